@@ -12,6 +12,9 @@ class MySQLUpdateBoard(UpdateBoard):
 
         self._mysql = MySQL(db_params)
 
+        # Number of rows per INSERT statement
+        self.batch_size = config.get('batch_size', 1000)
+
     def lock(self): #override
         self._mysql.lock_tables(write = ['inventory_updates'])
 
@@ -30,16 +33,37 @@ class MySQLUpdateBoard(UpdateBoard):
         self._mysql.query('ALTER TABLE `inventory_updates` AUTO_INCREMENT = 1')
 
     def write_updates(self, update_commands): #override
+        def make_row(cmd, obj):
+            if type(obj) is str:
+                sobj = obj
+            else:
+                sobj = repr(obj)
+
+            if cmd == DynamoInventory.CMD_UPDATE:
+                return ('update', sobj)
+            elif cmd == DynamoInventory.CMD_DELETE:
+                return ('delete', sobj)
+            else:
+                return None
+
         self._mysql.lock_tables(write = ['inventory_updates'])
 
         try:
-            sql = 'INSERT INTO `inventory_updates` (`cmd`, `obj`) VALUES (%s, %s)'
+            fields = ('cmd', 'obj')
+
+            rows = []
+            for cmd, obj in update_commands:
+                row = make_row(cmd, obj)
+                if row is None:
+                    continue
+
+                rows.append(row)
+
+                if len(rows) == self.batch_size:
+                    self._mysql.insert_many('inventory_updates', fields, None, rows, do_update = False)
+                    rows = []
 
-            for cmd, sobj in update_commands:
-                if cmd == DynamoInventory.CMD_UPDATE:
-                    self._mysql.query(sql, 'update', sobj)
-                elif cmd == DynamoInventory.CMD_DELETE:
-                    self._mysql.query(sql, 'delete', sobj)
+            self._mysql.insert_many('inventory_updates', fields, None, rows, do_update = False)
 
         finally:
             self._mysql.unlock_tables()
@@ -1,10 +1,12 @@
 import time
+import array
 import logging
 import fnmatch
 import hashlib
 
 from dynamo.core.components.persistency import InventoryStore
 from dynamo.utils.interface.mysql import MySQL
+from dynamo.utils.parallel import Map
 from dynamo.dataformat import Configuration, Partition, Dataset, Block, File, Site, SitePartition, Group, DatasetReplica, BlockReplica
 
 LOG = logging.getLogger(__name__)
@@ -17,6 +19,9 @@ class MySQLInventoryStore(InventoryStore):
 
         self._mysql = MySQL(config.db_params)
 
+        # Number of parallel connections used to load the replicas
+        self.num_load_shards = config.get('num_load_shards', 1)
+
     def close(self):
         self._mysql.close()
 
@@ -29,7 +34,7 @@ class MySQLInventoryStore(InventoryStore):
         return True
 
     def new_handle(self): #override
-        config = Configuration(db_params = self._mysql.config())
+        config = Configuration(db_params = self._mysql.config(), num_load_shards = self.num_load_shards)
         return MySQLInventoryStore(config)
 
     def get_partitions(self, conditions): #override
@@ -307,6 +312,94 @@ class MySQLInventoryStore(InventoryStore):
             id_block_map[block.id] = block
 
     def _load_replicas(self, inventory, id_group_map, id_site_map, id_dataset_map, id_block_maps, groups_tmp, sites_tmp, datasets_tmp):
+        if self.num_load_shards > 1:
+            if groups_tmp is None and sites_tmp is None and datasets_tmp is None:
+                self._load_replicas_sharded(id_group_map, id_site_map, id_dataset_map, id_block_maps)
+                return
+            else:
+                # Temporary tables are bound to the connection and cannot be used from other shards
+                LOG.info('Load constraints are set; loading replicas in a single shard.')
+
+        sql = self._replicas_query()
+
+        if groups_tmp is not None:
+            sql += ' INNER JOIN `%s`.`%s` AS gt ON gt.`id` = br.`group_id`' % (self._mysql.scratch_db, groups_tmp)
+
+        if sites_tmp is not None:
+            sql += ' INNER JOIN `%s`.`%s` AS st ON st.`id` = dr.`site_id`' % (self._mysql.scratch_db, sites_tmp)
+
+        if datasets_tmp is not None:
+            sql += ' INNER JOIN `%s`.`%s` AS dt ON dt.`id` = dr.`dataset_id`' % (self._mysql.scratch_db, datasets_tmp)
+
+        sql += ' ORDER BY dr.`dataset_id`, dr.`site_id`, b.`id`'
+
+        rows = self._mysql.xquery(sql)
+
+        for dataset_replica in self._make_replicas(rows, id_group_map, id_site_map, id_dataset_map, id_block_maps):
+            # add to dataset and site after filling all block replicas
+            # this does not matter for the dataset, but for the site there is some heavy
+            # computation needed when a replica is added
+            dataset_replica.dataset.replicas.add(dataset_replica)
+            dataset_replica.site.add_dataset_replica(dataset_replica, add_block_replicas = True)
+
+    def _load_replicas_sharded(self, id_group_map, id_site_map, id_dataset_map, id_block_maps):
+        """
+        Split the dataset id range into num_load_shards chunks with equal numbers of datasets and fetch
+        each chunk on its own connection. Dataset replicas are linked to the sites in this thread after
+        all shards are done, since sites are shared across shards.
+        """
+
+        dataset_ids = sorted(id_dataset_map.iterkeys())
+        if len(dataset_ids) == 0:
+            return
+
+        num_shards = min(self.num_load_shards, len(dataset_ids))
+        shard_size = len(dataset_ids) / num_shards + 1
+
+        # list of [min, max) ranges
+        ranges = []
+        for ishard in xrange(num_shards):
+            ifirst = ishard * shard_size
+            if ifirst >= len(dataset_ids):
+                break
+
+            ilast = ifirst + shard_size
+            if ilast >= len(dataset_ids):
+                ranges.append((dataset_ids[ifirst], dataset_ids[-1] + 1))
+            else:
+                ranges.append((dataset_ids[ifirst], dataset_ids[ilast]))
+
+        LOG.info('Loading replicas in %d shards.', len(ranges))
+
+        sql = self._replicas_query()
+        sql += ' WHERE dr.`dataset_id` >= %s AND dr.`dataset_id` < %s'
+        sql += ' ORDER BY dr.`dataset_id`, dr.`site_id`, b.`id`'
+
+        db_config = self._mysql.config()
+        db_config.reuse_connection = False
+
+        def load_shard(id_min, id_max):
+            mysql = MySQL(db_config)
+            try:
+                rows = mysql.xquery(sql, id_min, id_max)
+                # datasets and blocks are disjoint across shards - safe to fill their replica sets here
+                return list(self._make_replicas(rows, id_group_map, id_site_map, id_dataset_map, id_block_maps))
+            finally:
+                mysql.close()
+
+        pool = Map(Configuration(num_threads = len(ranges), repeat_on_exception = False))
+        pool.logger = LOG
+
+        for dataset_replicas in pool.execute(load_shard, ranges):
+            for dataset_replica in dataset_replicas:
+                dataset_replica.dataset.replicas.add(dataset_replica)
+                dataset_replica.site.add_dataset_replica(dataset_replica, add_block_replicas = True)
+
+    def _replicas_query(self):
+        """
+        SELECT ... FROM ... part of the replica loading query. Row format is understood by _make_replicas.
+        """
+
         sql = 'SELECT dr.`dataset_id`, dr.`site_id`, dr.`growing`, dr.`group_id`, br.`block_id`, br.`group_id`,'
         sql += ' br.`is_custodial`, UNIX_TIMESTAMP(br.`last_update`),'
         if BlockReplica._use_file_ids:
@@ -322,26 +415,25 @@ class MySQLInventoryStore(InventoryStore):
         else:
             sql += ' LEFT JOIN `block_replica_sizes` AS brf ON (brf.`block_id`, brf.`site_id`) = (b.`id`, dr.`site_id`)'
 
-        if groups_tmp is not None:
-            sql += ' INNER JOIN `%s`.`%s` AS gt ON gt.`id` = br.`group_id`' % (self._mysql.scratch_db, groups_tmp)
+        return sql
 
-        if sites_tmp is not None:
-            sql += ' INNER JOIN `%s`.`%s` AS st ON st.`id` = dr.`site_id`' % (self._mysql.scratch_db, sites_tmp)
-
-        if datasets_tmp is not None:
-            sql += ' INNER JOIN `%s`.`%s` AS dt ON dt.`id` = dr.`dataset_id`' % (self._mysql.scratch_db, datasets_tmp)
-
-        sql += ' ORDER BY dr.`dataset_id`, dr.`site_id`, b.`id`'
+    def _make_replicas(self, rows, id_group_map, id_site_map, id_dataset_map, id_block_maps):
+        """
+        Generator of dataset replicas with block replicas filled, from rows ordered by dataset id,
+        site id, and block id. Block replicas are added to the blocks; dataset replicas are not linked
+        to the datasets and sites.
+        """
 
         # Blocks are left joined -> there will be (# sites) x (# blocks) x (# block files) entries per dataset
 
         _dataset_id = 0
         _site_id = 0
         _block_id = 0
-        file_ids = []
+        # file ids of the current block replica, collected without creating a Python object per file
+        file_ids = array.array('L')
         dataset_replica = None
         block_replica = None
-        for row in self._mysql.xquery(sql):
+        for row in rows:
             if BlockReplica._use_file_ids:
                 dataset_id, site_id, growing, d_group_id, block_id, b_group_id, b_is_custodial, b_last_update, b_is_complete, file_id, file_size = row
             else:
@@ -363,12 +455,16 @@ class MySQLInventoryStore(InventoryStore):
 
             if dataset_replica is None or dataset is not dataset_replica.dataset or site is not dataset_replica.site:
                 if dataset_replica is not None:
-                    # previous dataset_replica
-                    # add to dataset and site after filling all block replicas
-                    # this does not matter for the dataset, but for the site there is some heavy
-                    # computation needed when a replica is added
-                    dataset_replica.dataset.replicas.add(dataset_replica)
-                    dataset_replica.site.add_dataset_replica(dataset_replica, add_block_replicas = True)
+                    if BlockReplica._use_file_ids and block_replica is not None and not block_replica_complete:
+                        # closing the last block replica of the previous dataset replica
+                        block_replica.size = block_replica_size
+                        block_replica.file_ids = file_ids
+
+                    yield dataset_replica
+
+                block_replica = None
+                block_replica_size = 0
+                del file_ids[:]
 
                 dataset_replica = DatasetReplica(
                     dataset,
@@ -392,7 +488,7 @@ class MySQLInventoryStore(InventoryStore):
                     # closing the previous block replica
                     if not block_replica_complete:
                         block_replica.size = block_replica_size
-                        block_replica.file_ids = tuple(file_ids)
+                        block_replica.file_ids = file_ids
 
                     block_replica_size = 0
                     del file_ids[:]
@@ -425,13 +521,12 @@ class MySQLInventoryStore(InventoryStore):
 
         # one last bit
 
-        if dataset_replica is not None:
-            dataset_replica.dataset.replicas.add(dataset_replica)
-            dataset_replica.site.add_dataset_replica(dataset_replica, add_block_replicas = True)
-
         if BlockReplica._use_file_ids and block_replica is not None and not block_replica_complete:
             block_replica.size = block_replica_size
-            block_replica.file_ids = tuple(file_ids)
+            block_replica.file_ids = file_ids
+
+        if dataset_replica is not None:
+            yield dataset_replica
 
     def _setup_constraints(self, table, names):
         tmp_table = table + '_load'
@@ -945,7 +1040,7 @@ class MySQLInventoryStore(InventoryStore):
         _group_id = 0
         group = None
         block_replica = None
-        file_ids = []
+        file_ids = array.array('L')
         for row in self._mysql.xquery(sql):
             if BlockReplica._use_file_ids:
                 block_id, block_name, block_size, dataset_id, dataset_name, site_id, site_name, group_name, group_id, is_custodial, last_update, is_complete, file_id, file_size = row
@@ -980,7 +1075,7 @@ class MySQLInventoryStore(InventoryStore):
                 if BlockReplica._use_file_ids and block_replica is not None:
                     if not block_replica_complete:
                         block_replica.size = block_replica_size
-                        block_replica.file_ids = tuple(file_ids)
+                        block_replica.file_ids = file_ids
 
                     yield block_replica
 
@@ -1015,10 +1110,190 @@ class MySQLInventoryStore(InventoryStore):
             # if true, we have one last one to yield
             if not block_replica_complete:
                 block_replica.size = block_replica_size
-                block_replica.file_ids = tuple(file_ids)
+                block_replica.file_ids = file_ids
 
             yield block_replica
             
+    def save_objects(self, objects): #override
+        """
+        Group the objects by type and write each group with multi-row statements. Objects that still need
+        an auto-increment id (id == 0) and the rarely updated types are written one by one.
+        """
+        objects_by_type = {}
+        for obj in objects:
+            try:
+                objects_by_type[type(obj)].append(obj)
+            except KeyError:
+                objects_by_type[type(obj)] = [obj]
+
+        bulk_savers = {
+            Block: self._save_block_list,
+            File: self._save_file_list,
+            DatasetReplica: self._save_datasetreplica_list,
+            BlockReplica: self._save_blockreplica_list
+        }
+
+        # owners first
+        for cls in (Partition, Group, Site, SitePartition, Dataset, Block, File, DatasetReplica, BlockReplica):
+            try:
+                objs = objects_by_type[cls]
+            except KeyError:
+                continue
+
+            try:
+                bulk_savers[cls](objs)
+            except KeyError:
+                for obj in objs:
+                    obj.write_into(self)
+
+    def delete_objects(self, objects): #override
+        objects_by_type = {}
+        for obj in objects:
+            try:
+                objects_by_type[type(obj)].append(obj)
+            except KeyError:
+                objects_by_type[type(obj)] = [obj]
+
+        bulk_deleters = {
+            DatasetReplica: self._delete_datasetreplica_list,
+            BlockReplica: self._delete_blockreplica_list
+        }
+
+        # owned objects first
+        for cls in (BlockReplica, DatasetReplica, File, Block, Dataset, SitePartition, Site, Group, Partition):
+            try:
+                objs = objects_by_type[cls]
+            except KeyError:
+                continue
+
+            try:
+                bulk_deleters[cls](objs)
+            except KeyError:
+                for obj in objs:
+                    obj.delete_from(self)
+
+    def _save_block_list(self, blocks):
+        known = []
+        for block in blocks:
+            if block.id == 0:
+                # need the id from the insertion
+                self.save_block(block)
+            elif block.dataset.id != 0:
+                known.append(block)
+
+        fields = ('dataset_id', 'name', 'size', 'num_files', 'is_open', 'last_update')
+        mapping = lambda block: (block.dataset.id, block.real_name(), block.size, block.num_files, block.is_open, \
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block.last_update)))
+
+        self._mysql.insert_many('blocks', fields, mapping, known)
+
+    def _save_file_list(self, files):
+        known = []
+        for lfile in files:
+            if lfile.id == 0:
+                self.save_file(lfile)
+            elif lfile.block.dataset.id != 0 and lfile.block.id != 0:
+                known.append(lfile)
+
+        fields = ('block_id', 'size', 'name') + File.checksum_algorithms
+        mapping = lambda lfile: (lfile.block.id, lfile.size, lfile.lfn) + tuple(lfile.checksum)
+
+        self._mysql.insert_many('files', fields, mapping, known)
+
+    def _save_datasetreplica_list(self, replicas):
+        replicas = [r for r in replicas if r.dataset.id != 0 and r.site.id != 0]
+
+        fields = ('dataset_id', 'site_id', 'growing', 'group_id')
+        mapping = lambda replica: (replica.dataset.id, replica.site.id, replica.growing, replica.group.id if replica.growing else None)
+
+        self._mysql.insert_many('dataset_replicas', fields, mapping, replicas)
+
+    def _save_blockreplica_list(self, replicas):
+        rows = []
+        complete = []
+        partial = []
+
+        for replica in replicas:
+            replica.check_file_ids()
+
+            block_id = replica.block.id
+            site_id = replica.site.id
+            if block_id == 0 or site_id == 0:
+                continue
+
+            is_complete = replica.is_complete()
+
+            rows.append((block_id, site_id, replica.group.id, replica.is_custodial, \
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(replica.last_update)), is_complete))
+
+            # See save_blockreplica for the case of file_ids = None on incomplete replicas
+            if is_complete or replica.file_ids is None:
+                complete.append((block_id, site_id))
+            else:
+                partial.append(replica)
+
+        fields = ('block_id', 'site_id', 'group_id', 'is_custodial', 'last_update', 'is_complete')
+        self._mysql.insert_many('block_replicas', fields, None, rows)
+
+        if BlockReplica._use_file_ids:
+            table = 'block_replica_files'
+        else:
+            table = 'block_replica_sizes'
+
+        self._mysql.delete_many(table, ('block_id', 'site_id'), complete)
+
+        if BlockReplica._use_file_ids:
+            def file_rows():
+                for replica in partial:
+                    block_id = replica.block.id
+                    site_id = replica.site.id
+                    for fid in replica.file_ids:
+                        yield (block_id, site_id, fid)
+
+            fields = ('block_id', 'site_id', 'file_id')
+            self._mysql.insert_many('block_replica_files', fields, None, file_rows())
+        else:
+            fields = ('block_id', 'site_id', 'num_files', 'size')
+            mapping = lambda replica: (replica.block.id, replica.site.id, replica.file_ids, replica.size)
+            self._mysql.insert_many('block_replica_sizes', fields, mapping, partial)
+
+    def _delete_datasetreplica_list(self, replicas):
+        keys = list(set((r.dataset.id, r.site.id) for r in replicas if r.dataset.id != 0 and r.site.id != 0))
+
+        sql = 'DELETE FROM br, brf, brs USING `blocks` AS b'
+        sql += ' INNER JOIN `block_replicas` AS br ON br.`block_id` = b.`id`'
+        sql += ' LEFT JOIN `block_replica_files` AS brf ON brf.`block_id` = b.`id` AND brf.`site_id` = br.`site_id`'
+        sql += ' LEFT JOIN `block_replica_sizes` AS brs ON brs.`block_id` = b.`id` AND brs.`site_id` = br.`site_id`'
+
+        self._mysql.execute_many(sql, MySQL.bare('(b.`dataset_id`, br.`site_id`)'), keys)
+
+        self._mysql.delete_many('dataset_replicas', ('dataset_id', 'site_id'), keys)
+
+    def _delete_blockreplica_list(self, replicas):
+        keys = []
+        dataset_keys = set()
+        for replica in replicas:
+            dataset_id = replica.block.dataset.id
+            block_id = replica.block.id
+            site_id = replica.site.id
+            if dataset_id == 0 or block_id == 0 or site_id == 0:
+                continue
+
+            keys.append((block_id, site_id))
+            dataset_keys.add((dataset_id, site_id))
+
+        for table in ['block_replicas', 'block_replica_files', 'block_replica_sizes']:
+            self._mysql.delete_many(table, ('block_id', 'site_id'), keys)
+
+        # delete the dataset replicas that became empty
+        sql = 'SELECT DISTINCT b.`dataset_id`, br.`site_id` FROM `block_replicas` AS br'
+        sql += ' INNER JOIN `blocks` AS b ON b.`id` = br.`block_id`'
+        non_empty = self._mysql.execute_many(sql, MySQL.bare('(b.`dataset_id`, br.`site_id`)'), list(dataset_keys))
+
+        dataset_keys.difference_update(tuple(row) for row in non_empty)
+
+        self._mysql.delete_many('dataset_replicas', ('dataset_id', 'site_id'), list(dataset_keys))
+
     def save_block(self, block): #override
         dataset_id = block.dataset.id
         if dataset_id == 0:
@@ -292,6 +292,24 @@ class InventoryStore(object):
 
         LOG.info('Saved %d block replicas.', num)
 
+    def save_objects(self, objects):
+        """
+        Save a list of objects of mixed types. Objects must be ordered so that owners come before the
+        objects they own (e.g. dataset before its blocks). Subclasses can override the function to group
+        the writes by table; the default implementation calls write_into of each object.
+        @param objects  List of embedded objects.
+        """
+        for obj in objects:
+            obj.write_into(self)
+
+    def delete_objects(self, objects):
+        """
+        Delete a list of objects of mixed types. The default implementation calls delete_from of each object.
+        @param objects  List of unlinked objects.
+        """
+        for obj in objects:
+            obj.delete_from(self)
+
     def save_block(self, block):
         raise NotImplementedError('save_block')
 
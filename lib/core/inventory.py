@@ -5,6 +5,9 @@ from dynamo.policy.condition import Condition
 from dynamo.policy.variables import replica_variables
 import dynamo.dataformat as df
 from dynamo.core.components.persistency import InventoryStore
+from dynamo.core.snapshot import InventorySnapshot
+from dynamo.core.journal import InventoryJournal
+from dynamo.core.updatecodec import pack_object
 
 LOG = logging.getLogger(__name__)
 
@@ -122,14 +125,14 @@ class DynamoInventoryProxy(ObjectRepository):
 
     def register_update(self, obj): #override
         """
-        Put the text representation of obj to _update_commands.
+        Put the packed representation of obj to _update_commands.
         """
 
         if self._update_commands is None:
             return
 
         LOG.debug('%s has changed. Adding a clone to updated objects list.', str(obj))
-        self._update_commands.append((DynamoInventory.CMD_UPDATE, repr(obj)))
+        self._update_commands.append((DynamoInventory.CMD_UPDATE, pack_object(obj)))
 
     def delete(self, obj): #override
         """
@@ -145,7 +148,7 @@ class DynamoInventoryProxy(ObjectRepository):
 
         if self._update_commands is not None:
             LOG.debug('%s is deleted.', str(obj))
-            self._update_commands.append((DynamoInventory.CMD_DELETE, repr(deleted_object)))
+            self._update_commands.append((DynamoInventory.CMD_DELETE, pack_object(deleted_object)))
 
         return deleted_object
 
@@ -164,13 +167,17 @@ class DynamoInventory(ObjectRepository):
     Inventory class. ObjectRepository with a persistent store backend.
     """
 
-    CMD_UPDATE, CMD_DELETE, CMD_EOM = range(3)
-    _cmd_str = ['UPDATE', 'DELETE', 'EOM']
+    CMD_UPDATE, CMD_DELETE, CMD_EOM, CMD_BATCH = range(4)
+    _cmd_str = ['UPDATE', 'DELETE', 'EOM', 'BATCH']
 
     @property
     def has_store(self):
         return self._has_store
 
+    @property
+    def has_journal(self):
+        return self._journal is not None
+
     def __init__(self, config):
         ObjectRepository.__init__(self)
 
@@ -188,6 +195,21 @@ class DynamoInventory(ObjectRepository):
 
         self.partition_def_path = config.partition_def_path
 
+        # Binary image of the loaded content for fast restarts
+        if config.get('snapshot_path', ''):
+            self._snapshot = InventorySnapshot(config.snapshot_path)
+        else:
+            self._snapshot = None
+
+        # Journal of applied updates, replayed over an older snapshot
+        if config.get('journal_path', ''):
+            self._journal = InventoryJournal(config.journal_path)
+        else:
+            self._journal = None
+
+        # Load constraints of the current content (saved with the snapshot)
+        self._load_opts = {}
+
     def init_store(self, module, config):
         if self._store:
             self._store.close()
@@ -217,6 +239,48 @@ class DynamoInventory(ObjectRepository):
         """
         self._store.save_data(self)
 
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        """
+        Write the in-memory content to the snapshot file, tagged with the current store version.
+        """
+        if self._snapshot is None or not self.loaded:
+            return
+
+        version = self.store_version()
+
+        if self._journal is None:
+            self._snapshot.save(self, version, self._load_opts)
+        else:
+            self._snapshot.save(self, version, self._load_opts, journal_seq = self._journal.last_seq)
+            # entries up to here are contained in the snapshot
+            self._journal.truncate(version)
+
+    def journal_updates(self, commands, version = None):
+        """
+        Record applied update commands in the journal.
+        @param commands  List of (cmd, object) returned by apply_updates
+        @param version   Store version after the update. If None, the entry is identified by its sequence number only
+                         and cannot bring a snapshot up to a store version.
+        """
+        if self._journal is None:
+            return
+
+        commands = [(cmd, obj) for cmd, obj in commands if obj is not None]
+        if len(commands) == 0:
+            return
+
+        try:
+            self._journal.append(commands, version)
+        except:
+            # journal is only an optimization; make sure it is not used for a replay
+            LOG.error('Failed to write to the inventory journal.')
+            try:
+                self._journal.clear()
+            except:
+                self._journal = None
+
     def new_store_handle(self):
         return self._store.new_handle()
 
@@ -243,18 +307,37 @@ class DynamoInventory(ObjectRepository):
 
         self._load_partitions()
 
-        LOG.info('Loading data from persistent storage.')
+        self._load_opts = {'groups': groups, 'sites': sites, 'datasets': datasets}
+
+        from_snapshot = False
+        replayed = False
+        if self._snapshot is not None:
+            # The snapshot is used only if it matches the current store version, directly or after replaying
+            # the journal. Otherwise the content is loaded from the store below.
+            try:
+                from_snapshot, replayed = self._load_snapshot()
+            except:
+                LOG.error('Failed to load the inventory snapshot. Loading from persistent storage.')
+
+        if not from_snapshot:
+            # The snapshot may have partially filled the containers
+            self.groups.clear()
+            self.groups[None] = df.Group.null_group
+            self.sites.clear()
+            self.datasets.clear()
+
+            LOG.info('Loading data from persistent storage.')
 
-        group_names = self._get_group_names(*groups)
-        site_names = self._get_site_names(*sites)
-        dataset_names = self._get_dataset_names(*datasets)
+            group_names = self._get_group_names(*groups)
+            site_names = self._get_site_names(*sites)
+            dataset_names = self._get_dataset_names(*datasets)
 
-        self._store.load_data(
-            self,
-            group_names = group_names,
-            site_names = site_names,
-            dataset_names = dataset_names
-        )
+            self._store.load_data(
+                self,
+                group_names = group_names,
+                site_names = site_names,
+                dataset_names = dataset_names
+            )
 
         num_dataset_replicas = 0
         num_block_replicas = 0
@@ -267,6 +350,52 @@ class DynamoInventory(ObjectRepository):
 
         self.loaded = True
 
+        if not from_snapshot or replayed:
+            try:
+                self.save_snapshot()
+            except:
+                # snapshot is only an optimization
+                LOG.error('Failed to write the inventory snapshot.')
+                self._snapshot.clear()
+
+    def _load_snapshot(self):
+        """
+        Fill the inventory from the snapshot. If the store has moved on since the snapshot was made, replay the
+        journal entries recorded after the snapshot.
+        @return (loaded, replayed)
+        """
+
+        store_version = self.store_version()
+
+        header = self._snapshot.get_header()
+        if header is None or header['store_version'] == store_version or self._journal is None:
+            return self._snapshot.load(self, store_version, self._load_opts), False
+
+        entries = self._journal.read_after(header.get('journal_seq', 0), header['store_version'])
+        if not entries or entries[-1][1] != store_version:
+            LOG.info('Inventory journal does not cover the changes since the snapshot.')
+            return False, False
+
+        if not self._snapshot.load(self, header['store_version'], self._load_opts):
+            return False, False
+
+        LOG.info('Replaying %d inventory journal entries.', len(entries))
+
+        num_commands = 0
+        for _, _, commands in entries:
+            for cmd, obj in commands:
+                # store already has the changes
+                if cmd == DynamoInventory.CMD_UPDATE:
+                    ObjectRepository.update(self, obj)
+                elif cmd == DynamoInventory.CMD_DELETE:
+                    ObjectRepository.delete(self, obj)
+
+            num_commands += len(commands)
+
+        LOG.info('Replayed %d update commands.', num_commands)
+
+        return True, True
+
     def _load_partitions(self):
         """Load partition data from a text table."""
 
@@ -407,3 +536,61 @@ class DynamoInventory(ObjectRepository):
                 raise
 
         return deleted_object
+
+    def apply_updates(self, commands):
+        """
+        Apply a list of update and delete commands. All objects are embedded into (or unlinked from) memory
+        first, and the changes are then written to store in bulk. Consecutive commands of the same kind are
+        written together, so the store sees updates and deletions in the same order as they were issued.
+        @param commands   List of (cmd, obj) with cmd = CMD_UPDATE or CMD_DELETE
+        @return  List of (cmd, embedded or deleted object). Deleted object is None if nothing was deleted.
+        """
+
+        results = []
+        # list of (cmd, objects)
+        runs = []
+
+        for cmd, obj in commands:
+            if cmd == DynamoInventory.CMD_UPDATE:
+                store_object = ObjectRepository.update(self, obj)
+            elif cmd == DynamoInventory.CMD_DELETE:
+                store_object = ObjectRepository.delete(self, obj)
+            else:
+                continue
+
+            results.append((cmd, store_object))
+
+            if store_object is None:
+                continue
+
+            if len(runs) == 0 or runs[-1][0] != cmd:
+                runs.append((cmd, []))
+
+            runs[-1][1].append(store_object)
+
+        if not self._has_store:
+            return results
+
+        for cmd, objects in runs:
+            if cmd == DynamoInventory.CMD_UPDATE:
+                # an object updated multiple times needs to be written only once
+                unique = []
+                seen = set()
+                for obj in objects:
+                    if id(obj) not in seen:
+                        seen.add(id(obj))
+                        unique.append(obj)
+
+                try:
+                    self._store.save_objects(unique)
+                except:
+                    LOG.error('Exception writing %d objects to inventory store', len(unique))
+                    raise
+            else:
+                try:
+                    self._store.delete_objects(objects)
+                except:
+                    LOG.error('Exception writing deletion of %d objects to inventory store', len(objects))
+                    raise
+
+        return results
@@ -0,0 +1,196 @@
+import os
+import time
+import struct
+import marshal
+import logging
+
+from dynamo.core.updatecodec import pack_object, unpack_object
+
+LOG = logging.getLogger(__name__)
+
+class InventoryJournal(object):
+    """
+    Append-only journal of the update commands applied to the inventory. Each entry carries a sequence number
+    and the store version after the commands were applied, so that an inventory image of a known version
+    (e.g. a snapshot) can be brought up to date by replaying the entries made after it.
+
+    File layout:
+      magic (8 bytes) | entries
+    Each entry is a 4-byte little-endian length followed by a marshalled tuple
+      (seq, store version, timestamp, [(cmd, record), ...])
+    where records are made by updatecodec.pack_object. An entry with None in place of the command list is a
+    checkpoint: it carries the sequence number and the store version over a truncation and serves as the
+    starting point of a replay.
+    """
+
+    MAGIC = 'DYNJRNL\x00'
+
+    _length = struct.Struct('<I')
+
+    def __init__(self, path):
+        """
+        @param path  Path to the journal file.
+        """
+        self.path = path
+
+        # Sequence number of the last entry and the end of the last complete entry in the file
+        # (None until the file is scanned)
+        self._last_seq = None
+        self._end = None
+
+    @property
+    def last_seq(self):
+        if self._last_seq is None:
+            self._scan()
+
+        return self._last_seq
+
+    def append(self, commands, version):
+        """
+        Write a new entry.
+        @param commands  List of (cmd, object) as applied to the inventory
+        @param version   Store version after the commands were applied, or None if not known (the entry is then
+                         keyed by its sequence number only)
+
+        @return Sequence number of the new entry.
+        """
+
+        seq = self.last_seq + 1
+        records = [(cmd, pack_object(obj)) for cmd, obj in commands]
+
+        self._write_entry((seq, version, int(time.time()), records))
+
+        return seq
+
+    def read_after(self, seq, version):
+        """
+        Return the entries following the given point of the history as a list of (seq, version, commands) where
+        commands are (cmd, unlinked object).
+        @param seq      Sequence number of the starting point
+        @param version  Store version at the starting point
+
+        @return List of entries, or None if the history since the starting point is not available.
+        """
+
+        entries = None
+
+        for entry, _ in self._read_entries():
+            entry_seq, entry_version, _, records = entry
+
+            if entries is None:
+                if entry_seq == seq and entry_version == version:
+                    # found the starting point
+                    entries = []
+
+                continue
+
+            if records is None or entry_seq != seq + len(entries) + 1:
+                # history is broken after the starting point
+                return None
+
+            entries.append((entry_seq, entry_version, [(cmd, unpack_object(record)) for cmd, record in records]))
+
+        return entries
+
+    def truncate(self, version):
+        """
+        Drop all entries. The sequence number continues from the current value.
+        @param version  Current store version (recorded in the checkpoint entry)
+        """
+
+        self._reset((self.last_seq, version, int(time.time()), None))
+
+    def clear(self):
+        """
+        Drop all entries without a valid starting point, so that no replay goes across this point.
+        """
+
+        self._reset((self.last_seq + 1, '', int(time.time()), None))
+
+    def _reset(self, checkpoint):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as output:
+            output.write(InventoryJournal.MAGIC)
+            data = marshal.dumps(checkpoint, 2)
+            output.write(InventoryJournal._length.pack(len(data)))
+            output.write(data)
+
+        os.rename(tmp_path, self.path)
+
+        self._last_seq = checkpoint[0]
+        self._end = os.path.getsize(self.path)
+
+    def _write_entry(self, entry):
+        if self._end is None:
+            self._scan()
+
+        data = marshal.dumps(entry, 2)
+
+        with open(self.path, 'r+b') as output:
+            # drop any partially written entry from a previous crash
+            output.seek(self._end)
+            output.truncate()
+
+            output.write(InventoryJournal._length.pack(len(data)))
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+
+            self._end = output.tell()
+
+        self._last_seq = entry[0]
+
+    def _scan(self):
+        """
+        Find the last sequence number and the end of the last complete entry. Create the file if necessary.
+        """
+
+        try:
+            with open(self.path, 'rb') as source:
+                valid = (source.read(len(InventoryJournal.MAGIC)) == InventoryJournal.MAGIC)
+        except IOError:
+            valid = False
+
+        if not valid:
+            self._reset((0, '', int(time.time()), None))
+            return
+
+        self._last_seq = 0
+        self._end = len(InventoryJournal.MAGIC)
+
+        for entry, end in self._read_entries():
+            self._last_seq = entry[0]
+            self._end = end
+
+    def _read_entries(self):
+        """
+        Generator of (entry, end offset) for complete entries.
+        """
+
+        try:
+            source = open(self.path, 'rb')
+        except IOError:
+            return
+
+        with source:
+            if source.read(len(InventoryJournal.MAGIC)) != InventoryJournal.MAGIC:
+                return
+
+            while True:
+                prefix = source.read(InventoryJournal._length.size)
+                if len(prefix) != InventoryJournal._length.size:
+                    break
+
+                length = InventoryJournal._length.unpack(prefix)[0]
+                data = source.read(length)
+                if len(data) != length:
+                    # incomplete entry at the end
+                    break
+
+                try:
+                    entry = marshal.loads(data)
+                except (ValueError, EOFError, TypeError):
+                    LOG.warning('Corrupt entry in inventory journal %s.', self.path)
+                    break
+
+                yield entry, source.tell()
@@ -6,6 +6,8 @@ import logging
 from dynamo.core.components.host import ServerHost, OutOfSyncError
 from dynamo.core.components.master import MasterServer, AppManager
 from dynamo.core.components.board import UpdateBoard
+from dynamo.utils.parallel import Map
+from dynamo.dataformat import Configuration
 
 LOG = logging.getLogger(__name__)
 
@@ -38,6 +40,9 @@ class ServerManager(object):
         # If using a remote store, name of the host
         self.store_host = ''
 
+        # Write updates to all online servers simultaneously instead of one by one
+        self.parallel_fanout = config.get('parallel_fanout', False)
+
         self.hostname = socket.gethostname()
         
         self.status = ServerHost.STAT_INITIAL
@@ -267,12 +272,18 @@ class ServerManager(object):
         """
         Send the list of update commands to all online servers.
 
-        @param update_commands  List of two-tuples (cmd, obj)
+        @param update_commands  List of two-tuples (cmd, objstr), where objstr is the representation string of the object.
+                                Any further encoding is done by the board of each server, within the error handling
+                                of the write.
         """
         # Write-enabled process and server start do not happen simultaneously.
         # No servers could have come online while we were running a write-enabled process - other_servers is the full list
         # of running servers.
 
+        if self.parallel_fanout:
+            self._send_updates_parallel(update_commands)
+            return
+
         processed = set()
 
         while True:
@@ -293,14 +304,7 @@ class ServerManager(object):
                     processed.add(server.hostname)
 
                     self.set_status(ServerHost.STAT_UPDATING, server.hostname)
-                    try:
-                        server.board.write_updates(update_commands)
-                    except:
-                        LOG.error('Error while sending updates to %s. Setting server state to OUTOFSYNC.', server.hostname)
-                        self.set_status(ServerHost.STAT_OUTOFSYNC, server.hostname)
-                    else:
-                        LOG.info('Sent %d update commands to %s.', len(update_commands), server.hostname)
-                        
+                    self._write_updates_to(server, update_commands)
 
                 elif server.status == ServerHost.STAT_UPDATING:
                     # this server is still processing updates from the previous write process
@@ -315,6 +319,68 @@ class ServerManager(object):
 
             time.sleep(1)
 
+    def _send_updates_parallel(self, update_commands):
+        """
+        Set all online servers to UPDATING in one master lock and write to their boards in parallel threads.
+        Servers still processing the previous updates are picked up in the next iteration.
+        """
+
+        processed = set()
+
+        while True:
+            targets = []
+            waiting = False
+
+            self.master.lock()
+
+            try:
+                self.collect_hosts()
+
+                for server in self.other_servers.itervalues():
+                    if server.hostname in processed:
+                        continue
+
+                    if server.status == ServerHost.STAT_ONLINE:
+                        processed.add(server.hostname)
+                        self.set_status(ServerHost.STAT_UPDATING, server.hostname)
+                        targets.append((server, update_commands))
+
+                    elif server.status == ServerHost.STAT_UPDATING:
+                        # this server is still processing updates from the previous write process
+                        waiting = True
+
+                    else:
+                        # any other status means the server is not running
+                        processed.add(server.hostname)
+
+            finally:
+                self.master.unlock()
+
+            # Boards are locked individually; no need to hold the master lock while writing
+            if len(targets) != 0:
+                pool = Map(Configuration(num_threads = len(targets), repeat_on_exception = False))
+                pool.logger = LOG
+                pool.execute(self._write_updates_to, targets)
+
+            if not waiting:
+                break
+
+            time.sleep(1)
+
+    def _write_updates_to(self, server, update_commands):
+        try:
+            server.board.write_updates(update_commands)
+        except:
+            LOG.error('Error while sending updates to %s. Setting server state to OUTOFSYNC.', server.hostname)
+            # already held in the serial mode (the lock is reentrant)
+            self.master.lock()
+            try:
+                self.set_status(ServerHost.STAT_OUTOFSYNC, server.hostname)
+            finally:
+                self.master.unlock()
+        else:
+            LOG.info('Sent %d update commands to %s.', len(update_commands), server.hostname)
+
     def disconnect(self):
         """
         Go offline and delete the entry from the master server list.
@@ -13,6 +13,7 @@ import traceback
 import shlex
 
 from dynamo.core.inventory import DynamoInventory
+from dynamo.core.updatecodec import encode_batches, decode_batch, object_name
 from dynamo.core.manager import ServerManager
 import dynamo.core.serverutils as serverutils
 from dynamo.core.components.appserver import AppServer
@@ -78,6 +79,8 @@ class DynamoServer(object):
 
         ## Queue to send / receive inventory updates
         self.inventory_update_queue = multiprocessing.JoinableQueue()
+        ## Number of update commands packed into one queue message
+        self.update_batch_size = config.get('update_batch_size', 10000)
 
         ## Recipient of error message emails
         self.notification_recipient = config.notification_recipient
@@ -167,6 +170,12 @@ class DynamoServer(object):
             except KeyboardInterrupt:
                 LOG.info('Server process was interrupted.')
 
+                # Save the current image so the next startup can skip the full load
+                try:
+                    self.inventory.save_snapshot()
+                except:
+                    log_exception(LOG)
+
                 break
     
             except OutOfSyncError:
@@ -504,18 +513,20 @@ class DynamoServer(object):
             self.manager.master.update_application(app_id, status = status, exit_code = proc.exitcode)
 
     def _collect_updates(self):
-        print_every = 100000
         updates_received = 0
         deletes_received = 0
 
         reading = False
         update_commands = []
 
+        # Decoded objects are unlinked; log only their names, and only when debugging
+        debug = (LOG.getEffectiveLevel() == logging.DEBUG)
+
         while True:
             try:
                 # Once we have an item sent, we'll read until the end (EOM).
                 # If the child dies in the middle of messaging, we get out of the while loop by timeout = 60
-                cmd, objstr = self.inventory_update_queue.get(block = reading, timeout = 60)
+                cmd, batch = self.inventory_update_queue.get(block = reading, timeout = 60)
             except Queue.Empty:
                 if reading:
                     # The child process crashed or timed out
@@ -527,23 +538,23 @@ class DynamoServer(object):
 
                 reading = True # Now we have to read until the end - start blocking queue.get
 
-                if LOG.getEffectiveLevel() == logging.DEBUG:
-                    if cmd == DynamoInventory.CMD_UPDATE:
-                        LOG.debug('Update %d from queue: %s', updates_received, objstr)
-                    elif cmd == DynamoInventory.CMD_DELETE:
-                        LOG.debug('Delete %d from queue: %s', deletes_received, objstr)
+                if cmd == DynamoInventory.CMD_BATCH:
+                    for obj_cmd, obj in decode_batch(batch):
+                        if obj_cmd == DynamoInventory.CMD_UPDATE:
+                            updates_received += 1
+                            if debug:
+                                LOG.debug('Update %d from queue: %s', updates_received, object_name(obj))
+                        elif obj_cmd == DynamoInventory.CMD_DELETE:
+                            deletes_received += 1
+                            if debug:
+                                LOG.debug('Delete %d from queue: %s', deletes_received, object_name(obj))
 
-                if cmd == DynamoInventory.CMD_UPDATE:
-                    updates_received += 1
-                    update_commands.append((cmd, objstr))
-                elif cmd == DynamoInventory.CMD_DELETE:
-                    deletes_received += 1
-                    update_commands.append((cmd, objstr))
+                        update_commands.append((obj_cmd, obj))
 
-                if cmd == DynamoInventory.CMD_EOM or len(update_commands) % print_every == 0:
-                    LOG.info('Received %d updates and %d deletes.', updates_received, deletes_received)
+                    LOG.debug('Received %d updates and %d deletes so far.', updates_received, deletes_received)
 
-                if cmd == DynamoInventory.CMD_EOM:
+                elif cmd == DynamoInventory.CMD_EOM:
+                    LOG.info('Received %d updates and %d deletes.', updates_received, deletes_received)
                     return 1, update_commands
 
     def _collect_updates_from_web(self):
@@ -602,17 +613,19 @@ class DynamoServer(object):
         self.manager.set_status(ServerHost.STAT_UPDATING)
 
         with SignalBlocker():
-            self._exec_updates(update_commands)
+            applied = self._exec_updates(update_commands)[2]
 
         self.manager.set_status(ServerHost.STAT_ONLINE)
 
         # Others
-        self.manager.send_updates(update_commands)
+        # The received objects are unlinked; peers get the representations of the embedded (or deleted) objects
+        peer_commands = [(cmd, repr(store_object)) for cmd, store_object in applied if store_object is not None]
+        self.manager.send_updates(peer_commands)
 
     def _read_updates(self):
         update_commands = self.manager.get_updates()
 
-        num_updates, num_deletes = self._exec_updates(update_commands)
+        num_updates, num_deletes, _ = self._exec_updates(update_commands)
 
         if num_updates + num_deletes != 0:
             LOG.info('Received %d updates and %d deletes from a remote server.', num_updates, num_deletes)
@@ -620,32 +633,45 @@ class DynamoServer(object):
             self.manager.set_status(ServerHost.STAT_ONLINE)
 
     def _exec_updates(self, update_commands):
+        commands = []
+        for cmd, obj in update_commands:
+            if type(obj) is str:
+                # Create a python object from its representation string (updates from peer servers)
+                obj = self.inventory.make_object(obj)
+
+            commands.append((cmd, obj))
+
+        applied = self.inventory.apply_updates(commands)
+
         num_updates = 0
         num_deletes = 0
-        for cmd, objstr in update_commands:
-            # Create a python object from its representation string
-            obj = self.inventory.make_object(objstr)
-
+        for cmd, store_object in applied:
             if cmd == DynamoInventory.CMD_UPDATE:
                 num_updates += 1
-                embedded_object = self.inventory.update(obj)
-                CHANGELOG.info('Saved %s', str(embedded_object))
+                CHANGELOG.info('Saved %s', str(store_object))
 
             elif cmd == DynamoInventory.CMD_DELETE:
                 num_deletes += 1
-                deleted_object = self.inventory.delete(obj)
-                if deleted_object is not None:
-                    CHANGELOG.info('Deleting %s', str(deleted_object))
+                if store_object is not None:
+                    CHANGELOG.info('Deleting %s', str(store_object))
 
         if num_updates + num_deletes != 0:
             if self.inventory.has_store:
-                self.manager.master.advertise_store_version(self.inventory.store_version())
+                version = self.inventory.store_version()
+
+                self.inventory.journal_updates(applied, version)
+
+                self.manager.master.advertise_store_version(version)
+
+            elif self.inventory.has_journal:
+                # The version of a remote store is a checksum over its live tables; key the entry by the local sequence number
+                self.inventory.journal_updates(applied)
 
             if self.webserver:
                 # Restart the web server so it gets the latest inventory image
                 self.webserver.restart()
 
-        return num_updates, num_deletes
+        return num_updates, num_deletes, applied
 
     def _start_subprocess(self, app, is_local):
         proc_args = (app['path'], app['args'], is_local, app['auth_level'])
@@ -866,18 +892,21 @@ class DynamoServer(object):
         sys.stderr.flush()
 
         wm = 0.
-        for iobj, (cmd, objstr) in enumerate(inventory._update_commands):
-            if float(iobj) / nobj * 100. > wm:
-                sys.stderr.write(' %.0f%%..' % (float(iobj) / nobj * 100.))
+        nsent = 0
+        for batch in encode_batches(inventory._update_commands, self.update_batch_size):
+            if float(nsent) / nobj * 100. > wm:
+                sys.stderr.write(' %.0f%%..' % (float(nsent) / nobj * 100.))
                 sys.stderr.flush()
                 wm += 5.
     
             try:
-                self.inventory_update_queue.put((cmd, objstr))
+                self.inventory_update_queue.put((DynamoInventory.CMD_BATCH, batch))
             except:
-                sys.stderr.write('Exception while sending %s %s\n' % (DynamoInventory._cmd_str[cmd], objstr))
+                sys.stderr.write('Exception while sending update batch at object %d\n' % nsent)
                 sys.stderr.flush()
                 raise
+
+            nsent += self.update_batch_size
     
         if nobj != 0:
             sys.stderr.write(' 100%.\n')
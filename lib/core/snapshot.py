@@ -0,0 +1,338 @@
+import os
+import time
+import struct
+import marshal
+import mmap
+import logging
+
+from dynamo.dataformat import Dataset, Block, Site, SitePartition, Group, DatasetReplica, BlockReplica
+
+LOG = logging.getLogger(__name__)
+
+class InventorySnapshot(object):
+    """
+    Binary on-disk image of the inventory content, used to skip the full load from the persistency store
+    at server startup. The image is tagged with the store version it was made from and is only valid
+    as long as the store has the same version.
+
+    File layout:
+      magic (8 bytes) | header offset (8 bytes, little endian) | sections | header
+    Sections are marshalled lists of flat tuples. Objects refer to each other by their position in
+    the parent section, so the image does not depend on the store ids being set.
+    """
+
+    MAGIC = 'DYNSNAP\x00'
+    FORMAT_VERSION = 1
+
+    _prefix = struct.Struct('<8sQ')
+
+    def __init__(self, path):
+        """
+        @param path  Path to the snapshot file.
+        """
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def save(self, inventory, version, load_opts = {}, journal_seq = 0):
+        """
+        Write the inventory content to the snapshot file. The file is written to a temporary
+        location first and renamed, so a crash in the middle never leaves a truncated image.
+
+        @param inventory    DynamoInventory (or any ObjectRepository)
+        @param version      Store version string to tag the image with
+        @param load_opts    Load constraints used to fill the inventory (saved for validation)
+        @param journal_seq  Sequence number of the last inventory journal entry contained in the image
+        """
+
+        LOG.info('Writing inventory snapshot to %s.', self.path)
+        start = time.time()
+
+        tmp_path = self.path + '.tmp'
+        sections = []
+
+        with open(tmp_path, 'wb') as output:
+            output.write(InventorySnapshot._prefix.pack(InventorySnapshot.MAGIC, 0))
+
+            for name, data in self._serialize(inventory):
+                offset = output.tell()
+                marshal.dump(data, output, 2)
+                sections.append((name, offset, output.tell() - offset))
+
+            header = {
+                'format': InventorySnapshot.FORMAT_VERSION,
+                'store_version': version,
+                'load_opts': self._normalize_opts(load_opts),
+                'journal_seq': journal_seq,
+                'timestamp': int(time.time()),
+                'sections': sections
+            }
+
+            header_offset = output.tell()
+            marshal.dump(header, output, 2)
+
+            output.seek(0)
+            output.write(InventorySnapshot._prefix.pack(InventorySnapshot.MAGIC, header_offset))
+
+        os.rename(tmp_path, self.path)
+
+        LOG.info('Inventory snapshot written in %.1f seconds.', time.time() - start)
+
+    def get_version(self):
+        """
+        @return Store version the snapshot was made from, or None if there is no valid snapshot.
+        """
+
+        header = self.get_header()
+        if header is None:
+            return None
+
+        return header['store_version']
+
+    def get_header(self):
+        """
+        @return Header dict of the snapshot file, or None if there is no valid snapshot.
+        """
+
+        try:
+            with open(self.path, 'rb') as source:
+                return self._read_header(source.read)
+        except (IOError, OSError, ValueError, EOFError):
+            return None
+
+    def load(self, inventory, version, load_opts = {}):
+        """
+        Rehydrate the inventory from the snapshot file. Inventory partitions must be set up already.
+
+        @param inventory  DynamoInventory to fill
+        @param version    Current store version; snapshot is not used if it does not match
+        @param load_opts  Load constraints; snapshot is not used if they differ from the saved ones
+
+        @return True if the inventory was filled, False if the snapshot is missing or stale.
+        """
+
+        if not self.exists():
+            return False
+
+        start = time.time()
+
+        with open(self.path, 'rb') as source:
+            try:
+                image = mmap.mmap(source.fileno(), 0, access = mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                # empty or unreadable file
+                return False
+
+            try:
+                header = self._read_header(lambda size: image[:size], image)
+                if header is None:
+                    LOG.info('Inventory snapshot %s has an unknown format.', self.path)
+                    return False
+
+                if header['store_version'] != version:
+                    LOG.info('Inventory snapshot %s is stale (version %s, store %s).', self.path, header['store_version'], version)
+                    return False
+
+                if header['load_opts'] != self._normalize_opts(load_opts):
+                    LOG.info('Inventory snapshot %s was made with different load options.', self.path)
+                    return False
+
+                LOG.info('Loading inventory from snapshot %s.', self.path)
+
+                data = {}
+                for name, offset, length in header['sections']:
+                    data[name] = marshal.loads(image[offset:offset + length])
+
+            finally:
+                image.close()
+
+        self._deserialize(inventory, data)
+
+        LOG.info('Inventory snapshot loaded in %.1f seconds.', time.time() - start)
+
+        return True
+
+    def _read_header(self, read, image = None):
+        prefix = read(InventorySnapshot._prefix.size)
+        if len(prefix) != InventorySnapshot._prefix.size:
+            return None
+
+        magic, header_offset = InventorySnapshot._prefix.unpack(prefix)
+        if magic != InventorySnapshot.MAGIC or header_offset == 0:
+            return None
+
+        if image is None:
+            with open(self.path, 'rb') as source:
+                source.seek(header_offset)
+                header = marshal.load(source)
+        else:
+            header = marshal.loads(image[header_offset:])
+
+        if type(header) is not dict or header.get('format') != InventorySnapshot.FORMAT_VERSION:
+            return None
+
+        return header
+
+    @staticmethod
+    def _normalize_opts(load_opts):
+        # marshal-friendly and comparable form of the load constraints
+        opts = {}
+        for key, value in load_opts.iteritems():
+            opts[key] = tuple((tuple(v) if type(v) is list else v) for v in value)
+
+        return opts
+
+    def _serialize(self, inventory):
+        """
+        Generator of (section name, list of tuples). Section order matters for references.
+        """
+
+        yield 'software_versions', [(v.id, v.value) for v in Dataset._software_versions_byid]
+
+        group_index = {}
+        groups = []
+        for group in inventory.groups.itervalues():
+            if group.name is None:
+                continue
+
+            group_index[group] = len(groups) + 1
+            groups.append((group.name, group.olevel, group.id))
+
+        yield 'groups', groups
+
+        site_index = {}
+        sites = []
+        quotas = []
+        for site in inventory.sites.itervalues():
+            site_index[site] = len(sites)
+            mapping = dict((protocol, m._chains) for protocol, m in site.filename_mapping.iteritems())
+            sites.append((site.name, site.host, site.storage_type, site.backend, site.status, mapping, site.id))
+
+            for partition, site_partition in site.partitions.iteritems():
+                if partition.subpartitions is None and site_partition._quota != 0:
+                    quotas.append((site_index[site], partition.name, site_partition._quota))
+
+        yield 'sites', sites
+        yield 'quotas', quotas
+
+        def group_idx(group):
+            if group is None or group.name is None:
+                return 0
+            return group_index[group]
+
+        datasets = []
+        blocks = []
+        dataset_replicas = []
+        block_replicas = []
+
+        for dataset in inventory.datasets.itervalues():
+            idataset = len(datasets)
+            datasets.append((dataset.name, dataset.status, dataset.data_type, dataset._software_version_id, dataset.last_update, dataset.is_open, dataset.id))
+
+            block_index = {}
+            for block in dataset.blocks:
+                block_index[block] = len(blocks)
+                blocks.append((idataset, block.name, block.size, block.num_files, block.is_open, block.last_update, block.id))
+
+            for replica in dataset.replicas:
+                if replica.group is None:
+                    group = -1
+                else:
+                    group = group_idx(replica.group)
+
+                dataset_replicas.append((idataset, site_index[replica.site], replica.growing, group))
+                ireplica = len(dataset_replicas) - 1
+
+                for block_replica in replica.block_replicas:
+                    if block_replica.file_ids is None or type(block_replica.file_ids) is int:
+                        file_ids = block_replica.file_ids
+                    else:
+                        file_ids = tuple(block_replica.file_ids)
+
+                    block_replicas.append((ireplica, block_index[block_replica.block], group_idx(block_replica.group),
+                        block_replica.is_custodial, block_replica.size, block_replica.last_update, file_ids))
+
+        yield 'datasets', datasets
+        yield 'blocks', blocks
+        yield 'dataset_replicas', dataset_replicas
+        yield 'block_replicas', block_replicas
+
+    def _deserialize(self, inventory, data):
+        Dataset._software_versions_byid = []
+        Dataset._software_versions_byvalue = {}
+        for vid, value in data['software_versions']:
+            version = Dataset.SoftwareVersion(value, vid)
+            Dataset._software_versions_byid.append(version)
+            if value is not None:
+                Dataset._software_versions_byvalue[value] = version
+
+        groups = [inventory.groups[None]]
+        for name, olevel, gid in data['groups']:
+            group = Group(name, olevel = olevel, gid = gid)
+            inventory.groups.add(group)
+            groups.append(group)
+
+        sites = []
+        for name, host, storage_type, backend, status, mapping, sid in data['sites']:
+            site = Site(name, host = host, storage_type = storage_type, backend = backend, status = status, filename_mapping = mapping, sid = sid)
+            inventory.sites.add(site)
+            sites.append(site)
+
+            for partition in inventory.partitions.itervalues():
+                site.partitions[partition] = SitePartition(site, partition)
+
+        for isite, partition_name, quota in data['quotas']:
+            try:
+                partition = inventory.partitions[partition_name]
+            except KeyError:
+                continue
+
+            sites[isite].partitions[partition].set_quota(quota)
+
+        datasets = []
+        for name, status, data_type, sw_version_id, last_update, is_open, did in data['datasets']:
+            dataset = Dataset(name, status = status, data_type = data_type, last_update = last_update, is_open = is_open, did = did)
+            dataset._software_version_id = sw_version_id
+            inventory.datasets.add(dataset)
+            datasets.append(dataset)
+
+        blocks = []
+        for idataset, name, size, num_files, is_open, last_update, bid in data['blocks']:
+            dataset = datasets[idataset]
+            block = Block(name, dataset, size = size, num_files = num_files, is_open = is_open, last_update = last_update, bid = bid)
+            dataset.blocks.add(block)
+            blocks.append(block)
+
+        dataset_replicas = []
+        for idataset, isite, growing, igroup in data['dataset_replicas']:
+            if igroup < 0:
+                group = None
+            else:
+                group = groups[igroup]
+
+            replica = DatasetReplica(datasets[idataset], sites[isite], growing = growing, group = group)
+            dataset_replicas.append(replica)
+
+        for ireplica, iblock, igroup, is_custodial, size, last_update, file_ids in data['block_replicas']:
+            dataset_replica = dataset_replicas[ireplica]
+            block = blocks[iblock]
+
+            # constructor is bypassed for size and file_ids to avoid the per-file consistency checks
+            block_replica = BlockReplica(block, dataset_replica.site, groups[igroup], is_custodial = is_custodial, last_update = last_update)
+            block_replica.size = size
+            block_replica.file_ids = file_ids
+
+            dataset_replica.block_replicas.add(block_replica)
+            block.replicas.add(block_replica)
+
+        # add to dataset and site after filling all block replicas (see MySQLInventoryStore._load_replicas)
+        for replica in dataset_replicas:
+            replica.dataset.replicas.add(replica)
+            replica.site.add_dataset_replica(replica, add_block_replicas = True)
@@ -0,0 +1,256 @@
+"""
+Compact binary encoding of inventory update commands.
+
+Application processes record each updated or deleted object as a flat record (type tag + field values),
+and the records are sent to the server in large batches. A batch is a marshalled tuple
+  (format version, name table, [(cmd, tag, field, ...), ...])
+where repeated names (datasets, sites, groups, partitions) are replaced by indices into the name table.
+Records are turned back into objects by calling the constructors directly, without going through eval.
+"""
+
+import marshal
+
+from dynamo.dataformat import Dataset, Block, File, Site, SitePartition, Group, DatasetReplica, BlockReplica, Partition, ObjectError
+
+FORMAT_VERSION = 1
+
+# Type tags
+TAG_DATASET, TAG_BLOCK, TAG_FILE, TAG_SITE, TAG_SITEPARTITION, TAG_GROUP, TAG_DATASETREPLICA, TAG_BLOCKREPLICA, TAG_PARTITION = range(1, 10)
+
+def _pack_dataset(dataset):
+    return (TAG_DATASET, dataset.name, dataset.status, dataset.data_type, dataset.software_version, dataset.last_update, dataset.is_open, dataset.id)
+
+def _pack_block(block):
+    return (TAG_BLOCK, block._dataset_name(), block.real_name(), block.size, block.num_files, block.is_open, block.last_update, block.id)
+
+def _pack_file(lfile):
+    block_name = lfile._block_full_name()
+    if block_name is None:
+        dataset_name = None
+        block_real_name = None
+    else:
+        dataset_name, block_internal_name = Block.from_full_name(block_name)
+        block_real_name = Block.to_real_name(block_internal_name)
+
+    return (TAG_FILE, dataset_name, block_real_name, lfile.lfn, lfile.size, tuple(lfile.checksum), lfile.id)
+
+def _pack_site(site):
+    mapping = dict((protocol, m._chains) for protocol, m in site.filename_mapping.iteritems())
+    return (TAG_SITE, site.name, site.host, site.storage_type, site.backend, site.status, mapping, site.id)
+
+def _pack_sitepartition(site_partition):
+    return (TAG_SITEPARTITION, site_partition._site_name(), site_partition._partition_name(), site_partition._quota)
+
+def _pack_group(group):
+    return (TAG_GROUP, group.name, group.olevel, group.id)
+
+def _pack_datasetreplica(replica):
+    return (TAG_DATASETREPLICA, replica._dataset_name(), replica._site_name(), replica.growing, replica._group_name())
+
+def _pack_blockreplica(replica):
+    # Same convention as BlockReplica.__repr__: size is -1 if the replica is complete
+    if replica.is_complete():
+        size = -1
+        file_ids = None
+    else:
+        size = replica.size
+        file_ids = replica.file_ids
+        if file_ids is not None and type(file_ids) is not int:
+            file_ids = tuple(file_ids)
+
+    dataset_name, block_internal_name = Block.from_full_name(replica._block_full_name())
+
+    return (TAG_BLOCKREPLICA, dataset_name, Block.to_real_name(block_internal_name), replica._site_name(), replica._group_name(),
+        replica.is_custodial, size, replica.last_update, file_ids)
+
+def _pack_partition(partition):
+    return (TAG_PARTITION, partition.name, partition.id)
+
+_packers = {
+    Dataset: _pack_dataset,
+    Block: _pack_block,
+    File: _pack_file,
+    Site: _pack_site,
+    SitePartition: _pack_sitepartition,
+    Group: _pack_group,
+    DatasetReplica: _pack_datasetreplica,
+    BlockReplica: _pack_blockreplica,
+    Partition: _pack_partition
+}
+
+# Positions of name fields (to be interned) in each record, counting the tag as position 0
+_name_fields = {
+    TAG_DATASET: (1,),
+    TAG_BLOCK: (1,),
+    TAG_FILE: (1,),
+    TAG_SITE: (1,),
+    TAG_SITEPARTITION: (1, 2),
+    TAG_GROUP: (1,),
+    TAG_DATASETREPLICA: (1, 2, 4),
+    TAG_BLOCKREPLICA: (1, 3, 4),
+    TAG_PARTITION: (1,)
+}
+
+def pack_object(obj):
+    """
+    Make a flat record out of an inventory object. The record captures the state of the object at
+    the time of the call, like repr(obj) does.
+
+    @param obj  A dataformat object
+    @return A tuple (tag, field, ...)
+    """
+
+    try:
+        packer = _packers[type(obj)]
+    except KeyError:
+        raise ObjectError('Cannot encode object of type %s' % type(obj).__name__)
+
+    return packer(obj)
+
+_namers = {
+    Dataset: lambda obj: obj.name,
+    Block: lambda obj: obj.full_name(),
+    File: lambda obj: obj.lfn,
+    Site: lambda obj: obj.name,
+    SitePartition: lambda obj: '%s/%s' % (obj._site_name(), obj._partition_name()),
+    Group: lambda obj: str(obj.name),
+    DatasetReplica: lambda obj: '%s:%s' % (obj._site_name(), obj._dataset_name()),
+    BlockReplica: lambda obj: '%s:%s' % (obj._site_name(), obj._block_full_name()),
+    Partition: lambda obj: obj.name
+}
+
+def object_name(obj):
+    """
+    Identify an object by its type and name, for logging. Unlike str() and repr(), this works on the
+    unlinked objects returned by unpack_object and decode_batch.
+
+    @param obj  A dataformat object
+    @return A string "Type name"
+    """
+
+    try:
+        namer = _namers[type(obj)]
+    except KeyError:
+        return type(obj).__name__
+
+    return '%s %s' % (type(obj).__name__, namer(obj))
+
+def _make_dataset(name, status, data_type, software_version, last_update, is_open, did):
+    return Dataset(name, status = status, data_type = data_type, software_version = software_version, last_update = last_update, is_open = is_open, did = did)
+
+def _make_block(dataset_name, real_name, size, num_files, is_open, last_update, bid):
+    return Block(real_name, dataset_name, size = size, num_files = num_files, is_open = is_open, last_update = last_update, bid = bid, internal_name = False)
+
+def _make_file(dataset_name, block_real_name, lfn, size, checksum, fid):
+    if dataset_name is None:
+        block = None
+    else:
+        block = Block.to_full_name(dataset_name, block_real_name)
+
+    return File(lfn, block = block, size = size, checksum = checksum, fid = fid)
+
+def _make_site(name, host, storage_type, backend, status, mapping, sid):
+    return Site(name, host = host, storage_type = storage_type, backend = backend, status = status, filename_mapping = mapping, sid = sid)
+
+def _make_sitepartition(site_name, partition_name, quota):
+    return SitePartition(site_name, partition_name, quota = quota)
+
+def _make_group(name, olevel, gid):
+    return Group(name, olevel = olevel, gid = gid)
+
+def _make_datasetreplica(dataset_name, site_name, growing, group_name):
+    return DatasetReplica(dataset_name, site_name, growing = growing, group = group_name)
+
+def _make_blockreplica(dataset_name, block_real_name, site_name, group_name, is_custodial, size, last_update, file_ids):
+    block_name = Block.to_full_name(dataset_name, block_real_name)
+    return BlockReplica(block_name, site_name, group_name, is_custodial = is_custodial, size = size, last_update = last_update, file_ids = file_ids)
+
+def _make_partition(name, pid):
+    return Partition(name, pid = pid)
+
+_makers = {
+    TAG_DATASET: _make_dataset,
+    TAG_BLOCK: _make_block,
+    TAG_FILE: _make_file,
+    TAG_SITE: _make_site,
+    TAG_SITEPARTITION: _make_sitepartition,
+    TAG_GROUP: _make_group,
+    TAG_DATASETREPLICA: _make_datasetreplica,
+    TAG_BLOCKREPLICA: _make_blockreplica,
+    TAG_PARTITION: _make_partition
+}
+
+def unpack_object(record):
+    """
+    Create an object from a record made by pack_object. The object is unlinked, like the ones
+    created from repr strings.
+
+    @param record  A tuple (tag, field, ...)
+    @return A new dataformat object
+    """
+
+    try:
+        maker = _makers[record[0]]
+    except KeyError:
+        raise ObjectError('Unknown object type tag %s' % str(record[0]))
+
+    return maker(*record[1:])
+
+def encode_batches(commands, batch_size = 10000):
+    """
+    Generator of binary batches.
+
+    @param commands    Iterable of (cmd, record) with records made by pack_object
+    @param batch_size  Maximum number of commands in a batch
+    """
+
+    names = []
+    name_index = {}
+    records = []
+
+    for cmd, record in commands:
+        record = list(record)
+        for ifield in _name_fields[record[0]]:
+            name = record[ifield]
+            try:
+                record[ifield] = name_index[name]
+            except KeyError:
+                record[ifield] = name_index[name] = len(names)
+                names.append(name)
+
+        records.append((cmd,) + tuple(record))
+
+        if len(records) == batch_size:
+            yield marshal.dumps((FORMAT_VERSION, names, records), 2)
+
+            names = []
+            name_index = {}
+            records = []
+
+    if len(records) != 0:
+        yield marshal.dumps((FORMAT_VERSION, names, records), 2)
+
+def decode_batch(batch):
+    """
+    Decode a batch made by encode_batches.
+
+    @param batch  A binary string
+    @return List of (cmd, object)
+    """
+
+    version, names, records = marshal.loads(batch)
+    if version != FORMAT_VERSION:
+        raise ObjectError('Unknown update batch format %s' % str(version))
+
+    commands = []
+
+    for record in records:
+        record = list(record)
+        cmd = record[0]
+        tag = record[1]
+        for ifield in _name_fields[tag]:
+            record[ifield + 1] = names[record[ifield + 1]]
+
+        commands.append((cmd, _makers[tag](*record[2:])))
+
+    return commands
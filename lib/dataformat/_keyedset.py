@@ -0,0 +1,187 @@
+def _restore(cls, key, elements):
+    """
+    Unpickle a keyed set. When the elements are part of a reference cycle, they may not be fully restored at
+    this point. The index is therefore built at the first lookup (_index = None).
+    """
+    if issubclass(cls, frozenset):
+        obj = frozenset.__new__(cls, elements)
+    else:
+        obj = set.__new__(cls)
+        set.update(obj, elements)
+
+    obj._key = key
+    obj._index = None
+    return obj
+
+class KeyedSet(set):
+    """
+    Set with a dict index of its elements by a key. The key function must be picklable (a module-level function)
+    and the key of an element must not change while the element is in the set. Operations that create a new set
+    (copy, union, | etc.) return plain sets. Subclasses that keep derived quantities should recompute them in
+    _reindex.
+    """
+
+    __slots__ = ['_key', '_index']
+
+    def __init__(self, key, iterable = ()):
+        set.__init__(self)
+        self._key = key
+        self._index = {}
+        self.update(iterable)
+
+    def __reduce__(self):
+        return (_restore, (type(self), self._key, list(self)))
+
+    def get(self, key, default = None):
+        """
+        Return the element with the key, or default if there is none.
+        """
+        self._check_index()
+        return self._index.get(key, default)
+
+    def add(self, elem):
+        self._check_index()
+        set.add(self, elem)
+        self._index[self._key(elem)] = elem
+
+    def remove(self, elem):
+        self._check_index()
+        set.remove(self, elem)
+        self._unindex(elem)
+
+    def discard(self, elem):
+        if elem in self:
+            self.remove(elem)
+
+    def pop(self):
+        self._check_index()
+        elem = set.pop(self)
+        self._unindex(elem)
+        return elem
+
+    def clear(self):
+        set.clear(self)
+        self._index = {}
+
+    def update(self, *others):
+        for other in others:
+            for elem in other:
+                self.add(elem)
+
+    def difference_update(self, *others):
+        for other in others:
+            for elem in other:
+                self.discard(elem)
+
+    def intersection_update(self, *others):
+        set.intersection_update(self, *others)
+        self._reindex()
+
+    def symmetric_difference_update(self, other):
+        set.symmetric_difference_update(self, other)
+        self._reindex()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def copy(self):
+        return set(self)
+
+    def union(self, *others):
+        return set(self).union(*others)
+
+    def intersection(self, *others):
+        return set(self).intersection(*others)
+
+    def difference(self, *others):
+        return set(self).difference(*others)
+
+    def symmetric_difference(self, other):
+        return set(self).symmetric_difference(other)
+
+    def __or__(self, other):
+        return set(self) | other
+
+    def __and__(self, other):
+        return set(self) & other
+
+    def __sub__(self, other):
+        return set(self) - other
+
+    def __xor__(self, other):
+        return set(self) ^ other
+
+    def _check_index(self):
+        if self._index is None:
+            self._reindex()
+
+    def _unindex(self, elem):
+        key = self._key(elem)
+        if self._index.get(key) is elem:
+            self._index.pop(key)
+
+    def _reindex(self):
+        self._index = dict((self._key(elem), elem) for elem in self)
+
+
+class KeyedFrozenSet(frozenset):
+    """
+    Frozenset with a dict index of its elements by a key. See KeyedSet.
+    """
+
+    __slots__ = ['_key', '_index']
+
+    def __new__(cls, key, iterable = ()):
+        obj = frozenset.__new__(cls, iterable)
+        obj._key = key
+        obj._index = dict((key(elem), elem) for elem in obj)
+        return obj
+
+    def __reduce__(self):
+        return (_restore, (type(self), self._key, list(self)))
+
+    def get(self, key, default = None):
+        if self._index is None:
+            self._index = dict((self._key(elem), elem) for elem in self)
+
+        return self._index.get(key, default)
+
+    def copy(self):
+        return frozenset(self)
+
+    def union(self, *others):
+        return frozenset(self).union(*others)
+
+    def intersection(self, *others):
+        return frozenset(self).intersection(*others)
+
+    def difference(self, *others):
+        return frozenset(self).difference(*others)
+
+    def symmetric_difference(self, other):
+        return frozenset(self).symmetric_difference(other)
+
+    def __or__(self, other):
+        return frozenset(self) | other
+
+    def __and__(self, other):
+        return frozenset(self) & other
+
+    def __sub__(self, other):
+        return frozenset(self) - other
+
+    def __xor__(self, other):
+        return frozenset(self) ^ other
@@ -4,8 +4,16 @@ import threading
 import weakref
 
 from exceptions import ObjectError, IntegrityError, OperationalError
+from _keyedset import KeyedSet, KeyedFrozenSet
 from _namespace import customize_block
 
+# Index keys of Block.replicas and Block.files
+def _replica_key(replica):
+    return replica._site_name()
+
+def _file_key(lfile):
+    return lfile._lfn
+
 class Block(object):
     """
     Smallest data unit for data management.
@@ -40,6 +48,7 @@ class Block(object):
     def num_files(self, value):
         if value != self._num_files:
             self._check_and_load_files(cache = False)
+            self._update_totals(0, value - self._num_files)
             self._num_files = value
 
     @property
@@ -50,6 +59,7 @@ class Block(object):
     def size(self, value):
         if value != self._size:
             self._check_and_load_files(cache = False)
+            self._update_totals(value - self._size, 0)
             self._size = value
 
     @property
@@ -73,7 +83,8 @@ class Block(object):
         
         self.id = bid
 
-        self.replicas = set()
+        # set indexed by site name
+        self.replicas = KeyedSet(_replica_key)
 
         self._files = None
 
@@ -180,14 +191,17 @@ class Block(object):
         @param lfn        File name
         @param must_find  Raise an exception if file is not found.
         """
-        try:
-            return next(f for f in self.files if f._lfn == lfn)
+        files = self.files
+        if type(files) is set or type(files) is frozenset:
+            # files were set directly from outside
+            lfile = next((f for f in files if f._lfn == lfn), None)
+        else:
+            lfile = files.get(lfn)
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Cannot find file %s' % str(lfn))
-            else:
-                return None
+        if lfile is None and must_find:
+            raise ObjectError('Cannot find file %s' % str(lfn))
+
+        return lfile
 
     def add_file(self, lfile):
         """
@@ -209,17 +223,17 @@ class Block(object):
         self._files.remove(lfile)
 
     def find_replica(self, site, must_find = False):
-        try:
-            if type(site) is str:
-                return next(r for r in self.replicas if r.site.name == site)
-            else:
-                return next(r for r in self.replicas if r.site == site)
+        if type(site) is str:
+            replica = self.replicas.get(site)
+        else:
+            replica = self.replicas.get(site.name)
+            if replica is not None and replica.site != site:
+                replica = None
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Cannot find replica at %s for %s' % (site.name, self.full_name()))
-            else:
-                return None
+        if replica is None and must_find:
+            raise ObjectError('Cannot find replica at %s for %s' % (site.name, self.full_name()))
+
+        return replica
 
     def _dataset_name(self):
         if type(self._dataset) is str:
@@ -228,7 +242,7 @@ class Block(object):
             return self._dataset.name
 
     def _check_and_load_files(self, cache = True):
-        if type(self._files) is set:
+        if type(self._files) is KeyedSet or type(self._files) is set:
             return self._files
 
         if not Block.inventory_store.server_side:
@@ -247,7 +261,7 @@ class Block(object):
                         self._files = None
     
                 if self._files is None:
-                    files = frozenset(self._load_files())
+                    files = KeyedFrozenSet(_file_key, self._load_files())
                     
                     if Block.inventory_store.server_side:
                         # In server side inventory, we don't keep the files in memory
@@ -266,7 +280,7 @@ class Block(object):
 
                 if type(self._files) is weakref.ProxyType:
                     try:
-                        self._files = set(self._files)
+                        self._files = KeyedSet(_file_key, self._files)
                     except ReferenceError:
                         # expired proxy
                         self._files = None
@@ -277,7 +291,7 @@ class Block(object):
                         pass
 
                 if self._files is None:
-                    self._files = self._load_files()
+                    self._files = KeyedSet(_file_key, self._load_files())
 
         finally:
             if not Block.inventory_store.server_side:
@@ -307,7 +321,26 @@ class Block(object):
             # updating file parameters -> need to load files permanently
             self._check_and_load_files(cache = False)
 
+        self._update_totals(other._size - self._size, other._num_files - self._num_files)
+
         self._size = other._size
         self._num_files = other._num_files
 
+    def _update_totals(self, size_diff, num_files_diff):
+        """
+        Propagate a change of the block size or number of files to the totals kept by the dataset and
+        the dataset replicas.
+        """
+
+        if type(self._dataset) is not str and self in self._dataset.blocks:
+            self._dataset.blocks.size += size_diff
+            self._dataset.blocks.num_files += num_files_diff
+
+        if size_diff != 0:
+            for replica in self.replicas:
+                dataset_replica = replica._linked_dataset_replica()
+                if dataset_replica is not None:
+                    dataset_replica.block_replicas.logical_size += size_diff
+                    dataset_replica._touch_partitions()
+
 customize_block(Block)
@@ -1,14 +1,26 @@
 import time
+import array
+import bisect
 
 from exceptions import ObjectError
 from block import Block
 from _namespace import customize_blockreplica
 
+def _pack_file_ids(file_ids):
+    """
+    Store file ids as a sorted array of unsigned longs (much smaller than a tuple of long objects). Falls back
+    to a tuple if some of the files are identified by LFNs (not registered yet).
+    """
+    try:
+        return array.array('L', sorted(file_ids))
+    except (TypeError, OverflowError):
+        return tuple(file_ids)
+
 class BlockReplica(object):
     """Block placement at a site. Holds an attribute 'group' which can be None.
     BlockReplica size can be different from that of the Block."""
 
-    __slots__ = ['_block', '_site', 'group', 'is_custodial', 'size', 'last_update', 'file_ids']
+    __slots__ = ['_block', '_site', 'group', 'is_custodial', '_size', 'last_update', '_file_ids']
 
     _use_file_ids = True
 
@@ -20,6 +32,31 @@ class BlockReplica(object):
     def site(self):
         return self._site
 
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, value):
+        if value != self._size:
+            dataset_replica = self._linked_dataset_replica()
+            if dataset_replica is not None:
+                dataset_replica.block_replicas.physical_size += value - self._size
+                dataset_replica._touch_partitions()
+
+            self._size = value
+
+    @property
+    def file_ids(self):
+        return self._file_ids
+
+    @file_ids.setter
+    def file_ids(self, value):
+        if value is None or type(value) is int or type(value) is long:
+            self._file_ids = value
+        else:
+            self._file_ids = _pack_file_ids(value)
+
     @property
     def num_files(self):
         if self.file_ids is None:
@@ -29,8 +66,9 @@ class BlockReplica(object):
 
     def __init__(self, block, site, group, is_custodial = False, size = -1, last_update = 0, file_ids = None):
         # User of the object is responsible for making sure size and file_ids are consistent
-        # if _use_file_ids is True, file_ids should be a tuple of (long) integers or LFN strings,
-        #   latter in case where the file is not yet registered with the inventory
+        # if _use_file_ids is True, file_ids should be a sequence of (long) integers or LFN strings,
+        #   latter in case where the file is not yet registered with the inventory. Integer ids are stored
+        #   in a sorted array (see _pack_file_ids).
         # if _use_file_ids is False, file_ids is the number of files this replica has.
 
         self._block = block
@@ -42,23 +80,23 @@ class BlockReplica(object):
         # Override file_ids depending on the given size:
         # If size < 0, this replica is considered full. If type(block) is Block, set the size and file_ids
         #  from the block. If not, this is a transient object - just set the size to -1.
-        # If size == 0 and file_ids is None, self.file_ids becomes an empty tuple.
+        # If size == 0 and file_ids is None, self.file_ids becomes empty.
         #  size == 0 and file_ids = finite tuple is allowed. It is the object creator's responsibility to
         #  ensure that the files in the provided list are all 0-size.
 
         if size < 0:
             if type(block) is Block:
-                self.size = block.size
+                self._size = block.size
                 if BlockReplica._use_file_ids:
                     self.file_ids = None
                 else:
                     self.file_ids = block.num_files
             else:
-                self.size = -1
+                self._size = -1
                 self.file_ids = None
 
         elif size == 0 and file_ids is None:
-            self.size = 0
+            self._size = 0
             if BlockReplica._use_file_ids:
                 self.file_ids = tuple()
             else:
@@ -69,7 +107,7 @@ class BlockReplica(object):
                 raise ObjectError('Cannot initialize a BlockReplica with finite size and file_ids = None without a valid block')
 
             if size == block.size:
-                self.size = size
+                self._size = size
                 if BlockReplica._use_file_ids:
                     self.file_ids = None
                 else:
@@ -78,7 +116,7 @@ class BlockReplica(object):
                 raise ObjectError('BlockReplica file_ids cannot be None when size is finite and not the full block size')
 
         else:
-            self.size = size
+            self._size = size
 
             if BlockReplica._use_file_ids:
                 # some iterable
@@ -108,6 +146,8 @@ class BlockReplica(object):
         else:
             size = self.size
             file_ids = self.file_ids
+            if type(file_ids) is array.array:
+                file_ids = tuple(file_ids)
 
         return 'BlockReplica(%s,%s,%s,%s,%d,%d,%s)' % \
             (repr(self._block_full_name()), repr(self._site_name()), repr(self._group_name()), \
@@ -232,6 +272,17 @@ class BlockReplica(object):
         self._block.replicas.remove(self)
 
     def write_into(self, store):
+        self.check_file_ids()
+
+        store.save_blockreplica(self)
+
+    def delete_from(self, store):
+        store.delete_blockreplica(self)
+
+    def check_file_ids(self):
+        """
+        Raise ObjectError if any of the file ids is not an integer (file not saved to the store yet).
+        """
         if BlockReplica._use_file_ids and self.file_ids is not None:
             for fid in self.file_ids:
                 try:
@@ -240,11 +291,6 @@ class BlockReplica(object):
                     # was some string
                     raise ObjectError('Cannot write %s into store because one of the files %s %s is not known yet' % (str(self), fid, type(fid).__name__))
 
-        store.save_blockreplica(self)
-
-    def delete_from(self, store):
-        store.delete_blockreplica(self)
-
     def is_complete(self):
         size_match = (self.size == self._block.size)
         if BlockReplica._use_file_ids:
@@ -292,7 +338,7 @@ class BlockReplica(object):
             return False
 
         else:
-            return lfile.id in self.file_ids
+            return self._has_file_id(lfile.id)
 
     def add_file(self, lfile):
         if lfile.block != self.block:
@@ -352,7 +398,7 @@ class BlockReplica(object):
                 else:                    
                     file_ids = [(f.id if f.id != 0 else f.lfn) for f in self.block.files]
 
-            elif identifier not in self.file_ids:
+            elif not self._has_file_id(identifier):
                 return False
 
             else:
@@ -368,6 +414,32 @@ class BlockReplica(object):
 
         return True
 
+    def _has_file_id(self, fid):
+        file_ids = self._file_ids
+        if type(file_ids) is array.array:
+            if type(fid) is str:
+                return False
+
+            # sorted array
+            idx = bisect.bisect_left(file_ids, fid)
+            return idx != len(file_ids) and file_ids[idx] == fid
+        else:
+            return fid in file_ids
+
+    def _linked_dataset_replica(self):
+        """
+        Return the dataset replica registered at the site that contains this block replica, or None.
+        """
+
+        if type(self._site) is str or type(self._block) is str:
+            return None
+
+        dataset_replica = self._site._dataset_replicas.get(self._block._dataset)
+        if dataset_replica is None or self not in dataset_replica.block_replicas:
+            return None
+
+        return dataset_replica
+
     def _block_full_name(self):
         if type(self._block) is str:
             return self._block
@@ -3,8 +3,78 @@ import copy
 import threading
 
 from exceptions import ObjectError
+from _keyedset import KeyedSet
 from _namespace import customize_dataset
 
+# Index keys of Dataset.blocks and Dataset.replicas
+def _block_key(block):
+    return block._name
+
+def _replica_key(replica):
+    return replica._site_name()
+
+class _BlockSet(KeyedSet):
+    """
+    Dataset.blocks. Keeps the total size and number of files of the blocks; Block updates the totals when its
+    size or num_files changes.
+    """
+
+    __slots__ = ['_size', '_num_files']
+
+    @property
+    def size(self):
+        self._check_index()
+        return self._size
+
+    @size.setter
+    def size(self, value):
+        self._check_index()
+        self._size = value
+
+    @property
+    def num_files(self):
+        self._check_index()
+        return self._num_files
+
+    @num_files.setter
+    def num_files(self, value):
+        self._check_index()
+        self._num_files = value
+
+    def __init__(self, iterable = ()):
+        self._size = 0
+        self._num_files = 0
+        KeyedSet.__init__(self, _block_key, iterable)
+
+    def add(self, block):
+        self._check_index()
+        if block not in self:
+            self._size += block._size
+            self._num_files += block._num_files
+
+        KeyedSet.add(self, block)
+
+    def remove(self, block):
+        KeyedSet.remove(self, block)
+        self._size -= block._size
+        self._num_files -= block._num_files
+
+    def pop(self):
+        block = KeyedSet.pop(self)
+        self._size -= block._size
+        self._num_files -= block._num_files
+        return block
+
+    def clear(self):
+        KeyedSet.clear(self)
+        self._size = 0
+        self._num_files = 0
+
+    def _reindex(self):
+        KeyedSet._reindex(self)
+        self._size = sum(b._size for b in self)
+        self._num_files = sum(b._num_files for b in self)
+
 class Dataset(object):
     """Represents a dataset."""
 
@@ -65,11 +135,11 @@ class Dataset(object):
 
     @property
     def size(self):
-        return sum(b.size for b in self.blocks)
+        return self.blocks.size
 
     @property
     def num_files(self):
-        return sum(b.num_files for b in self.blocks)
+        return self.blocks.num_files
 
     @property
     def files(self):
@@ -109,8 +179,9 @@ class Dataset(object):
 
         self.id = did
 
-        self.blocks = set()
-        self.replicas = set()
+        # sets indexed by block name and site name
+        self.blocks = _BlockSet()
+        self.replicas = KeyedSet(_replica_key)
 
         # "transient" members - excluded in __getstate__
         self.attr = {} # freeform key-value pairs
@@ -201,13 +272,11 @@ class Dataset(object):
         store.delete_dataset(self)
 
     def find_block(self, block_name, must_find = False):
-        try:
-            return next(b for b in self.blocks if b.name == block_name)
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Could not find block %s in %s', block_name, self._name)
-            else:
-                return None
+        block = self.blocks.get(block_name)
+        if block is None and must_find:
+            raise ObjectError('Could not find block %s in %s', block_name, self._name)
+
+        return block
 
     def find_file(self, path, must_find = False):
         for block in self.blocks:
@@ -221,16 +290,16 @@ class Dataset(object):
             return None
 
     def find_replica(self, site, must_find = False):
-        try:
-            if type(site) is str:
-                return next(r for r in self.replicas if r.site.name == site)
-            else:
-                return next(r for r in self.replicas if r.site == site)
+        if type(site) is str:
+            replica = self.replicas.get(site)
+        else:
+            replica = self.replicas.get(site.name)
+            if replica is not None and replica.site != site:
+                replica = None
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Could not find replica on %s of %s', str(site), self._name)
-            else:
-                return None
+        if replica is None and must_find:
+            raise ObjectError('Could not find replica on %s of %s', str(site), self._name)
+
+        return replica
 
 customize_dataset(Dataset)
@@ -1,5 +1,103 @@
 from exceptions import ObjectError
 from group import Group
+from _keyedset import KeyedSet
+
+# Index key of DatasetReplica.block_replicas
+def _block_replica_key(block_replica):
+    return block_replica._block_name()
+
+def _logical_size(block_replica):
+    if type(block_replica._block) is str:
+        return 0
+    else:
+        return block_replica._block._size
+
+class _BlockReplicaSet(KeyedSet):
+    """
+    DatasetReplica.block_replicas. Keeps the total physical and logical sizes of the block replicas; BlockReplica
+    and Block update the totals when their sizes change. Changes are propagated only while the dataset replica
+    is registered at its site, so the totals are recounted when the replica is added to the site.
+    """
+
+    __slots__ = ['_physical_size', '_logical_size']
+
+    @property
+    def physical_size(self):
+        self._check_index()
+        return self._physical_size
+
+    @physical_size.setter
+    def physical_size(self, value):
+        self._check_index()
+        self._physical_size = value
+
+    @property
+    def logical_size(self):
+        self._check_index()
+        return self._logical_size
+
+    @logical_size.setter
+    def logical_size(self, value):
+        self._check_index()
+        self._logical_size = value
+
+    def __init__(self, iterable = ()):
+        self._physical_size = 0
+        self._logical_size = 0
+        KeyedSet.__init__(self, _block_replica_key, iterable)
+
+    def add(self, block_replica):
+        self._check_index()
+        if block_replica in self:
+            return
+
+        KeyedSet.add(self, block_replica)
+        self._physical_size += block_replica._size
+        self._logical_size += _logical_size(block_replica)
+        self._touch(block_replica)
+
+    def remove(self, block_replica):
+        KeyedSet.remove(self, block_replica)
+        self._physical_size -= block_replica._size
+        self._logical_size -= _logical_size(block_replica)
+        self._touch(block_replica)
+
+    def pop(self):
+        block_replica = KeyedSet.pop(self)
+        self._physical_size -= block_replica._size
+        self._logical_size -= _logical_size(block_replica)
+        self._touch(block_replica)
+        return block_replica
+
+    def clear(self):
+        block_replica = next(iter(self), None)
+        KeyedSet.clear(self)
+        self._physical_size = 0
+        self._logical_size = 0
+        if block_replica is not None:
+            self._touch(block_replica)
+
+    def _reindex(self):
+        KeyedSet._reindex(self)
+        self._recount()
+
+        block_replica = next(iter(self), None)
+        if block_replica is not None:
+            self._touch(block_replica)
+
+    def _recount(self):
+        self._physical_size = sum(br._size for br in self)
+        self._logical_size = sum(_logical_size(br) for br in self)
+
+    def _touch(self, block_replica):
+        # block_replica is used to find the owning dataset replica
+        site = block_replica._site
+        if type(site) is str or type(block_replica._block) is str:
+            return
+
+        dataset_replica = site._dataset_replicas.get(block_replica._block._dataset)
+        if dataset_replica is not None and dataset_replica.block_replicas is self:
+            dataset_replica._touch_partitions()
 
 class DatasetReplica(object):
     """Represents a dataset replica. Just a container for block replicas."""
@@ -24,7 +122,8 @@ class DatasetReplica(object):
         else:
             self.group = group
 
-        self.block_replicas = set()
+        # set indexed by block name
+        self.block_replicas = _BlockReplicaSet()
 
     def __str__(self):
         if self.growing:
@@ -166,23 +265,37 @@ class DatasetReplica(object):
             return max(br.last_update for br in self.block_replicas)
 
     def size(self, physical = True):
+        if type(self._site) is not str and self._site._dataset_replicas.get(self._dataset) is self:
+            # totals are kept up to date
+            if physical:
+                return self.block_replicas.physical_size
+            else:
+                return self.block_replicas.logical_size
+
         if physical:
             return sum(r.size for r in self.block_replicas)
         else:
             return sum(r.block.size for r in self.block_replicas)
 
     def find_block_replica(self, block, must_find = False):
-        try:
-            if type(block).__name__ == 'Block':
-                return next(b for b in self.block_replicas if b.block == block)
-            else:
-                return next(b for b in self.block_replicas if b.block.name == block)
+        if type(block).__name__ == 'Block':
+            block_replica = self.block_replicas.get(block.name)
+            if block_replica is not None and block_replica.block != block:
+                block_replica = None
+        else:
+            block_replica = self.block_replicas.get(block)
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Cannot find block replica %s/%s', self._site.name, block.full_name())
-            else:
-                return None
+        if block_replica is None and must_find:
+            raise ObjectError('Cannot find block replica %s/%s', self._site.name, block.full_name())
+
+        return block_replica
+
+    def _touch_partitions(self):
+        """
+        Tell the site partitions that the content or the size of this replica changed.
+        """
+        for site_partition in self._site.partitions.itervalues():
+            site_partition.replicas.touch(self)
 
     def _dataset_name(self):
         if type(self._dataset) is str:
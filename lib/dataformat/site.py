@@ -220,6 +220,9 @@ class Site(object):
 
     def add_dataset_replica(self, replica, add_block_replicas = True):
         self._dataset_replicas[replica.dataset] = replica
+        # block replica sizes are tracked only while the replica is registered
+        replica.block_replicas._recount()
+        replica._touch_partitions()
 
         if add_block_replicas:
             for partition, site_partition in self.partitions.iteritems():
@@ -2,6 +2,106 @@ import sys
 
 from exceptions import ObjectError, IntegrityError
 
+class _ReplicaMap(dict):
+    """
+    SitePartition.replicas. Keeps the total physical and logical sizes of the replicas in the partition.
+    Each dataset replica contributes with the sizes computed at the last evaluation; an entry is re-evaluated
+    when it is set or touched (DatasetReplica calls touch when its block replicas or their sizes change).
+    Block replica sets stored as values can be modified in place as long as the entry is touched or set again.
+    """
+
+    __slots__ = ['_sizes', '_dirty', '_physical_size', '_logical_size']
+
+    def __init__(self, *args, **kwd):
+        dict.__init__(self)
+        # {dataset_replica: (physical, logical)} for replicas counted in the totals
+        self._sizes = {}
+        # replicas to be re-evaluated
+        self._dirty = set()
+        self._physical_size = 0
+        self._logical_size = 0
+
+        self.update(*args, **kwd)
+
+    def __reduce__(self):
+        return (_ReplicaMap, (), None, None, self.iteritems())
+
+    def __setitem__(self, replica, block_replicas):
+        dict.__setitem__(self, replica, block_replicas)
+        self._dirty.add(replica)
+
+    def __delitem__(self, replica):
+        dict.__delitem__(self, replica)
+        self._forget(replica)
+
+    def pop(self, replica, *args):
+        block_replicas = dict.pop(self, replica, *args)
+        self._forget(replica)
+        return block_replicas
+
+    def popitem(self):
+        replica, block_replicas = dict.popitem(self)
+        self._forget(replica)
+        return replica, block_replicas
+
+    def clear(self):
+        dict.clear(self)
+        self._sizes.clear()
+        self._dirty.clear()
+        self._physical_size = 0
+        self._logical_size = 0
+
+    def update(self, *args, **kwd):
+        for replica, block_replicas in dict(*args, **kwd).iteritems():
+            self[replica] = block_replicas
+
+    def setdefault(self, replica, block_replicas = None):
+        if replica not in self:
+            self[replica] = block_replicas
+
+        return dict.__getitem__(self, replica)
+
+    def touch(self, replica):
+        if replica in self:
+            self._dirty.add(replica)
+
+    def total_size(self, physical = True):
+        if len(self._dirty) != 0:
+            for replica in self._dirty:
+                self._forget_size(replica)
+
+                block_replicas = dict.__getitem__(self, replica)
+                if block_replicas is None:
+                    physical_size = replica.size(physical = True)
+                    logical_size = replica.size(physical = False)
+                else:
+                    physical_size = sum(br.size for br in block_replicas)
+                    logical_size = sum(br.block.size for br in block_replicas)
+
+                self._sizes[replica] = (physical_size, logical_size)
+                self._physical_size += physical_size
+                self._logical_size += logical_size
+
+            self._dirty.clear()
+
+        if physical:
+            return self._physical_size
+        else:
+            return self._logical_size
+
+    def _forget(self, replica):
+        self._dirty.discard(replica)
+        self._forget_size(replica)
+
+    def _forget_size(self, replica):
+        try:
+            physical_size, logical_size = self._sizes.pop(replica)
+        except KeyError:
+            return
+
+        self._physical_size -= physical_size
+        self._logical_size -= logical_size
+
 class SitePartition(object):
     """State of a partition at a site."""
 
@@ -37,7 +137,7 @@ class SitePartition(object):
         # partition quota in bytes
         self._quota = quota
         # {dataset_replica: set(block_replicas) or None (if all blocks are in)}
-        self.replicas = {}
+        self.replicas = _ReplicaMap()
 
     def __str__(self):
         if type(self._partition) is str:
@@ -129,16 +229,7 @@ class SitePartition(object):
         elif quota < 0:
             return 0.
         else:
-            total_size = 0.
-            for replica, block_replicas in self.replicas.iteritems():
-                if block_replicas is None:
-                    total_size += replica.size(physical = physical)
-                elif physical:
-                    total_size += sum(br.size for br in block_replicas)
-                else:
-                    total_size += sum(br.block.size for br in block_replicas)
-
-            return total_size / quota
+            return float(self.replicas.total_size(physical = physical)) / quota
 
     def embed_tree(self, inventory):
         if self._partition._subpartitions is not None:
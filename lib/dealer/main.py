@@ -1,4 +1,5 @@
 import time
+import bisect
 import datetime
 import collections
 import fnmatch
@@ -9,6 +10,7 @@ from dynamo.dataformat import Dataset, DatasetReplica, BlockReplica
 from dynamo.dataformat.history import CopiedReplica, HistoryRecord
 from dynamo.dealer.dealerpolicy import DealerPolicy
 from dynamo.dealer.history import DealerHistory
+from dynamo.detox.history import DetoxHistoryBase, DecisionCache
 from dynamo.operation.copy import CopyInterface
 from dynamo.utils.signaling import SignalBlocker
 import dynamo.dealer.plugins as dealer_plugins
@@ -82,7 +84,12 @@ class Dealer(object):
         # to keep things simpler. If a plugin proposes a copy to a non-target site, the proposal is
         # ignored.
         # requests is [(DealerRequest, plugin)]
-        requests = self._collect_requests(inventory)
+        # Detox decisions read by the plugins are shared among them during the collection
+        DetoxHistoryBase.decision_cache = DecisionCache()
+        try:
+            requests = self._collect_requests(inventory)
+        finally:
+            DetoxHistoryBase.decision_cache = None
 
         LOG.info('Determining the list of transfers to make.')
         # copy_list is {plugin: [new dataset replica]}
@@ -166,7 +173,7 @@ class Dealer(object):
         # Default group for newly created replicas
         default_group = inventory.groups[self.policy.group_name]
 
-        reqlists = {} # {plugin: reqlist} reqlist is [(item, destination)]
+        reqlists = {} # {plugin: reqlist} reqlist is deque([DealerRequest])
 
         for plugin, priority in self._plugin_priorities.items():
             if priority == 0:
@@ -179,7 +186,7 @@ class Dealer(object):
             LOG.debug('%s requesting %d items', plugin.name, len(plugin_requests))
 
             if len(plugin_requests) != 0:
-                reqlists[plugin] = plugin_requests
+                reqlists[plugin] = collections.deque(plugin_requests)
 
         # Flattened list of (DealerRequest, plugin)
         requests = []
@@ -190,26 +197,43 @@ class Dealer(object):
             'Dataset is not valid': 0
         }
 
-        while len(reqlists) != 0:
-            # Classic weighted random-picking algorithm
-            plugins = reqlists.keys()
+        # Classic weighted random-picking algorithm
+        # Cumulative weights of the plugins with remaining requests; recomputed only when a plugin runs out
+        plugins = []
+        sums = []
+
+        def update_weights():
+            del plugins[:]
+            del sums[:]
+
+            total = 0.
+            for plugin in reqlists.iterkeys():
+                priority = self._plugin_priorities[plugin]
+                if priority == 0:
+                    priority = 1
 
-            pvalues = [1. / self._plugin_priorities[p] for p in plugins]
-            sums = [sum(pvalues[:i + 1]) for i in range(len(pvalues))]
+                total += 1. / priority
+                plugins.append(plugin)
+                sums.append(total)
 
+        update_weights()
+
+        while len(reqlists) != 0:
             # Select k if sum(w_{i})_{i <= k-1} w_{k} < x < sum(w_{i})_{i <= k} for x in Uniform(0, sum(w_{i}))
             x = random.uniform(0., sums[-1])
 
-            # Index of the selected plugin
-            ip = next(k for k in range(len(sums)) if x < sums[k])
+            # Index of the selected plugin (x can be equal to the total sum)
+            ip = min(bisect.bisect_right(sums, x), len(sums) - 1)
             plugin = plugins[ip]
 
             reqlist = reqlists[plugin]
-            request = reqlist.pop(0)
+            request = reqlist.popleft()
 
             if len(reqlist) == 0:
                 LOG.debug('No more requests from %s', plugin.name)
                 reqlists.pop(plugin)
+                if len(reqlists) != 0:
+                    update_weights()
 
             # check that there is at least one source (allow it to be incomplete - could be in production)
             no_source = False
@@ -32,7 +32,7 @@ class BalancingHandler(BaseHandler):
         for reason in self.target_reasons.keys():
             LOG.debug(reason)
 
-        deletion_decisions = self.detoxhistory.get_deletion_decisions(latest_cycle, size_only = False)
+        deletion_decisions = self.detoxhistory.get_site_decisions(latest_cycle)
 
         partition = inventory.partitions[policy.partition_name]
 
@@ -55,7 +55,7 @@ class BalancingHandler(BaseHandler):
             except KeyError:
                 continue
 
-            protections = [(ds_name, size, reason) for ds_name, size, decision, _, reason in decisions if decision == 'protect']
+            protections = [(ds_name, size, reason) for ds_name, size, _, _, reason in decisions.select('protect')]
             protected_fraction = float(sum(size for _, size, _ in protections)) / quota
 
             LOG.debug('Site %s protected fraction %f', site.name, protected_fraction)
@@ -24,7 +24,7 @@ class Undertaker(BaseHandler):
         if len(self.manual_evacuation_sites) != 0:
             LOG.info('Additionally evacuating %s as requested by configuration', ' '.join(self.manual_evacuation_sites))
 
-        deletion_decisions = self.detoxhistory.get_deletion_decisions(latest_cycle, size_only = False)
+        deletion_decisions = self.detoxhistory.get_site_decisions(latest_cycle)
 
         protected_fractions = {} # {site: fraction}
         last_copies = {} # {site: [datasets]}
@@ -42,10 +42,7 @@ class Undertaker(BaseHandler):
             except KeyError:
                 continue
 
-            for ds_name, size, decision, _, _ in decisions:
-                if decision != 'protect':
-                    continue
-
+            for ds_name, size, decision, _, _ in decisions.select('protect'):
                 try:
                     dataset = inventory.datasets[ds_name]
                 except KeyError:
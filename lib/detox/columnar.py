@@ -0,0 +1,255 @@
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from dynamo.policy.attrs import DatasetAttr, BlockReplicaAttr, ReplicaSiteAttr
+from dynamo.policy.predicates import Lt, Gt
+from dynamo.detox.detoxpolicy import DatasetAction, BlockAction
+
+LOG = logging.getLogger(__name__)
+
+class ColumnarEvaluator(object):
+    """
+    Vectorized evaluation of the policy lines over a set of dataset replicas. The replicas and their block replicas
+    are flattened into tables, the values of each policy variable are extracted into a column (per dataset or site
+    where the variable allows it), and every predicate and every line is evaluated as a boolean mask over the table
+    rows. Values are extracted only for the rows still matched by the preceding predicates of the line, so that
+    expensive variables are not computed for the whole partition. The masks are then resolved into the same lists
+    of actions DetoxPolicy.evaluate returns.
+
+    The values are extracted from the current state of the replicas. The results must therefore be discarded for
+    replicas whose evaluation depends on a part of the image that changed after the call to evaluate.
+    A replica for which a block-level line takes out a part of its blocks is not resolved, because the values of
+    the following lines depend on the remaining blocks; such replicas must be evaluated with DetoxPolicy.evaluate.
+    """
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def __init__(self, policy):
+        if np is None:
+            raise RuntimeError('ColumnarEvaluator requires numpy.')
+
+        self.policy = policy
+
+    def evaluate(self, replicas):
+        """
+        @param replicas  Iterable of dataset replicas.
+        @return {replica: actions} for the resolved replicas. Lines are not flagged as matched (has_match);
+                it is up to the caller when the result is used.
+        """
+
+        dataset_replicas = list(replicas)
+        table = _ReplicaTable(dataset_replicas)
+
+        lines = self.policy.policy_lines
+
+        # dataset replica and block replica masks of each line
+        dr_masks = []
+        br_masks = []
+
+        # dataset replicas not decided by the preceding lines
+        open_mask = np.ones(len(table.dataset_replicas), dtype = bool)
+        num_block_replicas = np.diff(table.offsets)
+
+        for line in lines:
+            dr_mask = open_mask.copy()
+            br_mask = np.ones(len(table.block_replicas), dtype = bool)
+
+            for predicate in line.condition.predicates:
+                if isinstance(predicate.variable, BlockReplicaAttr):
+                    mask = table.block_replica_mask(predicate, dr_mask)
+                    # block-level predicate over a dataset replica is an OR over the block replicas
+                    dr_mask &= table.any_block_replica(mask)
+                    br_mask &= mask
+                else:
+                    mask = table.dataset_replica_mask(predicate, dr_mask)
+                    dr_mask &= mask
+                    # a block replica sees the values of its dataset replica
+                    br_mask &= mask[table.br_owner]
+
+            if issubclass(line.decision.action_cls, BlockAction):
+                br_mask &= dr_mask[table.br_owner]
+                # a dataset replica is decided if all or a part of its block replicas match (see below)
+                num_matching = np.bincount(table.br_owner, weights = br_mask, minlength = len(table.dataset_replicas))
+                open_mask &= ~(dr_mask & ((num_matching != 0) | (num_block_replicas == 0)))
+            else:
+                open_mask &= ~dr_mask
+
+            dr_masks.append(dr_mask.tolist())
+            br_masks.append(br_mask.tolist())
+
+        results = {}
+
+        for irep, replica in enumerate(dataset_replicas):
+            rows = table.rows_of(irep)
+
+            actions = []
+
+            for iline, line in enumerate(lines):
+                if not dr_masks[iline][irep]:
+                    continue
+
+                if issubclass(line.decision.action_cls, BlockAction):
+                    br_mask = br_masks[iline]
+                    matching_block_replicas = [table.block_replicas[row] for row in rows if br_mask[row]]
+
+                    if len(matching_block_replicas) == len(rows):
+                        action = line.decision.action_cls.dataset_level(line)
+                    else:
+                        action = line.decision.action(line, matching_block_replicas)
+                else:
+                    action = line.decision.action(line)
+
+                actions.append(action)
+                if isinstance(action, DatasetAction):
+                    break
+
+                if len(action.block_replicas) != 0:
+                    # the following lines see the replica without these block replicas
+                    actions = None
+                    break
+
+            else:
+                actions.append(self.policy.default_decision.action(None))
+
+            if actions is not None:
+                results[replica] = actions
+
+        LOG.debug('Columnar evaluation resolved %d out of %d replicas.', len(results), len(dataset_replicas))
+
+        return results
+
+
+class _ReplicaTable(object):
+    """
+    Dataset replicas and their block replicas flattened into rows, with columns of variable values.
+    """
+
+    def __init__(self, dataset_replicas):
+        self.dataset_replicas = dataset_replicas
+        self.block_replicas = []
+
+        # dataset replica row -> first block replica row; block replicas of a dataset replica are contiguous
+        offsets = [0]
+        # block replica row -> dataset replica row
+        br_owner = []
+
+        # group indices of the dataset replicas
+        datasets = {}
+        sites = {}
+        dr_dataset = []
+        dr_site = []
+
+        for irep, replica in enumerate(dataset_replicas):
+            self.block_replicas.extend(replica.block_replicas)
+            br_owner.extend([irep] * len(replica.block_replicas))
+            offsets.append(len(self.block_replicas))
+
+            dr_dataset.append(datasets.setdefault(replica.dataset, len(datasets)))
+            dr_site.append(sites.setdefault(replica.site, len(sites)))
+
+        self.offsets = offsets
+        self.br_owner = np.array(br_owner, dtype = np.intp)
+
+        # group index -> representative dataset replica
+        self.groups = {
+            DatasetAttr: (np.array(dr_dataset, dtype = np.intp), _representatives(dataset_replicas, dr_dataset, len(datasets))),
+            ReplicaSiteAttr: (np.array(dr_site, dtype = np.intp), _representatives(dataset_replicas, dr_site, len(sites)))
+        }
+
+        self._columns = {} # {variable: [value]}
+
+    def rows_of(self, irep):
+        return xrange(self.offsets[irep], self.offsets[irep + 1])
+
+    def any_block_replica(self, br_mask):
+        """
+        OR of the block replica mask over the block replicas of each dataset replica.
+        """
+        counts = np.bincount(self.br_owner, weights = br_mask, minlength = len(self.dataset_replicas))
+        return counts > 0.
+
+    def block_replica_mask(self, predicate, dr_mask):
+        """
+        Mask of the predicate over the block replicas of the dataset replicas selected by dr_mask.
+        """
+        rows = np.flatnonzero(dr_mask[self.br_owner])
+        return self._mask(predicate, self.block_replicas, rows)
+
+    def dataset_replica_mask(self, predicate, dr_mask):
+        """
+        Mask of the predicate over the dataset replicas selected by dr_mask.
+        """
+        variable = predicate.variable
+
+        for attr_cls, (index, representatives) in self.groups.iteritems():
+            if isinstance(variable, attr_cls):
+                # the value is common to all dataset replicas in the group - evaluate once per group
+                groups = np.unique(index[dr_mask])
+                return self._mask(predicate, representatives, groups)[index]
+
+        rows = np.flatnonzero(dr_mask)
+        return self._mask(predicate, self.dataset_replicas, rows)
+
+    def _mask(self, predicate, objects, rows):
+        variable = predicate.variable
+
+        try:
+            column = self._columns[variable]
+        except KeyError:
+            column = self._columns[variable] = [_MISSING] * len(objects)
+
+        values = []
+        for row in rows.tolist():
+            value = column[row]
+            if value is _MISSING:
+                value = column[row] = variable.get(objects[row])
+
+            values.append(value)
+
+        mask = np.zeros(len(objects), dtype = bool)
+        mask[rows] = _evaluate(predicate, values)
+        return mask
+
+
+_MISSING = object()
+
+def _representatives(dataset_replicas, group_index, num_groups):
+    representatives = [None] * num_groups
+    for replica, igroup in zip(dataset_replicas, group_index):
+        if representatives[igroup] is None:
+            representatives[igroup] = replica
+
+    return representatives
+
+def _evaluate(predicate, values):
+    """
+    Evaluate the predicate over a column of values. Equivalent to [predicate.match_value(v) for v in values].
+    """
+
+    if type(predicate) is Lt or type(predicate) is Gt:
+        column = np.array(values)
+        if column.ndim == 1 and column.dtype.kind in 'biuf':
+            if type(predicate) is Lt:
+                return column < predicate.rhs
+            else:
+                return column > predicate.rhs
+
+    # evaluate the predicate once for each distinct value
+    codes = {}
+    try:
+        index = np.fromiter((codes.setdefault(v, len(codes)) for v in values), dtype = np.intp, count = len(values))
+    except TypeError:
+        # unhashable values
+        return np.array([bool(predicate.match_value(v)) for v in values], dtype = bool)
+
+    table = np.zeros(len(codes), dtype = bool)
+    for value, code in codes.iteritems():
+        table[code] = bool(predicate.match_value(value))
+
+    return table[index]
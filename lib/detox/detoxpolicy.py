@@ -1,3 +1,4 @@
+import time
 import logging
 
 from dynamo.dataformat import ConfigurationError
@@ -71,17 +72,32 @@ class PolicyLine(object):
         self.decision = decision
         self.has_match = False
 
+        # Evaluation statistics (see reset_stats)
+        self.num_evaluated = 0
+        self.num_matched = 0
+        # time spent in condition.match and get_matching_blocks
+        self.evaluation_time = 0.
+
         # filled by history interface
         self.condition_id = 0
 
     def __str__(self):
         return self.condition.text
 
+    def reset_stats(self):
+        self.num_evaluated = 0
+        self.num_matched = 0
+        self.evaluation_time = 0.
+
     def evaluate(self, replica):
         action = None
 
+        self.num_evaluated += 1
+        start = time.time()
+
         if self.condition.match(replica):
             self.has_match = True
+            self.num_matched += 1
 
             if issubclass(self.decision.action_cls, BlockAction):
                 # block-level
@@ -94,6 +110,8 @@ class PolicyLine(object):
             else:
                 action = self.decision.action(self)
 
+        self.evaluation_time += time.time() - start
+
         return action
 
 
@@ -107,11 +125,22 @@ class DetoxPolicy(object):
         # Detox will finalize the delete and protect list in the first iteration.
         self.iterative_deletion = True
         
-        LOG.info('Reading the policy file.')
-        with open(config.policy_file) as policy_def:
-            self.policy_text = policy_def.read().strip()
+        if 'policy_text' in config:
+            self.policy_text = config.policy_text.strip()
+        else:
+            LOG.info('Reading the policy file.')
+            with open(config.policy_file) as policy_def:
+                self.policy_text = policy_def.read().strip()
 
         self.parse_lines(self.policy_text.split('\n'), config.attrs)
+
+        # AttrProfile set by set_attr_profile
+        self.attr_profile = None
+
+        # Reorder the predicates of the lines by their measured cost and rejection rate
+        if config.get('adaptive_predicate_order', False):
+            for line in self.policy_lines:
+                line.condition.set_adaptive(True, config.get('predicate_reorder_interval', 1000))
         
         # Special config - shift time-based policies by config.time_shift days for simulation
         if config.get('time_shift', 0.) > 0.:
@@ -120,6 +149,9 @@ class DetoxPolicy(object):
                     if type(pred) is predicates.BinaryExpr and pred.variable.vtype == attrs.Attr.TIME_TYPE:
                         pred.rhs += config.time_shift * 24. * 3600.
 
+                # rhs values are compiled in as constants
+                line.condition.compile()
+
         # Check if the replicas can be deleted just before making the deletion requests.
         # Set to a function that takes a list of dataset replicas and removes from it
         # the replicas that should not be deleted.
@@ -214,11 +246,44 @@ class DetoxPolicy(object):
 
         attr_names.update(self.candidate_sort_key.required_attrs)
 
+        # If any line looks at the other replicas of the dataset, a deletion can change the decision
+        # on all replicas of the dataset
+        self.reads_other_replicas = any(line.condition.reads_other_replicas for line in self.policy_lines)
+
         self.attr_producers = list(set(get_producers(attr_names, attrs_config).itervalues()))
 
         LOG.info('Policy stack for %s: %d lines using dataset attr producers [%s]', \
                  self.partition_name, len(self.policy_lines), ' '.join(type(p).__name__ for p in self.attr_producers))
 
+    def set_attr_profile(self, profile):
+        """
+        Recompile the line conditions to time the attribute fetches with the profile.
+        @param profile  AttrProfile or None
+        """
+
+        self.attr_profile = profile
+
+        for line in self.policy_lines:
+            line.condition.profile = profile
+            line.condition.compile()
+
+    def get_line_stats(self):
+        """
+        @return [(num_evaluated, num_matched, evaluation_time)] of the policy lines
+        """
+
+        return [(line.num_evaluated, line.num_matched, line.evaluation_time) for line in self.policy_lines]
+
+    def add_line_stats(self, stats):
+        """
+        Add statistics in the format of get_line_stats (e.g. from a worker process) to the lines.
+        """
+
+        for line, (num_evaluated, num_matched, evaluation_time) in zip(self.policy_lines, stats):
+            line.num_evaluated += num_evaluated
+            line.num_matched += num_matched
+            line.evaluation_time += evaluation_time
+
     def evaluate(self, replica):
         actions = []
         block_replicas_tmp = set()
@@ -239,10 +304,19 @@ class DetoxPolicy(object):
                     replica.block_replicas.remove(block_replica)
                     block_replicas_tmp.add(block_replica)
 
+                # memoized values of the dataset were computed with the block replicas in place
+                if attrs.Attr.cache is not None:
+                    attrs.Attr.cache.invalidate(replica.dataset)
+
         else:
             actions.append(self.default_decision.action(None))
 
         # return the block replicas
-        replica.block_replicas.update(block_replicas_tmp)
+        if len(block_replicas_tmp) != 0:
+            replica.block_replicas.update(block_replicas_tmp)
+
+            # values computed on the stripped replica must not be seen by the other replicas
+            if attrs.Attr.cache is not None:
+                attrs.Attr.cache.invalidate(replica.dataset)
         
         return actions
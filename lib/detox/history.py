@@ -1,9 +1,13 @@
 import os
 import re
+import time
 import sqlite3
 import lzma
 import hashlib
 import logging
+import array
+import itertools
+import collections
 
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.dataformat import Site
@@ -12,6 +16,121 @@ from dynamo.dataformat import Configuration
 
 LOG = logging.getLogger(__name__)
 
+# Number of rows per executemany when writing the snapshot SQLite files
+SNAPSHOT_INSERT_CHUNK = 10000
+# Number of differences whose dataset names are looked up at once in diff_cycles
+SNAPSHOT_DIFF_CHUNK = 10000
+# Number of bytes per call to the (de)compressor when archiving or extracting the snapshot files
+SNAPSHOT_COMPRESS_CHUNK = 1024 * 1024
+
+def _chunks(iterable, size):
+    """
+    Generate lists of up to size elements from an iterable.
+    """
+
+    itr = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(itr, size))
+        if len(chunk) == 0:
+            return
+
+        yield chunk
+
+def _transform_file(source, dest, transformer, flush):
+    """
+    Write source through the (de)compressor into dest chunk by chunk.
+    @param source       Input file object
+    @param dest         Output file object
+    @param transformer  compress or decompress method of an lzma (de)compressor object
+    @param flush        flush method of the compressor or None
+    """
+
+    while True:
+        data = source.read(SNAPSHOT_COMPRESS_CHUNK)
+        if not data:
+            break
+
+        dest.write(transformer(data))
+
+    if flush is not None:
+        dest.write(flush())
+
+class SiteDecisions(object):
+    """
+    Deletion decisions of a cycle at one site, in parallel arrays ordered by decreasing replica size. Dataset names
+    and condition texts are shared among the sites of the cycle.
+    """
+
+    __slots__ = ['dataset_ids', 'sizes', 'decision_ids', 'condition_ids', '_dataset_names', '_decisions', '_reasons']
+
+    def __init__(self, dataset_names, decisions, reasons):
+        """
+        @param dataset_names  {dataset_id: dataset name}
+        @param decisions      {decision_id: decision}
+        @param reasons        {condition_id: condition text}
+        """
+
+        self.dataset_ids = array.array('l')
+        self.sizes = array.array('l')
+        self.decision_ids = array.array('b')
+        self.condition_ids = array.array('l')
+
+        self._dataset_names = dataset_names
+        self._decisions = decisions
+        self._reasons = reasons
+
+    def __len__(self):
+        return len(self.dataset_ids)
+
+    def __iter__(self):
+        """
+        Iterate over (dataset_name, size, decision, condition_id, reason), same as the entries of
+        get_deletion_decisions(size_only = False).
+        """
+
+        for irow in xrange(len(self.dataset_ids)):
+            yield self._entry(irow)
+
+    def select(self, decision):
+        """
+        Iterate over the entries with the given decision.
+        """
+
+        decision_ids = [did for did, value in self._decisions.iteritems() if value == decision]
+        if len(decision_ids) == 0:
+            return
+
+        decision_id = decision_ids[0]
+
+        for irow, did in enumerate(self.decision_ids):
+            if did == decision_id:
+                yield self._entry(irow)
+
+    def _entry(self, irow):
+        condition_id = self.condition_ids[irow]
+        return (self._dataset_names[self.dataset_ids[irow]], self.sizes[irow], self._decisions[self.decision_ids[irow]], condition_id, self._reasons.get(condition_id))
+
+
+class DecisionCache(object):
+    """
+    Per-site decisions of detox cycles (see DetoxHistoryBase.get_site_decisions) keyed by history DB and cycle number.
+    """
+
+    def __init__(self):
+        self._cycles = {} # {(history_db, cycle_number): {site_name: SiteDecisions}}
+
+    def get(self, history, cycle_number):
+        key = (history.history_db, cycle_number)
+        try:
+            return self._cycles[key]
+        except KeyError:
+            decisions = self._cycles[key] = history._read_site_decisions(cycle_number)
+            return decisions
+
+    def clear(self):
+        self._cycles.clear()
+
+
 class DetoxHistoryBase(DeletionHistoryDatabase):
     """
     Parts of the DetoxHistory that can be used by the web detox monitor.
@@ -19,6 +138,10 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
 
     _config = Configuration()
 
+    # When set to a DecisionCache, get_site_decisions results are shared among all instances. The owner of the
+    # cache (e.g. Dealer during a cycle) is responsible for clearing it.
+    decision_cache = None
+
     @staticmethod
     def set_default(config):
         DetoxHistoryBase._config = Configuration(config)
@@ -35,6 +158,14 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         self.snapshots_spool_dir = config.snapshots_spool_dir
         self.snapshots_archive_dir = config.snapshots_archive_dir
 
+        # Open snapshot SQLite files {file name: ((inode, mtime), connection)}, least recently used first
+        self.max_open_snapshots = config.get('max_open_snapshots', 8)
+        self._snapshots = collections.OrderedDict()
+        # Archived snapshots extracted into the spool by this instance; deleted when they fall out of the LRU
+        self._extracted = set()
+        # Extracted snapshots older than this (in days) are deleted from the spool (see _clean_spool)
+        self.spool_retention = config.get('spool_retention', 7)
+
     def get_cycles(self, partition, first = -1, last = -1):
         """
         Get a list of deletion cycles in range first <= cycle <= last. If first == -1, pick only the latest before last.
@@ -78,22 +209,24 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         @return {site_name:  (id, status, quota)}
         """
 
-        self._fill_snapshot_cache('sites', cycle_number)
-
-        table_name = 'sites_%d' % cycle_number
+        snapshot_db = self._get_snapshot(cycle_number)
+        if snapshot_db is None:
+            return {}
 
-        sql = 'SELECT s.`name`, n.`status`, n.`quota` FROM `{0}`.`{1}` AS n'.format(self.cache_db, table_name)
-        sql += ' INNER JOIN `{0}`.`sites` AS s ON s.`id` = n.`site_id`'.format(self.history_db)
+        sql = 'SELECT s.`site_id`, t.`value`, s.`quota` FROM `sites` AS s'
+        sql += ' INNER JOIN `statuses` AS t ON t.`id` = s.`status_id`'
         if skip_unused:
-            self._fill_snapshot_cache('replicas', cycle_number)
+            sql += ' WHERE s.`site_id` IN (SELECT DISTINCT `site_id` FROM `replicas`)'
 
-            replica_table_name = 'replicas_%d' % cycle_number
-            sql += ' INNER JOIN (SELECT DISTINCT `site_id` FROM `{0}`.`{1}`) AS r ON r.`site_id` = s.`id`'.format(self.cache_db, replica_table_name)
+        site_names = self._get_site_names()
 
         sites_dict = {}
 
-        for site_name, status, quota in self.db.xquery(sql):
-            sites_dict[site_name] = (status, quota)
+        for site_id, status, quota in snapshot_db.execute(sql):
+            try:
+                sites_dict[site_names[site_id]] = (status, quota)
+            except KeyError:
+                pass
 
         return sites_dict
 
@@ -107,36 +240,38 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
                 If size_only = False: a massive dict {site: [(dataset, size, decision, reason)]}
         """
 
-        self._fill_snapshot_cache('replicas', cycle_number)
+        snapshot_db = self._get_snapshot(cycle_number)
+        if snapshot_db is None:
+            return {}
 
-        table_name = 'replicas_%d' % cycle_number
+        site_names = self._get_site_names()
 
         if size_only:
             # return {site_name: (protect_size, delete_size, keep_size)}
-            volumes = {}
-            sites = set()
-
-            query = 'SELECT s.`name`, SUM(r.`size`) * 1.e-12 FROM `{0}`.`{1}` AS r'.format(self.cache_db, table_name)
-            query += ' INNER JOIN `{0}`.`sites` AS s ON s.`id` = r.`site_id`'.format(self.history_db)
-            query += ' WHERE r.`decision` LIKE %s'
-            query += ' GROUP BY r.`site_id`'
-
             if type(decisions) is not list:
                 decisions = ['protect', 'delete', 'keep']
 
-            for decision in decisions:
-                volumes[decision] = dict(self.db.xquery(query, decision))
-                sites.update(set(volumes[decision].iterkeys()))
-               
+            query = 'SELECT r.`site_id`, d.`value`, SUM(r.`size`) * 1.e-12 FROM `replicas` AS r'
+            query += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
+            query += ' WHERE d.`value` IN (%s)' % ','.join('?' for _ in decisions)
+            query += ' GROUP BY r.`site_id`, r.`decision_id`'
+
             product = {}
-            for site_name in sites:
-                v = {}
-                for decision in ['protect', 'delete', 'keep']:
-                    try:
-                        v[decision] = volumes[decision][site_name]
-                    except:
-                        v[decision] = 0
 
+            for site_id, decision, volume in snapshot_db.execute(query, decisions):
+                try:
+                    site_name = site_names[site_id]
+                except KeyError:
+                    continue
+
+                try:
+                    v = product[site_name]
+                except KeyError:
+                    v = product[site_name] = {'protect': 0, 'delete': 0, 'keep': 0}
+
+                v[decision] = volume
+
+            for site_name, v in product.items():
                 product[site_name] = (v['protect'], v['delete'], v['keep'])
 
             return product
@@ -144,135 +279,362 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         else:
             # return {site_name: [(dataset_name, size, decision, condition_id, reason)]}
 
-            query = 'SELECT s.`name`, d.`name`, r.`size`, r.`decision`, r.`condition`, p.`text` FROM `{0}`.`{1}` AS r'.format(self.cache_db, table_name)
-            query += ' INNER JOIN `{0}`.`sites` AS s ON s.`id` = r.`site_id`'.format(self.history_db)
-            query += ' INNER JOIN `{0}`.`datasets` AS d ON d.`id` = r.`dataset_id`'.format(self.history_db)
-            query += ' LEFT JOIN `{0}`.`policy_conditions` AS p ON p.`id` = r.`condition`'.format(self.history_db)
+            query = 'SELECT r.`site_id`, r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r'
+            query += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
             if type(decisions) is list:
-                query += ' WHERE r.`decision` IN (%s)' % ','.join('\'%s\'' % d for d in decisions)
-            query += ' ORDER BY s.`name` ASC, r.`size` DESC'
+                query += ' WHERE d.`value` IN (%s)' % ','.join('?' for _ in decisions)
+                args = decisions
+            else:
+                args = ()
+            query += ' ORDER BY r.`site_id` ASC, r.`size` DESC'
+
+            rows = snapshot_db.execute(query, args).fetchall()
+
+            dataset_names = self._get_dataset_names(set(row[1] for row in rows))
+            reasons = self._get_condition_texts()
 
             product = {}
 
-            _site_name = ''
+            _site_id = 0
 
-            for site_name, dataset_name, size, decision, cid, reason in self.db.xquery(query):
-                if site_name != _site_name:
-                    product[site_name] = []
-                    current = product[site_name]
-                    _site_name = site_name
-                
-                current.append((dataset_name, size, decision, cid, reason))
+            for site_id, dataset_id, size, decision, cid in rows:
+                if site_id != _site_id:
+                    _site_id = site_id
+                    try:
+                        current = product[site_names[site_id]] = []
+                    except KeyError:
+                        current = None
+
+                if current is None:
+                    continue
+
+                try:
+                    dataset_name = dataset_names[dataset_id]
+                except KeyError:
+                    continue
+
+                current.append((dataset_name, size, decision, cid, reasons.get(cid)))
 
             return product
 
+    def get_site_decisions(self, cycle_number):
+        """
+        Compact version of get_deletion_decisions with size_only = False, read through DetoxHistoryBase.decision_cache
+        if it is set.
+        @param cycle_number   Cycle number
+
+        @return {site_name: SiteDecisions}
+        """
+
+        if DetoxHistoryBase.decision_cache is None:
+            return self._read_site_decisions(cycle_number)
+        else:
+            return DetoxHistoryBase.decision_cache.get(self, cycle_number)
+
+    def _read_site_decisions(self, cycle_number):
+        snapshot_db = self._get_snapshot(cycle_number)
+        if snapshot_db is None:
+            return {}
+
+        site_names = self._get_site_names()
+        dataset_names = self._get_dataset_names(set(row[0] for row in snapshot_db.execute('SELECT DISTINCT `dataset_id` FROM `replicas`')))
+        decisions = dict(snapshot_db.execute('SELECT `id`, `value` FROM `decisions`'))
+        reasons = self._get_condition_texts()
+
+        product = {}
+
+        query = 'SELECT `site_id`, `dataset_id`, `size`, `decision_id`, `condition` FROM `replicas`'
+        query += ' ORDER BY `site_id` ASC, `size` DESC'
+
+        _site_id = 0
+
+        for site_id, dataset_id, size, decision_id, cid in snapshot_db.execute(query):
+            if site_id != _site_id:
+                _site_id = site_id
+                try:
+                    current = product[site_names[site_id]] = SiteDecisions(dataset_names, decisions, reasons)
+                except KeyError:
+                    current = None
+
+            if current is None or dataset_id not in dataset_names:
+                continue
+
+            current.dataset_ids.append(dataset_id)
+            current.sizes.append(size)
+            current.decision_ids.append(decision_id)
+            current.condition_ids.append(cid)
+
+        return product
+
     def get_site_deletion_decisions(self, cycle_number, site_name):
         """
         @return  site-specific version of get_deletion_decisions with size_only = False
         """
 
-        self._fill_snapshot_cache('replicas', cycle_number)
+        snapshot_db = self._get_snapshot(cycle_number)
+        if snapshot_db is None:
+            return []
 
-        table_name = 'replicas_%d' % cycle_number
+        site_ids = self.db.query('SELECT `id` FROM `{0}`.`sites` WHERE `name` = %s'.format(self.history_db), site_name)
+        if len(site_ids) == 0:
+            return []
 
-        query = 'SELECT d.`name`, r.`size`, r.`decision`, r.`condition`, p.`text` FROM `{0}`.`{1}` AS r'.format(self.cache_db, table_name)
-        query += ' INNER JOIN `{0}`.`sites` AS s ON s.`id` = r.`site_id`'.format(self.history_db)
-        query += ' INNER JOIN `{0}`.`datasets` AS d ON d.`id` = r.`dataset_id`'.format(self.history_db)
-        query += ' LEFT JOIN `{0}`.`policy_conditions` AS p ON p.`id` = r.`condition`'.format(self.history_db)
-        query += ' WHERE s.`name` = %s ORDER BY r.`size` DESC'
+        query = 'SELECT r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r'
+        query += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
+        query += ' WHERE r.`site_id` = ? ORDER BY r.`size` DESC'
 
-        return self.db.query(query, site_name)
+        rows = snapshot_db.execute(query, (site_ids[0],)).fetchall()
 
-    def _fill_snapshot_cache(self, template, cycle_number):
-        self.db.use_db(self.cache_db)
+        dataset_names = self._get_dataset_names(set(row[0] for row in rows))
+        reasons = self._get_condition_texts()
 
-        # cycle_number is either a cycle number or a partition name. %s works for both
-        table_name = '%s_%s' % (template, cycle_number)
+        result = []
+        for dataset_id, size, decision, cid in rows:
+            try:
+                result.append((dataset_names[dataset_id], size, decision, cid, reasons.get(cid)))
+            except KeyError:
+                pass
 
-        table_exists = self.db.table_exists(table_name)
+        return result
+
+    def diff_cycles(self, cycle_a, cycle_b, site = None):
+        """
+        Compare the decisions of two cycles replica by replica. The two snapshots are read in (site_id, dataset_id)
+        order and merged, so that only the current replica of each cycle and one chunk of differences are held in
+        memory at a time.
+        @param cycle_a   Cycle number (old)
+        @param cycle_b   Cycle number (new)
+        @param site      If not None, limit to the site of this name
+
+        @return Generator of (site_name, dataset_name, change, decisions_a, decisions_b), where change is 'added',
+                'removed', or 'changed', and decisions_a and decisions_b are tuples of (decision, size, condition_id)
+                of the replica in each cycle (None if the replica is not in the cycle). A replica is 'changed' if the
+                set of its decisions differs between the cycles.
+        """
+
+        if site is None:
+            site_id = None
+        else:
+            site_ids = self.db.query('SELECT `id` FROM `{0}`.`sites` WHERE `name` = %s'.format(self.history_db), site)
+            if len(site_ids) == 0:
+                return
+
+            site_id = site_ids[0]
+
+        file_a = self._get_snapshot_file(cycle_a)
+        file_b = self._get_snapshot_file(cycle_b)
+        if file_a is None or file_b is None:
+            return
+
+        site_names = self._get_site_names()
+
+        # Connections dedicated to this generator, so that the LRU cannot close them while the merge is running
+        snapshot_a = sqlite3.connect(file_a, check_same_thread = False)
+        snapshot_a.text_factory = str
+        snapshot_b = sqlite3.connect(file_b, check_same_thread = False)
+        snapshot_b.text_factory = str
 
-        is_cycle = True
         try:
-            cycle_number += 0
-        except TypeError:
-            is_cycle = False
+            replicas_a = self._read_replica_decisions(snapshot_a, site_id)
+            replicas_b = self._read_replica_decisions(snapshot_b, site_id)
+
+            # [(site_id, dataset_id, change, decisions_a, decisions_b)]
+            differences = []
 
-        if not is_cycle or not table_exists:
-            if is_cycle:
-                db_file_name = '%s/snapshot_%09d.db' % (self.snapshots_spool_dir, cycle_number)
+            def flush():
+                dataset_names = self._get_dataset_names(set(d[1] for d in differences))
 
-                if not os.path.exists(db_file_name):
+                for site_id, dataset_id, change, decisions_a, decisions_b in differences:
                     try:
-                        os.makedirs(self.snapshots_spool_dir)
-                        os.chmod(self.snapshots_spool_dir, 0777)
-                    except OSError:
+                        yield (site_names[site_id], dataset_names[dataset_id], change, decisions_a, decisions_b)
+                    except KeyError:
                         pass
 
-                    scycle = '%09d' % cycle_number
-                    xz_file_name = '%s/%s/%s/snapshot_%09d.db.xz' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6], cycle_number)
-                    if not os.path.exists(xz_file_name):
-                        raise RuntimeError('Archived snapshot DB ' + xz_file_name + ' does not exist')
-    
-                    with open(xz_file_name, 'rb') as xz_file:
-                        with open(db_file_name, 'wb') as db_file:
-                            db_file.write(lzma.decompress(xz_file.read()))
+                del differences[:]
 
-            else:
-                db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
+            entry_a = next(replicas_a, None)
+            entry_b = next(replicas_b, None)
 
-                if not os.path.exists(db_file_name):
-                    return
+            while entry_a is not None or entry_b is not None:
+                if entry_b is None or (entry_a is not None and entry_a[0] < entry_b[0]):
+                    key, decisions_a = entry_a
+                    differences.append(key + ('removed', decisions_a, None))
+                    entry_a = next(replicas_a, None)
 
-            # fill from sqlite
-            if table_exists:
-                self.db.query('TRUNCATE TABLE `{0}`'.format(table_name))
-            else:
-                self.db.query('CREATE TABLE `{0}` LIKE `{1}`'.format(table_name, template))
-
-            snapshot_db = sqlite3.connect(db_file_name)
-            snapshot_db.text_factory = str # otherwise we'll get unicode and MySQLdb cannot convert that
-            snapshot_cursor = snapshot_db.cursor()
-
-            def make_snapshot_reader():
-                if template == 'replicas':
-                    sql = 'SELECT r.`site_id`, r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r'
-                    sql += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
-                elif template == 'sites':
-                    sql = 'SELECT s.`site_id`, t.`value`, s.`quota` FROM `sites` AS s'
-                    sql += ' INNER JOIN `statuses` AS t ON t.`id` = s.`status_id`'
-                    
-                snapshot_cursor.execute(sql)
-                
-                while True:
-                    row = snapshot_cursor.fetchone()
-                    if row is None:
-                        return
-
-                    yield row
-
-            snapshot_reader = make_snapshot_reader()
-
-            if template == 'replicas':
-                fields = ('site_id', 'dataset_id', 'size', 'decision', 'condition')
-            elif template == 'sites':
-                fields = ('site_id', 'status', 'quota')
-                
-            self.db.insert_many(table_name, fields, None, snapshot_reader, do_update = False)
-
-            snapshot_cursor.close()
-            snapshot_db.close()
+                elif entry_a is None or entry_b[0] < entry_a[0]:
+                    key, decisions_b = entry_b
+                    differences.append(key + ('added', None, decisions_b))
+                    entry_b = next(replicas_b, None)
 
-        if is_cycle:
-            # cycle_number is really a number. Update the partition cache table too
-            sql = 'SELECT p.`name` FROM `{hdb}`.`partitions` AS p INNER JOIN `{hdb}`.`deletion_cycles` AS r ON r.`partition_id` = p.`id` WHERE r.`id` = %s'.format(hdb = self.history_db)
-            partition = self.db.query(sql, cycle_number)[0]
-    
-            self._fill_snapshot_cache(template, partition)
+                else:
+                    key, decisions_a = entry_a
+                    _, decisions_b = entry_b
+                    if set(d[0] for d in decisions_a) != set(d[0] for d in decisions_b):
+                        differences.append(key + ('changed', decisions_a, decisions_b))
 
-            # then update the cache usage
-            self._update_cache_usage(template, cycle_number)
+                    entry_a = next(replicas_a, None)
+                    entry_b = next(replicas_b, None)
 
-        self.db.use_db(self.history_db)
+                if len(differences) == SNAPSHOT_DIFF_CHUNK:
+                    for diff in flush():
+                        yield diff
+
+            for diff in flush():
+                yield diff
+
+        finally:
+            snapshot_a.close()
+            snapshot_b.close()
+
+    def _read_replica_decisions(self, snapshot_db, site_id = None):
+        """
+        Generate ((site_id, dataset_id), ((decision, size, condition_id), ...)) from a snapshot in the order of
+        (site_id, dataset_id).
+        """
+
+        sql = 'SELECT r.`site_id`, r.`dataset_id`, d.`value`, r.`size`, r.`condition` FROM `replicas` AS r'
+        sql += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
+        if site_id is None:
+            args = ()
+        else:
+            sql += ' WHERE r.`site_id` = ?'
+            args = (site_id,)
+        sql += ' ORDER BY r.`site_id`, r.`dataset_id`, r.`decision_id`, r.`condition`'
+
+        cursor = snapshot_db.execute(sql, args)
+
+        for key, rows in itertools.groupby(cursor, lambda row: (row[0], row[1])):
+            yield key, tuple((decision, size, condition_id) for _, _, decision, size, condition_id in rows)
+
+    def _get_snapshot(self, cycle_number):
+        """
+        Return an open SQLite connection to the snapshot of a cycle. An archived snapshot is extracted into the spool
+        directory the first time it is requested. Connections are kept open for the max_open_snapshots most recently
+        used snapshots, and are reopened if the file was rewritten in the meantime.
+        @param cycle_number   Cycle number, or partition name for the latest snapshot cycle of the partition
+
+        @return sqlite3 connection, or None if there is no snapshot for the partition
+        """
+
+        db_file_name = self._get_snapshot_file(cycle_number)
+        if db_file_name is None:
+            return None
+
+        stat = os.stat(db_file_name)
+        file_id = (stat.st_ino, stat.st_mtime)
+
+        try:
+            saved_id, snapshot_db = self._snapshots.pop(db_file_name)
+        except KeyError:
+            snapshot_db = None
+        else:
+            if saved_id != file_id:
+                snapshot_db.close()
+                snapshot_db = None
+
+        if snapshot_db is None:
+            snapshot_db = sqlite3.connect(db_file_name, check_same_thread = False)
+            snapshot_db.text_factory = str # otherwise we'll get unicode
+
+        self._snapshots[db_file_name] = (file_id, snapshot_db)
+
+        while len(self._snapshots) > self.max_open_snapshots:
+            old_file_name, (_, old_db) = self._snapshots.popitem(last = False)
+            old_db.close()
+
+            if old_file_name in self._extracted:
+                self._extracted.remove(old_file_name)
+                try:
+                    os.unlink(old_file_name)
+                except OSError:
+                    pass
+
+        return snapshot_db
+
+    def _get_snapshot_file(self, cycle_number):
+        """
+        Return the path of the snapshot SQLite file of a cycle, extracting the archived snapshot if necessary.
+        @param cycle_number   Cycle number or partition name
+
+        @return File name, or None if there is no snapshot for the partition
+        """
+
+        try:
+            cycle_number += 0
+        except TypeError:
+            db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
+
+            if not os.path.exists(db_file_name):
+                return None
+        else:
+            db_file_name = '%s/snapshot_%09d.db' % (self.snapshots_spool_dir, cycle_number)
+
+            if not os.path.exists(db_file_name):
+                self._extract_snapshot(cycle_number, db_file_name)
+
+        return db_file_name
+
+    def _extract_snapshot(self, cycle_number, db_file_name):
+        try:
+            os.makedirs(self.snapshots_spool_dir)
+            os.chmod(self.snapshots_spool_dir, 0777)
+        except OSError:
+            pass
+
+        scycle = '%09d' % cycle_number
+        xz_file_name = '%s/%s/%s/snapshot_%09d.db.xz' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6], cycle_number)
+        if not os.path.exists(xz_file_name):
+            raise RuntimeError('Archived snapshot DB ' + xz_file_name + ' does not exist')
+
+        self._clean_spool()
+
+        LOG.info('Extracting snapshot %s', xz_file_name)
+
+        # Extract into a temporary file so that a partially written snapshot is never opened
+        tmp_file_name = '%s.%d.tmp' % (db_file_name, os.getpid())
+        with open(xz_file_name, 'rb') as xz_file:
+            with open(tmp_file_name, 'wb') as db_file:
+                _transform_file(xz_file, db_file, lzma.LZMADecompressor().decompress, None)
+
+        os.rename(tmp_file_name, db_file_name)
+
+        self._extracted.add(db_file_name)
+
+    def _clean_spool(self):
+        """
+        Delete the numbered cycle snapshots in the spool directory that were written or extracted more than
+        spool_retention days ago, except for the ones open in this instance. Deleted snapshots are extracted again
+        from the archive when requested.
+        """
+
+        limit = time.time() - self.spool_retention * 24. * 3600.
+
+        for file_name in os.listdir(self.snapshots_spool_dir):
+            if re.match('snapshot_[0-9]{9}\.db$', file_name) is None:
+                continue
+
+            db_file_name = '%s/%s' % (self.snapshots_spool_dir, file_name)
+            if db_file_name in self._snapshots:
+                continue
+
+            try:
+                if os.stat(db_file_name).st_mtime < limit:
+                    LOG.info('Deleting old snapshot %s', db_file_name)
+                    os.unlink(db_file_name)
+            except OSError:
+                pass
+
+    def _get_site_names(self):
+        return dict(self.db.xquery('SELECT `id`, `name` FROM `{0}`.`sites`'.format(self.history_db)))
+
+    def _get_dataset_names(self, dataset_ids):
+        if len(dataset_ids) == 0:
+            return {}
+
+        return dict(self.db.select_many(MySQL.bare('`{0}`.`datasets`'.format(self.history_db)), ('id', 'name'), 'id', dataset_ids))
+
+    def _get_condition_texts(self):
+        return dict(self.db.xquery('SELECT `id`, `text` FROM `{0}`.`policy_conditions`'.format(self.history_db)))
 
     def _update_cache_usage(self, template, cycle_number):
         self.db.use_db(self.cache_db)
@@ -384,6 +746,30 @@ class DetoxHistory(DetoxHistoryBase):
             else:
                 line.condition_id = ids[0]
 
+    def save_policy_profile(self, cycle_number, policy_lines, line_stats, attr_stats):
+        """
+        Save the evaluation statistics of the policy lines and the attribute fetch times of a cycle.
+        @param cycle_number  Cycle number.
+        @param policy_lines  List of PolicyLine objects (condition_ids set by save_conditions)
+        @param line_stats    [[(num_evaluated, num_matched, time) for each line] for each iteration]
+        @param attr_stats    {variable name: (number of calls, time)}
+        """
+
+        if self._read_only:
+            return
+
+        def line_entries():
+            for iteration, stats in enumerate(line_stats):
+                for line, (num_evaluated, num_matched, evaluation_time) in zip(policy_lines, stats):
+                    yield (cycle_number, line.condition_id, iteration + 1, num_evaluated, num_matched, evaluation_time)
+
+        fields = ('cycle_id', 'condition_id', 'iteration', 'num_evaluated', 'num_matched', 'time')
+        self.db.insert_many('policy_line_stats', fields, None, line_entries(), do_update = False)
+
+        fields = ('cycle_id', 'variable', 'num_calls', 'time')
+        mapping = lambda (name, (num_calls, duration)): (cycle_number, name, num_calls, duration)
+        self.db.insert_many('policy_attr_stats', fields, mapping, attr_stats.iteritems(), do_update = False)
+
     def save_cycle_state(self, cycle_number, deleted_list, kept_list, protected_list, quotas):
         """
         Save decisions and their reasons for all replicas.
@@ -519,6 +905,10 @@ class DetoxHistory(DetoxHistoryBase):
         snapshot_db = sqlite3.connect(db_file_name)
         snapshot_cursor = snapshot_db.cursor()
 
+        # The file is written from scratch in a single transaction (committed at the end); no need for a journal
+        snapshot_db.execute('PRAGMA journal_mode = OFF')
+        snapshot_db.execute('PRAGMA synchronous = OFF')
+
         # Make enum mapping tables
         # Get the decision value to name mapping from MySQL information_schema
         # This is just a fancy way to arrive at a list [(1, 'delete'), (2, 'keep'), (3, 'protect')]
@@ -530,25 +920,20 @@ class DetoxHistory(DetoxHistoryBase):
             # MySQL enum starts at 1
             decision_mapping.append((idec + 1, decision))
 
+        # Create all tables first; the sqlite3 module commits implicitly before schema statements, and all rows
+        # below are inserted in a single transaction
         sql = 'CREATE TABLE `decisions` ('
         sql += '`id` TINYINT PRIMARY KEY NOT NULL,'
         sql += '`value` TEXT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        for value, name in decision_mapping:
-            snapshot_db.execute('INSERT INTO `decisions` VALUES (?, ?)', (value, name))
 
         sql = 'CREATE TABLE `statuses` ('
         sql += '`id` TINYINT PRIMARY KEY NOT NULL,'
         sql += '`value` TEXT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'ready\')' % Site.STAT_READY)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'waitroom\')' % Site.STAT_WAITROOM)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'morgue\')' % Site.STAT_MORGUE)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'unknown\')' % Site.STAT_UNKNOWN)
 
-        # Fill in the replica states
         sql = 'CREATE TABLE `replicas` ('
         sql += '`site_id` SMALLINT NOT NULL,'
         sql += '`dataset_id` INT NOT NULL,'
@@ -557,16 +942,7 @@ class DetoxHistory(DetoxHistoryBase):
         sql += '`condition` MEDIUMINT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        snapshot_db.execute('CREATE INDEX `site_dataset` ON `replicas` (`site_id`, `dataset_id`)')
-
-        sql = 'INSERT INTO `replicas` VALUES (?, ?, ?, ?, ?)'
-
-        for entry in self.db.xquery('SELECT `site_id`, `dataset_id`, `size`, 0+`decision`, `condition` FROM `{0}`'.format(replica_table_name)):
-            snapshot_cursor.execute(sql, entry)
 
-        snapshot_db.commit()
-
-        # Fill in the site states
         sql = 'CREATE TABLE `sites` ('
         sql += '`site_id` SMALLINT PRIMARY KEY NOT NULL,'
         sql += '`status_id` TINYINT NOT NULL REFERENCES `statuses`(`id`),'
@@ -574,13 +950,35 @@ class DetoxHistory(DetoxHistoryBase):
         sql += ')'
         snapshot_db.execute(sql)
 
+        snapshot_cursor.executemany('INSERT INTO `decisions` VALUES (?, ?)', decision_mapping)
+
+        statuses = [
+            (Site.STAT_READY, 'ready'),
+            (Site.STAT_WAITROOM, 'waitroom'),
+            (Site.STAT_MORGUE, 'morgue'),
+            (Site.STAT_UNKNOWN, 'unknown')
+        ]
+        snapshot_cursor.executemany('INSERT INTO `statuses` VALUES (?, ?)', statuses)
+
+        # Fill in the replica states; rows are streamed from the MySQL table and inserted in chunks
+        sql = 'INSERT INTO `replicas` VALUES (?, ?, ?, ?, ?)'
+
+        entries = self.db.xquery('SELECT `site_id`, `dataset_id`, `size`, 0+`decision`, `condition` FROM `{0}`'.format(replica_table_name))
+        for chunk in _chunks(entries, SNAPSHOT_INSERT_CHUNK):
+            snapshot_cursor.executemany(sql, chunk)
+
+        # Fill in the site states
         sql = 'INSERT INTO `sites` VALUES (?, ?, ?)'
 
-        for entry in self.db.xquery('SELECT `site_id`, 0+`status`, `quota` FROM `{0}`'.format(site_table_name)):
-            snapshot_cursor.execute(sql, entry)
+        entries = self.db.xquery('SELECT `site_id`, 0+`status`, `quota` FROM `{0}`'.format(site_table_name))
+        for chunk in _chunks(entries, SNAPSHOT_INSERT_CHUNK):
+            snapshot_cursor.executemany(sql, chunk)
 
         snapshot_db.commit()
 
+        # Index is built once after the bulk insertion
+        snapshot_db.execute('CREATE INDEX `site_dataset` ON `replicas` (`site_id`, `dataset_id`)')
+
         # Close the sqlite file
         snapshot_cursor.close()
         snapshot_db.close()
@@ -598,9 +996,13 @@ class DetoxHistory(DetoxHistoryBase):
             except OSError:
                 pass
     
+            # Compress incrementally into a temporary file and move it in place when complete
+            compressor = lzma.LZMACompressor()
             with open(db_file_name, 'rb') as db_file:
-                with open(xz_file_name, 'wb') as xz_file:
-                    xz_file.write(lzma.compress(db_file.read()))
+                with open(xz_file_name + '.tmp', 'wb') as xz_file:
+                    _transform_file(db_file, xz_file, compressor.compress, compressor.flush)
+
+            os.rename(xz_file_name + '.tmp', xz_file_name)
 
             self._update_cache_usage('replicas', cycle_number)
             self._update_cache_usage('sites', cycle_number)
@@ -1,14 +1,20 @@
 import time
+import copy
+import heapq
 import logging
+import itertools
 import collections
 
-from dynamo.core.inventory import ObjectRepository
-from dynamo.dataformat import Group, Site, Dataset, Block, DatasetReplica, BlockReplica
+from dynamo.dataformat import Group, Site, BlockReplica, ConfigurationError
 from dynamo.dataformat.history import DeletedReplica
 from dynamo.detox.detoxpolicy import DetoxPolicy
 from dynamo.detox.detoxpolicy import Ignore, Protect, Delete, Dismiss, ProtectBlock, DeleteBlock, DismissBlock
 from dynamo.detox.history import DetoxHistory
+from dynamo.detox.columnar import ColumnarEvaluator
+from dynamo.detox.parallel import ParallelEvaluator
+from dynamo.detox.partitionview import PartitionView
 from dynamo.operation.deletion import DeletionInterface
+from dynamo.policy.attrs import Attr, AttrCache, AttrProfile
 from dynamo.utils.signaling import SignalBlocker
 
 LOG = logging.getLogger(__name__)
@@ -27,10 +33,35 @@ class Detox(object):
 
         self.history = DetoxHistory(config.get('history', None))
 
+        self.config = config
+
         self.policy = DetoxPolicy(config)
 
         self.deletion_per_iteration = config.get('deletion_per_iteration', 0.01)
 
+        # Evaluate the policy lines over the whole partition as vectorized masks (requires numpy)
+        self.columnar_evaluator = None
+        if config.get('columnar_evaluation', False):
+            if ColumnarEvaluator.available():
+                self.columnar_evaluator = ColumnarEvaluator(self.policy)
+            else:
+                LOG.error('Columnar evaluation requested but numpy is not available. Evaluating replica by replica.')
+
+        # Evaluate the policy lines in forked processes, each taking a group of sites
+        self.parallel_evaluator = None
+        num_processes = config.get('num_evaluation_processes', 1)
+        if self.columnar_evaluator is None and num_processes > 1:
+            self.parallel_evaluator = ParallelEvaluator(self.policy, num_processes)
+
+        # Time the attribute fetches during the policy evaluation and save the evaluation statistics of the lines
+        # and the attributes in the history. Lines evaluated by the columnar evaluator are not counted.
+        self.profile_policy = config.get('profile_policy', False)
+        if self.profile_policy:
+            self.policy.set_attr_profile(AttrProfile())
+
+        # [[(num_evaluated, num_matched, time) for each line] for each iteration] of the last policy execution
+        self.line_stats = []
+
         self.test_run = config.get('test_run', False)
         if self.test_run:
             self.deletion_op.set_read_only()
@@ -56,179 +87,227 @@ class Detox(object):
             LOG.info('Detox snapshot cycle for %s starting', self.policy.partition_name)
 
         LOG.info('Building the object repository for the partition.')
-        # Create a full clone of the inventory limited to the partition of the policy
-        partition_repository = self._build_partition(inventory)
+        # Create a view of the inventory limited to the partition of the policy
+        partition_view = self._build_partition(inventory)
+
+        try:
+            LOG.info('Loading dataset attributes.')
+            self._load_attributes(partition_view, [self.policy])
+
+            LOG.info('Saving policy conditions.')
+            # Sets policy IDs for each lines from the history DB; need to run this before execute_policy
+            self.history.save_conditions(self.policy.policy_lines)
 
-        LOG.info('Loading dataset attributes.')
-        for plugin in self.policy.attr_producers:
-            plugin.load(partition_repository)
+            LOG.info('Applying policy to replicas.')
+            deleted, kept, protected, reowned = self._execute_policy(partition_view)
 
-        LOG.info('Saving policy conditions.')
-        # Sets policy IDs for each lines from the history DB; need to run this before execute_policy
-        self.history.save_conditions(self.policy.policy_lines)
+            partition = partition_view.partitions[self.policy.partition_name]
+            quotas = dict((s, s.partitions[partition].quota * 1.e-12) for s in partition_view.sites.itervalues())
 
-        LOG.info('Applying policy to replicas.')
-        deleted, kept, protected, reowned = self._execute_policy(partition_repository)
+            LOG.info('Saving deletion decisions and site states.')
+            self.history.save_cycle_state(cycle_tag, deleted, kept, protected, quotas)
 
-        partition = partition_repository.partitions[self.policy.partition_name]
-        quotas = dict((s, s.partitions[partition].quota * 1.e-12) for s in partition_repository.sites.itervalues())
+            if create_cycle and self.profile_policy:
+                LOG.info('Saving policy evaluation profile.')
+                self.history.save_policy_profile(cycle_tag, self.policy.policy_lines, self.line_stats, self.policy.attr_profile.calls)
 
-        LOG.info('Saving deletion decisions and site states.')
-        self.history.save_cycle_state(cycle_tag, deleted, kept, protected, quotas)
+        finally:
+            LOG.info('Restoring the inventory.')
+            # Decisions refer to the inventory objects; from here on, the changes made in the image are only
+            # available as markers of the view (reassigned and stopped_growing)
+            partition_view.restore()
 
         if create_cycle:
             LOG.info('Committing deletion.')
             comment = 'Dynamo -- Automatic cache release request for %s partition.' % self.policy.partition_name
-            self._commit_deletions(cycle_tag, inventory, deleted, comment)
+            self._commit_deletions(cycle_tag, inventory, deleted, partition_view.stopped_growing, comment)
             comment = 'Dynamo -- Automatic group reassignment for %s partition.' % self.policy.partition_name
-            self._commit_reassignments(inventory, reowned, comment)
+            self._commit_reassignments(inventory, reowned, partition_view.reassigned, partition_view.stopped_growing, comment)
 
             self.history.close_cycle(cycle_tag)
 
         LOG.info('Detox cycle completed')
 
-    def _build_partition(self, inventory):
-        """Create a mini-inventory consisting only of replicas in the partition."""
+    def simulate(self, inventory, policies):
+        """
+        What-if execution of several policies. The partition image is built and the dataset attributes are loaded
+        once, and each policy is executed on the image rolled back to a checkpoint taken before the first execution.
+        Nothing is saved in the history or committed. The image covers the target sites of all policies; each policy
+        acts on its own target sites but sees the replicas at all of them.
+        @param inventory  Dynamo inventory
+        @param policies   List of DetoxPolicy objects or policy texts. All policies must be for the same partition.
+
+        @return {site name: [(deleted, kept, protected) in bytes for each policy]}
+        """
+
+        policies = list(policies)
+        for ipol, policy in enumerate(policies):
+            if isinstance(policy, basestring):
+                config = self.config.clone()
+                config.policy_text = policy
+                policies[ipol] = DetoxPolicy(config)
 
-        partition_repository = ObjectRepository()
-        partition_repository._store = inventory._store
+        partition_name = policies[0].partition_name
+        if any(policy.partition_name != partition_name for policy in policies):
+            raise ConfigurationError('Policies for different partitions cannot be simulated together')
 
-        LOG.info('Identifying target sites.')
+        LOG.info('Detox simulation of %d policies for %s starting', len(policies), partition_name)
 
-        partition = inventory.partitions[self.policy.partition_name]
+        LOG.info('Building the object repository for the partition.')
+        partition_view = self._build_partition(inventory, policies)
 
-        partition.embed_tree(partition_repository)
+        try:
+            LOG.info('Loading dataset attributes.')
+            self._load_attributes(partition_view, policies)
 
-        # Ask each site if deletion should be triggered.
-        target_sites = set() # target sites of this detox cycle
-        tape_is_target = False
-        for site in inventory.sites.itervalues():
+            partition = partition_view.partitions[partition_name]
+            volumes = dict((site.name, [(0, 0, 0)] * len(policies)) for site in partition_view.sites.itervalues())
+
+            partition_view.checkpoint()
+
+            for ipol, policy in enumerate(policies):
+                LOG.info('Applying policy %d to replicas.', ipol)
+
+                target_sites = self._get_target_sites(policy, partition_view.sites.itervalues(), partition)
+
+                detox = copy.copy(self)
+                detox.policy = policy
+                if self.columnar_evaluator is not None:
+                    detox.columnar_evaluator = ColumnarEvaluator(policy)
+                if self.parallel_evaluator is not None:
+                    detox.parallel_evaluator = ParallelEvaluator(policy, self.parallel_evaluator.num_processes)
+
+                decisions = detox._execute_policy(partition_view, target_sites)[:3]
+
+                site_volumes = collections.defaultdict(lambda: [0, 0, 0])
+                for idec, decision in enumerate(decisions):
+                    for replica, matches in decision.iteritems():
+                        for block_replicas in matches.itervalues():
+                            site_volumes[replica.site.name][idec] += sum(br.size for br in block_replicas)
+
+                for site_name, site_volume in site_volumes.iteritems():
+                    volumes[site_name][ipol] = tuple(site_volume)
+
+                partition_view.rollback()
+
+        finally:
+            partition_view.restore()
+
+        LOG.info('Deleted / kept / protected volumes (TB):')
+        for site_name in sorted(volumes.iterkeys()):
+            LOG.info('%s: %s', site_name, ' | '.join('%.1f / %.1f / %.1f' % tuple(v * 1.e-12 for v in vol) for vol in volumes[site_name]))
+
+        LOG.info('Detox simulation completed')
+
+        return volumes
+
+    def _get_target_sites(self, policy, sites, partition):
+        """Return the set of sites where the partition matches the target site definition of the policy."""
+
+        target_sites = set()
+        for site in sites:
             # target_site_defs are SiteConditions, which take site_partition as the argument
             site_partition = site.partitions[partition]
 
-            for targdef in self.policy.target_site_def:
+            for targdef in policy.target_site_def:
                 if targdef.match(site_partition):
                     target_sites.add(site)
-                    if site.storage_type == Site.TYPE_MSS:
-                        tape_is_target = True
-
                     break
 
-        if len(target_sites) == 0:
-            LOG.info('No site matches the target definition.')
-            return partition_repository
+        return target_sites
 
-        # Safety measure - if there are empty (no block rep) tape replicas, create block replicas with size 0 and
-        # add them into the partition. We will not report back to the main process though (i.e. won't call inventory.update).
-        if tape_is_target:
-            for site in filter(lambda s: s.storage_type == Site.TYPE_MSS, target_sites):
-                for replica in site.dataset_replicas():
-                    if len(replica.block_replicas) != 0:
-                        continue
+    def _load_attributes(self, repository, policies):
+        """Load the attributes with the producers required by the policies. Each producer class is loaded once."""
 
-                    for block in replica.dataset.blocks:
-                        block_replica = BlockReplica(block, site, Group.null_group, size = 0)
-                        replica.block_replicas.add(block_replica)
-                        block.replicas.add(block_replica)
+        loaded = set()
+        for policy in policies:
+            for plugin in policy.attr_producers:
+                if type(plugin) in loaded:
+                    continue
 
-                    # Add to the site partition
-                    site.partitions[partition].replicas[replica] = None
+                plugin.load(repository)
+                loaded.add(type(plugin))
 
-        # Create a copy of the inventory, limiting to the current partition
-        # We will be stripping replicas off the image as we process the policy in iterations
-        LOG.info('Creating a partition image.')
+    def _build_partition(self, inventory, policies = None):
+        """
+        Create a view of the inventory consisting only of replicas in the partition.
+        @param inventory  Dynamo inventory
+        @param policies   Policies whose target sites are included (default [self.policy])
+        """
 
-        for group in inventory.groups.itervalues():
-            group.embed_into(partition_repository)
+        if policies is None:
+            policies = [self.policy]
 
-        # Now clone the sites, datasets, and replicas
-        # Basically a copy-paste of various embed_into() functions ommitting the checks
+        LOG.info('Identifying target sites.')
 
-        # make a map to avoid excessive lookups
-        block_to_clone = {}
-        for site in target_sites:
-            site_clone = site.embed_into(partition_repository)
+        partition = inventory.partitions[policies[0].partition_name]
 
-            site_partition = site.partitions[partition]
-            site_partition_clone = site_partition.embed_tree(partition_repository)
+        partition_view = PartitionView(inventory, partition)
 
-            for dataset_replica, block_replica_set in site_partition.replicas.iteritems():
-                dataset = dataset_replica.dataset
+        target_sites = set() # target sites of this detox cycle
+        for policy in policies:
+            target_sites.update(self._get_target_sites(policy, inventory.sites.itervalues(), partition))
 
-                try:
-                    dataset_clone = partition_repository.datasets[dataset.name]
+        tape_is_target = any(site.storage_type == Site.TYPE_MSS for site in target_sites)
 
-                except KeyError:
-                    dataset_clone = dataset.embed_into(partition_repository)
+        if len(target_sites) == 0:
+            LOG.info('No site matches the target definition.')
+            return partition_view
 
-                    for block in dataset.blocks:
-                        block_clone = Block(
-                            block.name,
-                            dataset_clone,
-                            size = block.size,
-                            num_files = block.num_files,
-                            is_open = block.is_open,
-                            last_update = block.last_update,
-                            bid = block.id
-                        )
-                        dataset_clone.blocks.add(block_clone)
+        try:
+            # Safety measure - if there are empty (no block rep) tape replicas, create block replicas with size 0 and
+            # add them into the partition. We will not report back to the main process though (i.e. won't call inventory.update).
+            if tape_is_target:
+                for site in filter(lambda s: s.storage_type == Site.TYPE_MSS, target_sites):
+                    for replica in site.dataset_replicas():
+                        if len(replica.block_replicas) != 0:
+                            continue
 
-                        block_to_clone[block] = block_clone
+                        partition_view.modify(replica)
 
-                if dataset_replica.group is None:
-                    group = None
-                else:
-                    group = partition_repository.groups[dataset_replica.group.name]
-
-                replica_clone = DatasetReplica(
-                    dataset_clone,
-                    site_clone,
-                    growing = dataset_replica.growing,
-                    group = group
-                )
-                dataset_clone.replicas.add(replica_clone)
-                site_clone.add_dataset_replica(replica_clone, add_block_replicas = False)
-
-                if block_replica_set is None:
-                    # all block reps in partition
-                    block_replica_set = dataset_replica.block_replicas
-                    full_replica = True
-                    site_partition_clone.replicas[replica_clone] = None
-                else:
-                    full_replica = False
-                    block_replica_clone_set = site_partition_clone.replicas[replica_clone] = set()
-
-                for block_replica in block_replica_set:
-                    block_clone = block_to_clone[block_replica.block]
-                    if block_replica.is_complete():
-                        size = -1
-                    else:
-                        size = block_replica.size
+                        for block in replica.dataset.blocks:
+                            block_replica = BlockReplica(block, site, Group.null_group, size = 0)
+                            replica.block_replicas.add(block_replica)
+                            block.replicas.add(block_replica)
 
-                    block_replica_clone = BlockReplica(
-                        block_clone,
-                        site_clone,
-                        partition_repository.groups[block_replica.group.name],
-                        is_custodial = block_replica.is_custodial,
-                        size = size,
-                        last_update = block_replica.last_update,
-                        file_ids = block_replica.file_ids
-                    )
+                        # Add to the site partition
+                        site.partitions[partition].replicas[replica] = None
 
-                    replica_clone.block_replicas.add(block_replica_clone)
-                    block_clone.replicas.add(block_replica_clone)
+            # Limit the view to the current partition at the target sites. Instead of cloning the objects, the parts
+            # of the inventory outside of the partition are hidden; the view restores the inventory after the policy is
+            # executed. We will be stripping replicas off the image as we process the policy in iterations
+            LOG.info('Creating a partition image.')
 
-                    if not full_replica:
-                        block_replica_clone_set.add(block_replica_clone)
+            partition_view.make_image(target_sites)
+        except:
+            # The caller never receives the view; put back whatever was changed so far
+            partition_view.restore()
+            raise
 
-        return partition_repository
+        return partition_view
 
-    def _execute_policy(self, repository):
+    def _execute_policy(self, repository, sites = None):
         """
         Sort replicas into deleted, kept, protected, and reowned according to the policy.
         The lists deleted/kept/protected are disjoint. Reowned list overlaps with others.
+        @param repository  Partition view
+        @param sites       Sites to process (default all sites in the repository)
         """
 
+        # Memoize the attributes that scan the other replicas of the dataset during the execution.
+        # Cached values of a dataset are invalidated whenever its replicas in the repository are modified.
+        Attr.cache = AttrCache()
+
+        self.line_stats = []
+        if self.policy.attr_profile is not None:
+            self.policy.attr_profile.clear()
+
+        try:
+            return self._do_execute_policy(repository, sites)
+        finally:
+            Attr.cache = None
+
+    def _do_execute_policy(self, repository, sites):
         partition = repository.partitions[self.policy.partition_name]
 
         # Sites that are e.g. getting full and need dismiss calls
@@ -241,7 +320,10 @@ class Detox(object):
         # taken out of the list until we are left with datasets to be dismissed only.
         all_replicas = set()
 
-        for site in repository.sites.itervalues():
+        if sites is None:
+            sites = repository.sites.itervalues()
+
+        for site in sites:
             site_partition = site.partitions[partition]
             # deletion is triggered by an OR of all triggers
             for trigger in self.policy.deletion_trigger:
@@ -249,10 +331,9 @@ class Detox(object):
                     triggered_sites.add(site)
                     break
 
-            quotas[site] = site.partitions[partition].quota
+            quotas[site] = site_partition.quota
 
-            for replica in site.dataset_replicas():
-                all_replicas.add(replica)
+            all_replicas.update(site_partition.replicas.iterkeys())
 
         LOG.info('Start deletion. Evaluating %d lines against %d replicas.', len(self.policy.policy_lines), len(all_replicas))
 
@@ -274,12 +355,64 @@ class Detox(object):
                 s = replica_map[condition_id] = set()
                 return s
 
+        # Total size of the protected block replicas at each site, kept up to date as block replicas are added to
+        # the protected map (for iterative deletion)
+        protected_volume = collections.defaultdict(int) # {site: size}
+
+        def add_protected(replica, condition_id, block_replicas):
+            protected_list = get_list(protected, replica, condition_id)
+            new_block_replicas = block_replicas - protected_list
+            protected_list.update(new_block_replicas)
+            protected_volume[replica.site] += sum(r.size for r in new_block_replicas)
+
+        # Deletion candidates of each site in the order of the candidate sort key (for iterative deletion).
+        # Queues persist over iterations; entries are invalidated (taken out of queue_entries) when the replica
+        # becomes dirty, and entries of replicas that are not deletion candidates any more are dropped lazily.
+        candidate_queues = collections.defaultdict(list) # {site: [[key, serial, replica]]}
+        queue_entries = {} # {replica: entry}
+        queue_serial = itertools.count()
+
+        # Policy evaluation results are cached. The decision on a replica can only change when block replicas
+        # of the replica (or of its dataset, if the policy looks at the other replicas) are unlinked or reowned.
+        # Only these "dirty" replicas are evaluated again in the following iterations.
+        evaluated_actions = {} # {replica: actions}
+        dirty_replicas = set(all_replicas)
+
+        # With the columnar or parallel evaluator, dirty replicas are evaluated in bulk at the beginning of each iteration.
+        # Bulk results are discarded when the replica becomes dirty again within the iteration.
+        bulk_actions = {} # {replica: actions}
+
+        def set_dirty(replica):
+            if self.policy.reads_other_replicas:
+                dirty_replicas.update(replica.dataset.replicas)
+                for other in replica.dataset.replicas:
+                    bulk_actions.pop(other, None)
+            else:
+                dirty_replicas.add(replica)
+                bulk_actions.pop(replica, None)
+
+            if self.policy.candidate_sort_key.reads_other_replicas:
+                for other in replica.dataset.replicas:
+                    queue_entries.pop(other, None)
+            else:
+                queue_entries.pop(replica, None)
+
         iteration = 0
 
         # now iterate through deletions, updating site usage as we go
         while True:
             iteration += 1
-            LOG.info('Iteration %d, evaluating %d replicas', iteration, len(all_replicas))
+            LOG.info('Iteration %d, %d replicas (%d to evaluate)', iteration, len(all_replicas), len(dirty_replicas & all_replicas))
+
+            for line in self.policy.policy_lines:
+                line.reset_stats()
+
+            if self.columnar_evaluator is not None:
+                bulk_actions.clear()
+                bulk_actions.update(self.columnar_evaluator.evaluate(dirty_replicas & all_replicas))
+            elif self.parallel_evaluator is not None:
+                bulk_actions.clear()
+                bulk_actions.update(self.parallel_evaluator.evaluate(dirty_replicas & all_replicas))
 
             # Delete candidates: replicas that match Dismiss lines and are on sites where deletion is triggered.
             # We will only move a few replicas (on a single site up to deletion_per_iteration) from
@@ -298,12 +431,25 @@ class Detox(object):
             start = time.time()
 
             for replica in all_replicas:
-                # Call policy.evaluate for each replica
+                # Call policy.evaluate for each dirty replica
                 # Function evaluate() returns a list of actions. If the replica matches a dataset-level policy,
                 # there is only one element in the returned list.
                 # Block-level actions are triggered only if the condition does not apply to all blocks.
                 # Sort the evaluation results into the three candidate containers above.
-                actions = self.policy.evaluate(replica)
+                if replica in dirty_replicas:
+                    try:
+                        actions = bulk_actions.pop(replica)
+                    except KeyError:
+                        actions = self.policy.evaluate(replica)
+                    else:
+                        for action in actions:
+                            if action.matched_line is not None:
+                                action.matched_line.has_match = True
+
+                    evaluated_actions[replica] = actions
+                    dirty_replicas.remove(replica)
+                else:
+                    actions = evaluated_actions[replica]
 
                 # Keep track of block replicas matching block-level conditions
                 block_replicas = set(replica.block_replicas)
@@ -319,7 +465,7 @@ class Detox(object):
                         condition_id = matched_line.condition_id
 
                     if isinstance(action, ProtectBlock):
-                        get_list(protected, replica, condition_id).update(action.block_replicas)
+                        add_protected(replica, condition_id, action.block_replicas)
                         block_replicas -= action.block_replicas
     
                     elif isinstance(action, DeleteBlock):
@@ -328,6 +474,7 @@ class Detox(object):
                         # ones to be reowned are added to reowned
                         # the two sets overlap only when reowning causes the block replica to go out of the partition
                         # unlinked - reowned are returned as to_delete
+                        set_dirty(replica)
                         to_delete = self._unlink_block_replicas(replica, partition, action.block_replicas, repository, reowned, block_replicas)
 
                         if len(to_delete) != 0:
@@ -348,7 +495,7 @@ class Detox(object):
 
                     elif isinstance(action, Protect):
                         # protect a full dataset or a remainder after block-level operations
-                        get_list(protected, replica, condition_id).update(block_replicas)
+                        add_protected(replica, condition_id, block_replicas)
                         if block_replicas == replica.block_replicas:
                             # if all block replicas are to be protected, we don't need to evaluate this dataset replica any more.
                             # add to the ignore list to speed up processing
@@ -356,6 +503,7 @@ class Detox(object):
     
                     elif isinstance(action, Delete):
                         # delete a full dataset or a remainder after block-level operations
+                        set_dirty(replica)
                         to_delete = self._unlink_block_replicas(replica, partition, block_replicas, repository, reowned)
 
                         if len(to_delete) != 0:
@@ -364,7 +512,7 @@ class Detox(object):
                         # as a result of the modification, the dataset replica can become empty
                         if len(replica.block_replicas) == 0:
                             # replica is deleted at dataset level - can no longer be growing
-                            replica.growing = False
+                            repository.stop_growing(replica)
                             # if all blocks were deleted, take the replica off all_replicas for later iterations
                             # this is the only place where the replica can become empty
                             empty_replicas.add(replica)
@@ -377,12 +525,20 @@ class Detox(object):
                             get_list(keep_candidates, replica, condition_id).update(block_replicas)
 
             for replica in empty_replicas:
-                replica.unlink_from(repository)
+                repository.delete(replica)
+                Attr.cache.invalidate(replica.dataset)
 
             all_replicas -= empty_replicas
             all_replicas -= ignored_replicas
 
+            for replica in empty_replicas:
+                evaluated_actions.pop(replica, None)
+            for replica in ignored_replicas:
+                evaluated_actions.pop(replica, None)
+
             LOG.info('Took %f seconds to evaluate', time.time() - start)
+
+            self.line_stats.append(self.policy.get_line_stats())
             LOG.info(' %d dataset replicas in deletion candidates', len(delete_candidates))
 
             if len(delete_candidates) == 0:
@@ -398,30 +554,44 @@ class Detox(object):
                 # we will delete from one site at a time
 
                 # all sites where delete candidates are
-                candidate_sites = set(r.site for r in delete_candidates.iterkeys())
-
-                # fraction of protected data at each candidate site
-                protected_fraction = dict((s, 0. if quotas[s] > 0. else 1.) for s in candidate_sites)
+                candidate_sites = set()
 
-                for replica, matches in protected.iteritems():
-                    if replica.site not in protected_fraction:
-                        continue
+                for replica in delete_candidates.iterkeys():
+                    candidate_sites.add(replica.site)
 
-                    quota = quotas[replica.site]
-                    if quota <= 0.:
-                        continue
+                    if replica not in queue_entries:
+                        # new candidate or the sort key may have changed
+                        entry = [self.policy.candidate_sort_key(replica), next(queue_serial), replica]
+                        queue_entries[replica] = entry
+                        heapq.heappush(candidate_queues[replica.site], entry)
 
-                    for condition_id, block_replicas in matches.iteritems():
-                        protected_fraction[replica.site] += sum(r.size for r in block_replicas) / quota
+                # fraction of protected data at each candidate site
+                protected_fraction = {}
+                for site in candidate_sites:
+                    quota = quotas[site]
+                    if quota > 0.:
+                        protected_fraction[site] = float(protected_volume[site]) / quota
+                    else:
+                        protected_fraction[site] = 1.
 
                 # find the site with the highest protected fraction                            
                 selected_site = max(candidate_sites, key = lambda site: protected_fraction[site])
 
-                # all delete candidates at the site
-                candidates_at_site = [r for r in delete_candidates.iterkeys() if r.site == selected_site]
+                def queued_candidates(site):
+                    # delete candidates at the site in the order of the sort key
+                    queue = candidate_queues[site]
+                    while len(queue) != 0:
+                        entry = queue[0]
+                        replica = entry[2]
+                        if queue_entries.get(replica) is entry and replica in delete_candidates:
+                            yield replica
+
+                        # replica handled or the entry is obsolete; if the loop below breaks, the entry stays
+                        heapq.heappop(queue)
+                        if queue_entries.get(replica) is entry:
+                            queue_entries.pop(replica)
 
-                # sorted list of replicas to delete
-                replicas_to_delete = sorted(candidates_at_site, key = self.policy.candidate_sort_key)
+                replicas_to_delete = queued_candidates(selected_site)
 
                 deleted_volume = 0.
 
@@ -447,6 +617,8 @@ class Detox(object):
 
                 LOG.debug('Deleting replica: %s', str(replica))
 
+                set_dirty(replica)
+
                 for condition_id, matches in delete_candidates[replica].iteritems():
                     to_delete = self._unlink_block_replicas(replica, partition, matches, repository, reowned)
 
@@ -458,10 +630,12 @@ class Detox(object):
 
                 if len(replica.block_replicas) == 0:
                     if replica in dataset_level_delete_candidates:
-                        replica.growing = False
+                        repository.stop_growing(replica)
                     
-                    replica.unlink_from(repository)
+                    repository.delete(replica)
+                    Attr.cache.invalidate(replica.dataset)
                     all_replicas.remove(replica)
+                    evaluated_actions.pop(replica, None)
 
                 site_partition = site.partitions[partition]
 
@@ -477,10 +651,19 @@ class Detox(object):
         LOG.info(' %d dataset replicas in keep list', len(kept))
         LOG.info(' %d dataset replicas in protect list', len(protected))
 
-        for line in self.policy.policy_lines:
+        for iline, line in enumerate(self.policy.policy_lines):
             if not line.has_match:
                 LOG.warning('Policy %s had no matching replica.' % str(line))
 
+            num_evaluated = sum(stats[iline][0] for stats in self.line_stats)
+            num_matched = sum(stats[iline][1] for stats in self.line_stats)
+            evaluation_time = sum(stats[iline][2] for stats in self.line_stats)
+            LOG.debug('Policy %s: %d evaluations, %d matches, %f seconds', str(line), num_evaluated, num_matched, evaluation_time)
+
+        if self.policy.attr_profile is not None:
+            for name, (num_calls, duration) in sorted(self.policy.attr_profile.calls.iteritems(), key = lambda (n, c): -c[1]):
+                LOG.debug('Variable %s: %d fetches, %f seconds', name, num_calls, duration)
+
         # Do a last-minute check whether we can really delete these replicas
 #        if policy.predelete_check is not None:
 #            policy.predelete_check(list_chunk)
@@ -523,7 +706,7 @@ class Detox(object):
                 LOG.debug('%d blocks to hand over to %s in %s', len(blocks_to_hand_over), dr_owner.name, str(replica))
 
                 for block_replica in blocks_to_hand_over:
-                    block_replica.group = dr_owner
+                    repository.reassign(block_replica, dr_owner)
     
                     # if the change of owner disqualifies this block replica from the partition,
                     # we unlink it from the repository.
@@ -532,7 +715,7 @@ class Detox(object):
 
         if len(blocks_to_unlink) != 0:
             for block_replica in blocks_to_unlink:
-                block_replica.unlink_from(repository)
+                repository.delete(block_replica)
 
             # if this replica was put in reowned list earlier, take it out
             try:
@@ -555,42 +738,47 @@ class Detox(object):
 
         if len(blocks_to_hand_over) != 0:
             if replica in reowned:
-                reowned[replica].extend(blocks_to_hand_over)
+                reowned[replica].update(blocks_to_hand_over)
             else:
                 reowned[replica] = blocks_to_hand_over
 
+        if Attr.cache is not None and (len(blocks_to_unlink) != 0 or len(blocks_to_hand_over) != 0):
+            Attr.cache.invalidate(replica.dataset)
+
         return blocks_to_unlink - blocks_to_hand_over
 
-    def _commit_deletions(self, cycle_number, inventory, deleted, comment):
+    def _commit_deletions(self, cycle_number, inventory, deleted, stopped_growing, comment):
         """
-        @param cycle_number  Cycle number.
-        @param inventory     Global (original) inventory
-        @param deleted       {dataset_replica: {condition_id: set(block_replicas)}}
-        @param comment       Comment to be passed to the deletion interface.
+        @param cycle_number    Cycle number.
+        @param inventory       Global (original) inventory
+        @param deleted         {dataset_replica: {condition_id: set(block_replicas)}}
+        @param stopped_growing Set of dataset replicas that were set not growing in the partition image
+        @param comment         Comment to be passed to the deletion interface.
         """
 
         signal_blocker = SignalBlocker(logger = LOG)
 
-        # get the original replicas from the inventory and organize them into sites
+        # organize the replicas (inventory objects restored to the original state) into sites
         deletions_by_site = collections.defaultdict(list) # {site: [(dataset_replica, block_replicas)]}
 
         for replica, matches in deleted.iteritems():
-            site = inventory.sites[replica.site.name]
+            site = replica.site
 
-            original_replica = inventory.datasets[replica.dataset.name].find_replica(site)
-            original_block_replicas = dict((br.block.name, br) for br in original_replica.block_replicas)
-            
             all_block_replicas = set()
             for block_replicas in matches.itervalues():
-                for block_replica in block_replicas:
-                    all_block_replicas.add(original_block_replicas[block_replica.block.name])
+                all_block_replicas.update(block_replicas)
+
+            # block replicas created for empty tape replicas are not in the inventory
+            all_block_replicas &= replica.block_replicas
 
-            if not replica.growing and all_block_replicas == original_replica.block_replicas:
+            growing = replica.growing and replica not in stopped_growing
+
+            if not growing and all_block_replicas == replica.block_replicas:
                 # if we are deleting all block replicas and the replica is marked as not growing, delete the DatasetReplica
-                deletions_by_site[site].append((original_replica, None))
+                deletions_by_site[site].append((replica, None))
             else:
                 # otherwise delete only the BlockReplicas
-                deletions_by_site[site].append((original_replica, list(all_block_replicas)))
+                deletions_by_site[site].append((replica, list(all_block_replicas)))
 
         # now schedule deletions for each site
         for site in sorted(deletions_by_site.iterkeys(), key = lambda s: s.name):
@@ -636,11 +824,13 @@ class Detox(object):
                 total_size = sum(r.size for r in history_record.replicas)
                 LOG.info('Done deleting %.1f TB from %s.', total_size * 1.e-12, site.name)
 
-    def _commit_reassignments(self, inventory, reowned, comment):
+    def _commit_reassignments(self, inventory, reowned, reassigned, stopped_growing, comment):
         """
-        @param inventory     Global (original) inventory
-        @param reowned       {dataset_replica: set([block_replicas])}
-        @param comment       Comment to be passed to the copy interface.
+        @param inventory       Global (original) inventory
+        @param reowned         {dataset_replica: set([block_replicas])}
+        @param reassigned      {block_replica: group} new owners of the block replicas in the partition image
+        @param stopped_growing Set of dataset replicas that were set not growing in the partition image
+        @param comment         Comment to be passed to the copy interface.
         """
 
         # If Dynamo owns all files, all we need to do is update the inventory.
@@ -648,32 +838,30 @@ class Detox(object):
         need_operation = hasattr(self.deletion_op, 'schedule_reassignments')
 
         if need_operation:
-            # get the original replicas from the inventory and organize them into sites
+            # organize the replicas (inventory objects restored to the original state) into sites
             reown_by_site = collections.defaultdict(list) # {site: [(dataset_replica, block_replicas)]}
 
         for replica, block_replicas in reowned.iteritems():
             # just do the reassignment in the inventory upfront
-            original_replica = inventory.update(replica)
-
-            original_block_replicas = dict((br.block.name, br) for br in original_replica.block_replicas)
-
             all_block_replicas = set()
             for block_replica in block_replicas:
-                original_block_replica = original_block_replicas[block_replica.block.name]
+                group = reassigned[block_replica]
 
-                if original_block_replica != block_replica:
-                    original_block_replica.copy(block_replica)
-                    inventory.register_update(original_block_replica)
+                if block_replica.group is not group:
+                    block_replica.group = group
+                    inventory.register_update(block_replica)
 
-                all_block_replicas.add(original_block_replica)
+                all_block_replicas.add(block_replica)
 
             if need_operation:
-                if replica.growing and all_block_replicas == original_replica.block_replicas:
+                growing = replica.growing and replica not in stopped_growing
+
+                if growing and all_block_replicas == replica.block_replicas:
                     # if we are reassigning all block replicas and the replica is marked as growing, reassign the DatasetReplica
-                    reown_by_site[original_replica.site].append((original_replica, None))
+                    reown_by_site[replica.site].append((replica, None))
                 else:
                     # otherwise reassign by BlockReplicas
-                    reown_by_site[original_replica.site].append((original_replica, all_block_replicas))
+                    reown_by_site[replica.site].append((replica, all_block_replicas))
 
         if need_operation:
             for site in sorted(reown_by_site.iterkeys(), key = lambda s: s.name):
@@ -0,0 +1,162 @@
+import logging
+import multiprocessing
+
+from dynamo.detox.detoxpolicy import BlockAction
+from dynamo.detox.detoxpolicy import Ignore, Protect, Delete, Dismiss, ProtectBlock, DeleteBlock, DismissBlock
+
+LOG = logging.getLogger(__name__)
+
+# Action classes are sent between the processes as indices into this list
+_action_classes = [Ignore, Protect, Delete, Dismiss, ProtectBlock, DeleteBlock, DismissBlock]
+
+# (policy, shards) of the running evaluation; set before the workers are forked
+_context = None
+
+def _evaluate_shard(ishard):
+    """
+    Worker function. Evaluate the replicas in shard ishard and return the decisions as
+    [(replica index, [(action class index, line index or -1, block replica indices or None)])], together with
+    the line statistics and the attribute profile counts of the shard.
+    """
+
+    policy, shards = _context
+    replicas, block_replica_lists = shards[ishard]
+
+    # statistics are inherited from the parent process at the fork
+    for line in policy.policy_lines:
+        line.reset_stats()
+    if policy.attr_profile is not None:
+        policy.attr_profile.clear()
+
+    line_index = dict((line, iline) for iline, line in enumerate(policy.policy_lines))
+    action_index = dict((cls, icls) for icls, cls in enumerate(_action_classes))
+
+    decisions = []
+
+    for irep, replica in enumerate(replicas):
+        block_replica_index = None
+
+        encoded = []
+        for action in policy.evaluate(replica):
+            if action.matched_line is None:
+                iline = -1
+            else:
+                iline = line_index[action.matched_line]
+
+            if isinstance(action, BlockAction):
+                if block_replica_index is None:
+                    block_replica_index = dict((br, ibr) for ibr, br in enumerate(block_replica_lists[irep]))
+
+                indices = [block_replica_index[br] for br in action.block_replicas]
+            else:
+                indices = None
+
+            encoded.append((action_index[type(action)], iline, indices))
+
+        decisions.append((irep, encoded))
+
+    if policy.attr_profile is None:
+        attr_calls = None
+    else:
+        attr_calls = policy.attr_profile.calls
+
+    return decisions, policy.get_line_stats(), attr_calls
+
+
+class ParallelEvaluator(object):
+    """
+    Evaluation of the policy lines over a set of dataset replicas in forked worker processes. The replicas are
+    grouped by site and the site groups are distributed over the workers. The workers are forked at each call to
+    evaluate, and therefore see the partition image and the dataset attributes as they are in the parent process
+    through the copy-on-write memory. Decisions are sent back as lists of indices and translated into the same lists
+    of actions DetoxPolicy.evaluate returns.
+
+    Only the evaluation is done in the workers. Memoized attribute values and the has_match flags of the lines set
+    in the workers are lost; it is up to the caller to flag the lines when the result is used. Line statistics and
+    the attribute profile counts are added to the policy of the parent process.
+    """
+
+    def __init__(self, policy, num_processes, min_replicas_per_process = 1000):
+        """
+        @param policy                    DetoxPolicy
+        @param num_processes             Maximum number of worker processes.
+        @param min_replicas_per_process  Fewer workers are used if there are not enough replicas to evaluate.
+        """
+
+        self.policy = policy
+        self.num_processes = num_processes
+        self.min_replicas_per_process = min_replicas_per_process
+
+    def evaluate(self, replicas):
+        """
+        @param replicas  Iterable of dataset replicas.
+        @return {replica: actions}. Empty if there are too few replicas to be worth forking.
+        """
+
+        global _context
+
+        by_site = {}
+        num_replicas = 0
+        for replica in replicas:
+            try:
+                by_site[replica.site].append(replica)
+            except KeyError:
+                by_site[replica.site] = [replica]
+
+            num_replicas += 1
+
+        num_shards = min(self.num_processes, len(by_site), num_replicas // self.min_replicas_per_process)
+        if num_shards < 2:
+            return {}
+
+        # distribute the sites over the shards, largest site first to the least loaded shard
+        shards = [([], []) for _ in xrange(num_shards)]
+        loads = [0] * num_shards
+
+        for site_replicas in sorted(by_site.itervalues(), key = lambda l: -sum(len(r.block_replicas) for r in l)):
+            ishard = min(xrange(num_shards), key = lambda i: loads[i])
+            shard_replicas, block_replica_lists = shards[ishard]
+            for replica in site_replicas:
+                shard_replicas.append(replica)
+                block_replica_lists.append(list(replica.block_replicas))
+                loads[ishard] += len(replica.block_replicas)
+
+        LOG.info('Evaluating %d replicas at %d sites in %d processes.', num_replicas, len(by_site), num_shards)
+
+        _context = (self.policy, shards)
+        try:
+            pool = multiprocessing.Pool(num_shards)
+            try:
+                results = pool.map(_evaluate_shard, range(num_shards))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _context = None
+
+        lines = self.policy.policy_lines
+
+        evaluated = {}
+        for (shard_replicas, block_replica_lists), (decisions, line_stats, attr_calls) in zip(shards, results):
+            self.policy.add_line_stats(line_stats)
+            if attr_calls is not None:
+                self.policy.attr_profile.add(attr_calls)
+
+            for irep, encoded in decisions:
+                block_replicas = block_replica_lists[irep]
+
+                actions = []
+                for icls, iline, indices in encoded:
+                    if iline == -1:
+                        matched_line = None
+                    else:
+                        matched_line = lines[iline]
+
+                    if indices is None:
+                        actions.append(_action_classes[icls](matched_line))
+                    else:
+                        actions.append(_action_classes[icls](matched_line, [block_replicas[i] for i in indices]))
+
+                evaluated[shard_replicas[irep]] = actions
+
+        return evaluated
@@ -0,0 +1,222 @@
+import logging
+
+from dynamo.core.inventory import ObjectRepository
+
+LOG = logging.getLogger(__name__)
+
+class PartitionView(ObjectRepository):
+    """
+    Copy-on-write image of a partition at the target sites, made directly out of the inventory objects.
+    Parts of the inventory outside of the image (replicas at the other sites, block replicas outside of the
+    partition) are taken off the dataset, block, and dataset replica containers, so that the usual queries
+    (dataset.replicas, replica.block_replicas, site.partitions[p].replicas, occupancy etc.) see only the image.
+    The state of a dataset replica is recorded the first time the replica is modified through the view, and all
+    recorded replicas are put back in place by restore(). Checkpoints of the image can be taken with checkpoint();
+    replicas modified after the last checkpoint are recorded again and put back to their checkpoint states by
+    rollback(), so that the same image can be processed several times.
+
+    Group reassignments (reassign) and growing flags turned off (stop_growing) are applied to the objects while
+    the image is in use and are also kept as markers, so that they can be committed after the restoration.
+    """
+
+    def __init__(self, inventory, partition):
+        ObjectRepository.__init__(self)
+
+        self.groups = inventory.groups
+        self.partitions = inventory.partitions
+        self._store = inventory._store
+
+        self.partition = partition
+
+        # {block_replica: group} of the block replicas reassigned in the image
+        self.reassigned = {}
+        # dataset replicas whose growing flag was turned off in the image
+        self.stopped_growing = set()
+
+        # [{dataset_replica: state}] recorded at the first modification after the creation and each checkpoint
+        self._saved = [{}]
+        # [(reassigned, stopped_growing)] at each checkpoint
+        self._markers = []
+
+    def make_image(self, sites):
+        """
+        Limit the view to the replicas in the partition at the given sites.
+        @param sites  Target sites
+        """
+
+        image_replicas = set()
+
+        for site in sites:
+            self.sites.add(site)
+
+            for replica, block_replicas in site.partitions[self.partition].replicas.iteritems():
+                image_replicas.add(replica)
+                self.datasets.add(replica.dataset)
+
+                if block_replicas is None or len(block_replicas) == len(replica.block_replicas):
+                    continue
+
+                # hide the block replicas outside of the partition
+                self.modify(replica)
+                for block_replica in replica.block_replicas - block_replicas:
+                    replica.block_replicas.remove(block_replica)
+                    block_replica.block.replicas.remove(block_replica)
+
+        # hide the replicas of the image datasets outside of the image
+        for dataset in self.datasets.itervalues():
+            for replica in dataset.replicas - image_replicas:
+                self.modify(replica)
+                dataset.replicas.remove(replica)
+                for block_replica in replica.block_replicas:
+                    block_replica.block.replicas.remove(block_replica)
+
+        LOG.info('Partition image has %d dataset replicas at %d sites (%d replicas hidden or modified).', len(image_replicas), len(self.sites), len(self._saved[-1]))
+
+    def modify(self, replica):
+        """
+        Record the state of the dataset replica, if not done already. Must be called before the replica, its block
+        replicas, or its site partition entries are modified in place.
+        """
+
+        saved = self._saved[-1]
+        if replica in saved:
+            return
+
+        site = replica.site
+        dataset = replica.dataset
+
+        block_replicas = tuple(replica.block_replicas)
+
+        partitions = {}
+        for site_partition in site.partitions.itervalues():
+            try:
+                partition_block_replicas = site_partition.replicas[replica]
+            except KeyError:
+                continue
+
+            if partition_block_replicas is not None:
+                partition_block_replicas = set(partition_block_replicas)
+
+            partitions[site_partition] = partition_block_replicas
+
+        saved[replica] = (
+            site.find_dataset_replica(dataset) is replica,
+            replica in dataset.replicas,
+            replica.growing,
+            replica.group,
+            block_replicas,
+            tuple(br.group for br in block_replicas),
+            partitions
+        )
+
+    def delete(self, obj): #override
+        """
+        Unlink a dataset replica or a block replica from the image.
+        """
+
+        if type(obj).__name__ == 'BlockReplica':
+            self.modify(obj.site.find_dataset_replica(obj.block.dataset, must_find = True))
+        else:
+            self.modify(obj)
+
+        return ObjectRepository.delete(self, obj)
+
+    def reassign(self, block_replica, group):
+        """
+        Change the owner of a block replica in the image.
+        """
+
+        self.modify(block_replica.site.find_dataset_replica(block_replica.block.dataset, must_find = True))
+
+        block_replica.group = group
+        self.reassigned[block_replica] = group
+
+    def stop_growing(self, replica):
+        """
+        Set the growing flag of a dataset replica in the image to False.
+        """
+
+        self.modify(replica)
+
+        replica.growing = False
+        self.stopped_growing.add(replica)
+
+    def checkpoint(self):
+        """
+        Take a checkpoint of the current state of the image.
+        """
+
+        self._saved.append({})
+        self._markers.append((dict(self.reassigned), set(self.stopped_growing)))
+
+    def rollback(self):
+        """
+        Put the image back to the state at the last checkpoint. The checkpoint stays and can be rolled back to again.
+        """
+
+        if len(self._markers) == 0:
+            raise RuntimeError('No checkpoint to roll back to')
+
+        saved = self._saved[-1]
+        for replica, state in saved.iteritems():
+            self._restore_replica(replica, state)
+
+        saved.clear()
+
+        reassigned, stopped_growing = self._markers[-1]
+        self.reassigned = dict(reassigned)
+        self.stopped_growing = set(stopped_growing)
+
+    def restore(self):
+        """
+        Put all modified dataset replicas back to their recorded states. Checkpoints are discarded; markers are kept.
+        """
+
+        for saved in reversed(self._saved):
+            for replica, state in saved.iteritems():
+                self._restore_replica(replica, state)
+
+        self._saved = [{}]
+        self._markers = []
+
+    def _restore_replica(self, replica, state):
+        registered, listed, growing, group, block_replicas, groups, partitions = state
+
+        site = replica.site
+        dataset = replica.dataset
+
+        replica.growing = growing
+        replica.group = group
+
+        # block replicas added to the image
+        for block_replica in replica.block_replicas - set(block_replicas):
+            replica.block_replicas.remove(block_replica)
+            block_replica.block.replicas.discard(block_replica)
+
+        # block replicas are linked to the blocks while the dataset replica is listed in the dataset
+        for block_replica, block_replica_group in zip(block_replicas, groups):
+            block_replica.group = block_replica_group
+            replica.block_replicas.add(block_replica)
+            if listed:
+                block_replica.block.replicas.add(block_replica)
+            else:
+                block_replica.block.replicas.discard(block_replica)
+
+        if listed:
+            dataset.replicas.add(replica)
+        else:
+            dataset.replicas.discard(replica)
+
+        if registered and site.find_dataset_replica(dataset) is not replica:
+            site.add_dataset_replica(replica, add_block_replicas = False)
+
+        for site_partition in site.partitions.itervalues():
+            try:
+                partition_block_replicas = partitions[site_partition]
+            except KeyError:
+                site_partition.replicas.pop(replica, None)
+            else:
+                if partition_block_replicas is not None:
+                    partition_block_replicas = set(partition_block_replicas)
+
+                site_partition.replicas[replica] = partition_block_replicas
@@ -10,6 +10,8 @@ class SortKey(object):
         self.vars = []
         # Set of attr names used by variables used in sort
         self.required_attrs = set()
+        # True if the key of a replica depends on the other replicas of the dataset
+        self.reads_other_replicas = False
 
         words = text.split()
         iw = 0
@@ -32,6 +34,8 @@ class SortKey(object):
                 raise ConfigurationError('Cannot use non-numeric type to sort: ' + varname)
 
             self.required_attrs.update(variable.required_attrs)
+            if variable.reads_other_replicas:
+                self.reads_other_replicas = True
 
             self.vars.append((variable, reverse))
 
@@ -1,4 +1,5 @@
 import re
+import time
 import fnmatch
 import subprocess
 
@@ -8,6 +9,83 @@ from dynamo.dataformat.exceptions import OperationalError
 class InvalidExpression(Exception):
     pass
 
+class AttrCache(object):
+    """
+    Memoized attribute values. Values are grouped by dataset, and the group must be invalidated whenever the
+    replicas of the dataset change (replica unlinked, block replica unlinked or reowned etc.).
+    """
+
+    def __init__(self):
+        self._values = {} # {dataset: {(attr, obj): value}}
+
+    def get(self, attr, obj, dataset):
+        try:
+            values = self._values[dataset]
+        except KeyError:
+            values = self._values[dataset] = {}
+
+        key = (attr, obj)
+        try:
+            return values[key]
+        except KeyError:
+            value = values[key] = attr._get(obj)
+            return value
+
+    def invalidate(self, dataset):
+        self._values.pop(dataset, None)
+
+    def clear(self):
+        self._values.clear()
+
+class AttrProfile(object):
+    """
+    Number of calls and cumulative time of attribute fetches by variable name. Conditions compiled with a profile
+    (see Condition.compile) fetch the attributes through timed wrappers.
+    """
+
+    def __init__(self):
+        self.calls = {} # {variable name: [number of calls, time]}
+
+    def wrap(self, name, getter):
+        """
+        Return a function that calls getter and adds the call to the entry of name.
+        """
+
+        try:
+            entry = self.calls[name]
+        except KeyError:
+            entry = self.calls[name] = [0, 0.]
+
+        def get(obj):
+            start = time.time()
+            try:
+                return getter(obj)
+            finally:
+                entry[0] += 1
+                entry[1] += time.time() - start
+
+        return get
+
+    def add(self, calls):
+        """
+        Add the counts of another profile (e.g. from a worker process).
+        @param calls  {variable name: (number of calls, time)}
+        """
+
+        for name, (num_calls, duration) in calls.iteritems():
+            try:
+                entry = self.calls[name]
+            except KeyError:
+                entry = self.calls[name] = [0, 0.]
+
+            entry[0] += num_calls
+            entry[1] += duration
+
+    def clear(self):
+        for entry in self.calls.itervalues():
+            entry[0] = 0
+            entry[1] = 0.
+
 class Attr(object):
     """
     Base class representing an extended attribute of an object.
@@ -17,6 +95,10 @@ class Attr(object):
 
     BOOL_TYPE, NUMERIC_TYPE, TEXT_TYPE, TIME_TYPE = range(4)
 
+    # When set to an AttrCache, values of attributes that read the other replicas are memoized. The owner of the
+    # cache (e.g. Detox during policy execution) is responsible for the invalidation.
+    cache = None
+
     def __init__(self, vtype, attr = '', args = None):
         self.vtype = vtype
         self.attr = attr
@@ -24,10 +106,21 @@ class Attr(object):
 
         # Names of dataset.attr used by the instance
         self.required_attrs = []
+
+        # True if the value for a replica depends on the other replicas of the dataset or the block
+        self.reads_other_replicas = False
         
     def get(self, obj):
         return self._get(obj)
 
+    def _get_cached(self, obj, dataset):
+        """_get through Attr.cache if the attribute is expensive (reads the other replicas)."""
+
+        if Attr.cache is None or not self.reads_other_replicas:
+            return self._get(obj)
+        else:
+            return Attr.cache.get(self, obj, dataset)
+
     def _get(self, obj):
         if self.args is None:
             # simple attribute
@@ -85,7 +178,7 @@ class DatasetAttr(Attr):
             except KeyError:
                 return self.dict_default
         else:
-            return self._get(dataset)
+            return self._get_cached(dataset, dataset)
 
 
 class DatasetReplicaAttr(Attr):
@@ -96,10 +189,10 @@ class DatasetReplicaAttr(Attr):
 
     def get(self, replica):
         if type(replica) is BlockReplica:
-            dataset_replica = replica.block.dataset.find_replica(replica.site)
-            return self._get(dataset_replica)
+            dataset = replica.block.dataset
+            return self._get_cached(dataset.find_replica(replica.site), dataset)
         else:
-            return self._get(replica)
+            return self._get_cached(replica, replica.dataset)
 
 
 class BlockReplicaAttr(Attr):
@@ -110,9 +203,10 @@ class BlockReplicaAttr(Attr):
 
     def get(self, replica):
         if type(replica) is BlockReplica:
-            return self._get(replica)
+            return self._get_cached(replica, replica.block.dataset)
         else:
-            return map(self._get, replica.block_replicas)
+            dataset = replica.dataset
+            return [self._get_cached(block_replica, dataset) for block_replica in replica.block_replicas]
 
 
 class ReplicaSiteAttr(Attr):
@@ -1,12 +1,38 @@
+import time
+
 from dynamo.policy.predicates import Predicate
+from dynamo.policy.attrs import BlockReplicaAttr
 
 class Condition(object):
-    """AND-chained Predicates."""
+    """
+    AND-chained Predicates. The predicates are compiled into a single Python function which replaces
+    the match method of the instance (see compile).
+
+    In the adaptive mode (see set_adaptive), the compiled function also counts the evaluations and rejections and
+    measures the time of each predicate. Every adapt_interval calls, the predicates are reordered in increasing
+    order of cost / rejection rate, which minimizes the expected cost of a match when the predicates are independent,
+    and the function is recompiled. Predicates are free of side effects and the evaluation still stops at the first
+    rejecting predicate, so the result of match does not depend on the order.
+    """
 
     def __init__(self, text, variables):
         self.text = text
         self.predicates = []
+        # {predicate: variable name}
+        self.variable_names = {}
         self.required_attrs = set()
+        # see Attr.reads_other_replicas
+        self.reads_other_replicas = False
+        # AttrProfile to time the attribute fetches with (see compile)
+        self.profile = None
+
+        # Adaptive predicate ordering (see set_adaptive)
+        self.adaptive = False
+        self.adapt_interval = 0
+        # [number of calls since the last reordering]
+        self._num_calls = [0]
+        # {predicate: [number of evaluations, number of rejections, time]}
+        self.predicate_stats = {}
 
         pred_strs = map(str.strip, text.split(' and '))
 
@@ -25,6 +51,8 @@ class Condition(object):
 
             # list of name of attrs
             self.required_attrs.update(variable.required_attrs)
+            if variable.reads_other_replicas:
+                self.reads_other_replicas = True
 
             if len(words) > 2:
                 operator = words[1]
@@ -33,7 +61,12 @@ class Condition(object):
 
             rhs_expr = ' '.join(words[2:])
 
-            self.predicates.append(Predicate.get(variable, operator, rhs_expr))
+            predicate = Predicate.get(variable, operator, rhs_expr)
+            self.predicates.append(predicate)
+            self.variable_names[predicate] = expr
+            self.predicate_stats[predicate] = [0, 0, 0.]
+
+        self.compile()
 
     def __str__(self):
         return 'Condition \'%s\'' % self.text
@@ -48,6 +81,116 @@ class Condition(object):
 
         return True
 
+    def set_adaptive(self, adaptive = True, interval = 1000):
+        """
+        Turn the adaptive predicate ordering on or off.
+        @param adaptive  Flag
+        @param interval  Number of calls to match between reorderings
+        """
+
+        self.adaptive = adaptive
+        self.adapt_interval = interval
+        self._num_calls[0] = 0
+        self.compile()
+
+    def reorder(self):
+        """
+        Sort the predicates by the measured cost per rejection and recompile. Statistics are halved so that later
+        measurements can change the order. Predicates that never rejected go last, in the current order.
+        """
+
+        def rank(predicate):
+            num_evaluated, num_rejected, duration = self.predicate_stats[predicate]
+            if num_rejected == 0:
+                return float('inf')
+            # (time / num_evaluated) / (num_rejected / num_evaluated)
+            return duration / num_rejected
+
+        self.predicates.sort(key = rank)
+
+        for stats in self.predicate_stats.itervalues():
+            stats[0] //= 2
+            stats[1] //= 2
+            stats[2] *= 0.5
+
+        self._num_calls[0] = 0
+        self.compile()
+
+    def compile(self):
+        """
+        Generate a function equivalent to match with the attribute getters and the comparisons inlined and
+        the rhs values bound as constants, and set it as the match method of this instance. Must be called
+        again if the predicates, the profile, or the adaptive mode are modified. If self.profile is set, the attribute
+        getters (whole predicates if they cannot be inlined) are wrapped in timers of the profile. In the adaptive mode,
+        the function updates self.predicate_stats and calls reorder every self.adapt_interval calls.
+        """
+
+        namespace = {}
+        def bind(value):
+            name = '_c%d' % len(namespace)
+            namespace[name] = value
+            return name
+
+        lines = ['def match(obj):']
+
+        if self.adaptive:
+            num_calls = bind(self._num_calls)
+            lines.append('    %s[0] += 1' % num_calls)
+            # the current call is completed with the old order
+            lines.append('    if %s[0] >= %d:' % (num_calls, self.adapt_interval))
+            lines.append('        %s()' % bind(self.reorder))
+            clock = bind(time.time)
+
+        for predicate in self.predicates:
+            if self.adaptive:
+                stats = bind(self.predicate_stats[predicate])
+                lines.append('    %s[0] += 1' % stats)
+                lines.append('    start = %s()' % clock)
+                reject = '%s[1] += 1; %s[2] += %s() - start; return False' % (stats, stats, clock)
+                accept = '    %s[2] += %s() - start' % (stats, clock)
+            else:
+                reject = 'return False'
+                accept = None
+
+            expr = predicate.compile('lhs', bind)
+
+            if expr is None:
+                # cannot inline
+                if self.profile is None:
+                    lines.append('    if not %s(obj): %s' % (bind(predicate), reject))
+                else:
+                    lines.append('    if not %s(obj): %s' % (bind(self.profile.wrap(self.variable_names[predicate], predicate)), reject))
+
+                if accept is not None:
+                    lines.append(accept)
+                continue
+
+            if self.profile is None:
+                lines.append('    lhs = %s(obj)' % bind(predicate.variable.get))
+            else:
+                lines.append('    lhs = %s(obj)' % bind(self.profile.wrap(self.variable_names[predicate], predicate.variable.get)))
+
+            if isinstance(predicate.variable, BlockReplicaAttr):
+                # evaluated over a dataset replica, the variable is a list of block replica values
+                # and the predicate is an OR over the list (see Predicate.__call__)
+                lines.append('    if type(lhs) is list:')
+                lines.append('        for lhs in lhs:')
+                lines.append('            if %s: break' % expr)
+                lines.append('        else:')
+                lines.append('            %s' % reject)
+                lines.append('    elif not (%s): %s' % (expr, reject))
+            else:
+                lines.append('    if not (%s): %s' % (expr, reject))
+
+            if accept is not None:
+                lines.append(accept)
+
+        lines.append('    return True')
+
+        exec '\n'.join(lines) in namespace
+
+        self.match = namespace['match']
+
     def get_variable(self, expr, variables):
         """Return an Attr object using the expr from the given variables dictionary."""
 
@@ -34,15 +34,16 @@ class Predicate(object):
         self.variable = variable
 
     def __call__(self, obj):
+        return self.match_value(self.variable.get(obj))
+
+    def match_value(self, lhs):
         """
-        Call _eval of the inherited classes.
+        Call _eval of the inherited classes on a value of the variable.
         In case the LHS is a container (can happen when evaluating a block-level
         expression over a dataset replica), return the OR of _eval calls over the
         container elements.
         """
 
-        lhs = self.variable.get(obj)
-
         # first check for strings - strings are iterable
         if isinstance(lhs, basestring):
             pass
@@ -61,6 +62,16 @@ class Predicate(object):
 
         return self._eval(lhs)
 
+    def compile(self, lhs, bind):
+        """
+        Return the source of a Python expression that evaluates the predicate on a single value (see Condition.compile).
+        @param lhs   Name of the variable holding the value
+        @param bind  Function that takes an object and returns the name it is bound to in the generated code
+
+        @return An expression string, or None if the predicate cannot be compiled.
+        """
+        return None
+
 class UnaryExpr(Predicate):
     operators = ['', 'not']
 
@@ -125,6 +136,22 @@ class SetElementExpr(Predicate):
 
         self.rhs = map(self.variable.rhs_map, elem_exprs)
 
+    def _compile_any(self, lhs, bind):
+        """
+        Expression for "lhs matches any of the elements of rhs" with the elements unrolled.
+        """
+        terms = []
+        for elem in self.rhs:
+            if type(elem) is re._pattern_type:
+                terms.append('%s.match(%s)' % (bind(elem), lhs))
+            else:
+                terms.append('%s == %s' % (bind(elem), lhs))
+
+        if len(terms) == 0:
+            return 'False'
+        else:
+            return '(%s)' % ' or '.join(terms)
+
 
 #################################
 ## Unary (boolean) expressions ##
@@ -134,10 +161,16 @@ class Assert(UnaryExpr):
     def _eval(self, boolexpr):
         return boolexpr
 
+    def compile(self, lhs, bind):
+        return lhs
+
 class Negate(UnaryExpr):
     def _eval(self, boolexpr):
         return not boolexpr
 
+    def compile(self, lhs, bind):
+        return 'not %s' % lhs
+
 #####################################
 ## Binary (comparison) expressions ##
 #####################################
@@ -154,6 +187,12 @@ class Eq(BinaryExpr):
     def _eval(self, lhs):
         return self._call(lhs)
 
+    def compile(self, lhs, bind):
+        if type(self.rhs) is re._pattern_type:
+            return '%s.match(%s) is not None' % (bind(self.rhs), lhs)
+        else:
+            return '%s == %s' % (lhs, bind(self.rhs))
+
 class Neq(BinaryExpr):
     def __init__(self, variable, rhs_expr, is_re = False):
         BinaryExpr.__init__(self, variable, rhs_expr, is_re = is_re)
@@ -166,14 +205,26 @@ class Neq(BinaryExpr):
     def _eval(self, lhs):
         return self._call(lhs)
 
+    def compile(self, lhs, bind):
+        if type(self.rhs) is re._pattern_type:
+            return '%s.match(%s) is None' % (bind(self.rhs), lhs)
+        else:
+            return '%s != %s' % (lhs, bind(self.rhs))
+
 class Lt(BinaryExpr):
     def _eval(self, lhs):
         return lhs < self.rhs
 
+    def compile(self, lhs, bind):
+        return '%s < %s' % (lhs, bind(self.rhs))
+
 class Gt(BinaryExpr):
     def _eval(self, lhs):
         return lhs > self.rhs
 
+    def compile(self, lhs, bind):
+        return '%s > %s' % (lhs, bind(self.rhs))
+
 #########################################
 ## Set-element (inclusion) expressions ##
 #########################################
@@ -193,6 +244,12 @@ class In(SetElementExpr):
 
             return False
 
+    def compile(self, lhs, bind):
+        if self.variable.vtype == attrs.Attr.NUMERIC_TYPE:
+            return '%s in %s' % (lhs, bind(self.rhs))
+        else:
+            return self._compile_any(lhs, bind)
+
 class Notin(SetElementExpr):
     def _eval(self, lhs):
         if self.variable.vtype == attrs.Attr.NUMERIC_TYPE:
@@ -208,3 +265,8 @@ class Notin(SetElementExpr):
 
             return True
 
+    def compile(self, lhs, bind):
+        if self.variable.vtype == attrs.Attr.NUMERIC_TYPE:
+            return '%s not in %s' % (lhs, bind(self.rhs))
+        else:
+            return 'not %s' % self._compile_any(lhs, bind)
@@ -12,6 +12,8 @@ class DatasetHasIncompleteReplica(DatasetAttr):
     def __init__(self):
         DatasetAttr.__init__(self, Attr.BOOL_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, dataset):
         for rep in dataset.replicas:
             if not rep.is_complete():
@@ -45,6 +47,8 @@ class DatasetOnTape(DatasetAttr):
     def __init__(self):
         DatasetAttr.__init__(self, Attr.NUMERIC_TYPE)
 
+        self.reads_other_replicas = True
+
     def rhs_map(self, expr, is_re = False):
         # historic mapping
         if expr == 'NONE':
@@ -80,6 +84,8 @@ class DatasetNumFullDiskCopy(DatasetAttr):
     def __init__(self):
         DatasetAttr.__init__(self, Attr.NUMERIC_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, dataset):
         num = 0
         for rep in dataset.replicas:
@@ -92,6 +98,8 @@ class DatasetNumFullCopy(DatasetAttr):
     def __init__(self):
         DatasetAttr.__init__(self, Attr.NUMERIC_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, dataset):
         num = 0
         for rep in dataset.replicas:
@@ -121,6 +129,8 @@ class ReplicaNumFullDiskCopyCommonOwner(DatasetReplicaAttr):
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.NUMERIC_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, replica):
         owners = set(br.group for br in replica.block_replicas)
         dataset = replica.dataset
@@ -137,6 +147,8 @@ class ReplicaNumFullOtherCopyCommonOwner(DatasetReplicaAttr):
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.NUMERIC_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, replica):
         owners = set(br.group for br in replica.block_replicas)
         dataset = replica.dataset
@@ -181,6 +193,8 @@ class ReplicaIsLastSource(BlockReplicaAttr):
     def __init__(self):
         BlockReplicaAttr.__init__(self, Attr.BOOL_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, replica):
         if not replica.is_complete():
             return False
@@ -228,6 +242,8 @@ class BlockNumFullDiskCopy(BlockReplicaAttr):
     def __init__(self):
         BlockReplicaAttr.__init__(self, Attr.NUMERIC_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, replica):
         num = 0
         for rep in replica.block.replicas:
@@ -240,6 +256,8 @@ class BlockReplicaOnTape(BlockReplicaAttr):
     def __init__(self):
         BlockReplicaAttr.__init__(self, Attr.BOOL_TYPE)
 
+        self.reads_other_replicas = True
+
     def _get(self, replica):
         for rep in replica.block.replicas:
             if rep.site.storage_type == Site.TYPE_MSS and rep.is_complete():
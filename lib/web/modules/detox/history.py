@@ -1,6 +1,7 @@
 import os
 import fnmatch
 import re
+import itertools
 
 from dynamo.web.modules._base import WebModule
 from dynamo.web.modules._filedownload import FileDownloadMixin
@@ -381,6 +382,68 @@ class DetoxDatasetSearch(WebDetoxHistory):
 
         return data
 
+class DetoxCycleDiff(WebDetoxHistory):
+    # Maximum number of replicas returned in one response. Larger diffs are retrieved page by page with the
+    # offset parameter; 'more' in the response tells whether there are replicas beyond the page.
+    max_limit = 10000
+
+    def run(self, caller, request, inventory):
+        cycles = []
+        for key in ['cycle_a', 'cycle_b']:
+            if key not in request:
+                raise exceptions.MissingParameter(key)
+
+            try:
+                cycles.append(int(request[key]))
+            except ValueError:
+                raise exceptions.IllFormedRequest(key, request[key])
+
+        site = request.get('site', None)
+
+        paging = {'offset': 0, 'limit': DetoxCycleDiff.max_limit}
+        for key in ['offset', 'limit']:
+            if key not in request:
+                continue
+
+            try:
+                paging[key] = int(request[key])
+            except ValueError:
+                raise exceptions.IllFormedRequest(key, request[key])
+
+            if paging[key] < 0:
+                raise exceptions.IllFormedRequest(key, request[key])
+
+        offset = paging['offset']
+        limit = min(paging['limit'], DetoxCycleDiff.max_limit)
+
+        def format_decisions(decisions):
+            if decisions is None:
+                return []
+            else:
+                return [{'decision': decision, 'size': size * 1.e-9, 'condition_id': condition_id} for decision, size, condition_id in decisions]
+
+        replicas = []
+        more = False
+
+        differences = self.detox_history.diff_cycles(cycles[0], cycles[1], site = site)
+
+        try:
+            # read one beyond the page to know if there are more
+            for site_name, dataset_name, change, decisions_a, decisions_b in itertools.islice(differences, offset, offset + limit + 1):
+                if len(replicas) == limit:
+                    more = True
+                    break
+
+                replicas.append({'site': site_name, 'dataset': dataset_name, 'change': change, 'old': format_decisions(decisions_a), 'new': format_decisions(decisions_b)})
+        except RuntimeError as exc:
+            # archived snapshot missing
+            raise exceptions.InvalidRequest(str(exc))
+        finally:
+            # release the snapshot connections of the generator
+            differences.close()
+
+        return {'cycle_a': cycles[0], 'cycle_b': cycles[1], 'offset': offset, 'limit': limit, 'more': more, 'replicas': replicas}
+
 export_data = {
     'partitions': DetoxPartitions,
     'cycles': DetoxCycles,
@@ -388,7 +451,8 @@ export_data = {
     'sitedetail': DetoxSiteDetail,
     'datasets': DetoxDatasetSearch,
     'dump': DetoxCycleDump,
-    'policy': DetoxCyclePolicy
+    'policy': DetoxCyclePolicy,
+    'diff': DetoxCycleDiff
 }
 
 def test(cls):
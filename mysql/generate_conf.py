@@ -27,6 +27,9 @@ def generate_local_board_conf(conf_str):
     
     board_conf['config']['db_params'] = OD([('host', host), ('user', user), ('passwd', passwd), ('db', 'dynamoserver'), ('scratch_db', 'dynamo_tmp')])
 
+    if 'batch_size' in conf:
+        board_conf['config']['batch_size'] = conf['batch_size']
+
     return board_conf
 
 def generate_store_conf(conf_str):
@@ -63,6 +66,9 @@ def generate_store_conf(conf_str):
         ('scratch_db', 'dynamo_tmp')
     ])
 
+    if 'num_load_shards' in conf:
+        store_conf['config']['num_load_shards'] = conf['num_load_shards']
+
     store_conf['readonly_config']['db_params'] = OD([
         ('host', host),
         ('db', 'dynamo'),
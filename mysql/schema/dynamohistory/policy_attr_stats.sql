@@ -0,0 +1,7 @@
+CREATE TABLE `policy_attr_stats` (
+  `cycle_id` int(10) NOT NULL,
+  `variable` varchar(64) NOT NULL,
+  `num_calls` int(10) unsigned NOT NULL DEFAULT '0',
+  `time` float NOT NULL DEFAULT '0',
+  UNIQUE KEY `cyclevariable` (`cycle_id`,`variable`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
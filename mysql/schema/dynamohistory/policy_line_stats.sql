@@ -0,0 +1,10 @@
+CREATE TABLE `policy_line_stats` (
+  `cycle_id` int(10) NOT NULL,
+  `condition_id` int(11) unsigned NOT NULL,
+  `iteration` int(10) unsigned NOT NULL,
+  `num_evaluated` int(10) unsigned NOT NULL DEFAULT '0',
+  `num_matched` int(10) unsigned NOT NULL DEFAULT '0',
+  `time` float NOT NULL DEFAULT '0',
+  KEY `cycles` (`cycle_id`),
+  KEY `conditions` (`condition_id`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;